@@ -18,7 +18,8 @@ from .models import (OtherAction, ProcedureType, Session, Surgery, VirusInjectio
 from data.models import Dataset, FileRecord
 from misc.admin import NoteInline
 from subjects.models import Subject
-from .water_control import WaterControl
+from .water_control import WaterControl, water_control_cache_stats
+from .water_ledger import current_water_ledger, water_ledger_at
 
 logger = logging.getLogger(__name__)
 
@@ -131,6 +132,16 @@ class BaseActionForm(forms.ModelForm):
                 self.fields['subject'].queryset = Subject.objects.all().order_by('nickname')
 
 
+class WaterControlCacheStatsMixin(object):
+    """Show the hits and misses of the WaterControl cache below the changelist."""
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        # Passed as a callable so that the stats are read after the rows have been rendered.
+        extra_context['water_control_cache_stats'] = water_control_cache_stats
+        return super(WaterControlCacheStatsMixin, self).changelist_view(
+            request, extra_context=extra_context)
+
+
 class BaseActionAdmin(BaseAdmin):
     fields = ['subject', 'start_time', 'end_time', 'users',
               'location', 'lab', 'procedures', 'narrative']
@@ -246,7 +257,7 @@ class WaterRestrictionForm(forms.ModelForm):
         fields = '__all__'
 
 
-class WaterRestrictionAdmin(BaseActionAdmin):
+class WaterRestrictionAdmin(WaterControlCacheStatsMixin, BaseActionAdmin):
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == 'subject':
             kwargs['queryset'] = Subject.objects.all().order_by('nickname')
@@ -272,7 +283,7 @@ class WaterRestrictionAdmin(BaseActionAdmin):
               'start_time', 'end_time', 'water_type', 'users', 'narrative']
     list_display = ('subject_w', 'start_time_l', 'end_time_l', 'water_type', 'weight',
                     'weight_ref') + WaterControl._columns[3:]
-    list_select_related = ('subject',)
+    list_select_related = ('subject', 'subject__lab')
     list_display_links = ('start_time_l', 'end_time_l')
     readonly_fields = ('weight',)  # WaterControl._columns[1:]
     ordering = ['-start_time', 'subject__nickname']
@@ -301,63 +312,78 @@ class WaterRestrictionAdmin(BaseActionAdmin):
     end_time_l.short_description = 'end date'
     end_time_l.admin_order_field = 'end_time'
 
+    def get_changelist_instance(self, request):
+        """Compute the current water ledger values of the subjects of the page at once."""
+        cl = super(WaterRestrictionAdmin, self).get_changelist_instance(request)
+        rows = [obj for obj in cl.result_list if obj.subject]
+        ledgers = current_water_ledger({obj.subject for obj in rows})
+        for obj in rows:
+            obj._water_ledger = ledgers[obj.subject.pk]
+        return cl
+
+    def _ledger(self, obj):
+        """Return the current water ledger values of the subject, computed once per row."""
+        if not hasattr(obj, '_water_ledger'):
+            obj._water_ledger = water_ledger_at(obj.subject)
+        return obj._water_ledger
+
     def weight(self, obj):
         if not obj.subject:
             return
-        return '%.1f' % obj.subject.water_control.weight()
+        return '%.1f' % self._ledger(obj)['weight']
     weight.short_description = 'weight'
 
     def weight_ref(self, obj):
         if not obj.subject:
             return
-        return '%.1f' % obj.subject.water_control.reference_weight()
+        return '%.1f' % self._ledger(obj)['reference_weight']
 
     def expected_weight(self, obj):
         if not obj.subject:
             return
-        return '%.1f' % obj.subject.water_control.expected_weight()
+        return '%.1f' % self._ledger(obj)['expected_weight']
     expected_weight.short_description = 'weight exp'
 
     def percentage_weight(self, obj):
         if not obj.subject:
             return
-        return '%.1f' % obj.subject.water_control.percentage_weight()
+        return '%.1f' % self._ledger(obj)['percentage_weight']
     percentage_weight.short_description = 'weight pct'
 
     def min_weight(self, obj):
         if not obj.subject:
             return
-        return '%.1f' % obj.subject.water_control.min_weight()
+        return '%.1f' % self._ledger(obj)['min_weight']
     min_weight.short_description = 'weight min'
 
     def given_water_reward(self, obj):
         if not obj.subject:
             return
-        return '%.2f' % obj.subject.water_control.given_water_reward()
+        return '%.2f' % self._ledger(obj)['given_water_reward']
     given_water_reward.short_description = 'water reward'
 
     def given_water_supplement(self, obj):
         if not obj.subject:
             return
-        return '%.2f' % obj.subject.water_control.given_water_supplement()
+        return '%.2f' % self._ledger(obj)['given_water_supplement']
     given_water_supplement.short_description = 'water suppl'
 
     def given_water_total(self, obj):
         if not obj.subject:
             return
-        return '%.2f' % obj.subject.water_control.given_water_total()
+        return '%.2f' % self._ledger(obj)['given_water_total']
     given_water_total.short_description = 'water tot'
 
     def expected_water(self, obj):
         if not obj.subject:
             return
-        return '%.2f' % obj.subject.water_control.expected_water()
+        return '%.2f' % self._ledger(obj)['expected_water']
     expected_water.short_description = 'water exp'
 
     def excess_water(self, obj):
         if not obj.subject:
             return
-        return '%.2f' % obj.subject.water_control.excess_water()
+        return '%.2f' % self._ledger(obj)['excess_water']
     excess_water.short_description = 'water excess'
 
     def is_water_restricted(self, obj):
@@ -373,7 +399,7 @@ class WeighingForm(BaseActionForm):
             self.fields['weight'].widget.attrs.update({'autofocus': 'autofocus'})
 
 
-class WeighingAdmin(BaseActionAdmin):
+class WeighingAdmin(WaterControlCacheStatsMixin, BaseActionAdmin):
     list_display = ['subject_l', 'weight', 'percentage_weight', 'date_time']
     list_select_related = ('subject',)
     fields = ['subject', 'date_time', 'weight', 'user']
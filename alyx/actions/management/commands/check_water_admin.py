@@ -1,6 +1,7 @@
 from django.core.management import BaseCommand
 from actions.models import WaterRestriction
 from actions.notifications import check_water_administration
+from actions.water_control import water_control_many
 
 
 class Command(BaseCommand):
@@ -10,11 +11,13 @@ class Command(BaseCommand):
         pass
 
     def handle(self, *args, **options):
-        wrs = WaterRestriction.objects.select_related('subject'). \
+        wrs = WaterRestriction.objects.select_related(
+            'subject', 'subject__lab', 'subject__responsible_user'). \
             filter(
                 subject__death_date__isnull=True,
                 start_time__isnull=False,
                 end_time__isnull=True). \
             order_by('subject__responsible_user__username', 'subject__nickname')
+        wcs = water_control_many([wr.subject for wr in wrs])
         for wr in wrs:
-            check_water_administration(wr.subject)
+            check_water_administration(wr.subject, wc=wcs[wr.subject.id])
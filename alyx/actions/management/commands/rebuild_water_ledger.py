@@ -0,0 +1,21 @@
+from django.core.management import BaseCommand
+from actions.water_ledger import rebuild_water_ledger
+from subjects.models import Subject
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily water ledger of the subjects from scratch."
+
+    def add_arguments(self, parser):
+        parser.add_argument('nicknames', nargs='*',
+                            help='Subject nicknames (all subjects by default)')
+        parser.add_argument('--lab', help='Only the subjects of this lab')
+
+    def handle(self, *args, **options):
+        subjects = Subject.objects.select_related('lab').order_by('nickname')
+        if options.get('nicknames'):
+            subjects = subjects.filter(nickname__in=options['nicknames'])
+        if options.get('lab'):
+            subjects = subjects.filter(lab__name=options['lab'])
+        rebuild_water_ledger(subjects)
+        self.stdout.write("Rebuilt the water ledger of %d subjects." % len(subjects))
@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:19
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subjects', '0004_remove_project_repositories'),
+        ('actions', '0006_cull_cullmethod_cullreason'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaterLedger',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(blank=True, help_text='Long name', max_length=255)),
+                ('json', django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='Structured data, formatted in a user-defined way', null=True)),
+                ('date', models.DateField()),
+                ('weight', models.FloatField(default=0)),
+                ('weighing_at', models.FloatField(blank=True, null=True)),
+                ('reference_weight', models.FloatField(default=0)),
+                ('expected_weight', models.FloatField(default=0)),
+                ('min_weight', models.FloatField(default=0)),
+                ('percentage_weight', models.FloatField(default=0)),
+                ('given_water_reward', models.FloatField(default=0)),
+                ('given_water_supplement', models.FloatField(default=0)),
+                ('given_water_total', models.FloatField(default=0)),
+                ('expected_water', models.FloatField(default=0)),
+                ('excess_water', models.FloatField(default=0)),
+                ('is_water_restricted', models.BooleanField(default=False)),
+                ('subject', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='water_ledger', to='subjects.Subject')),
+            ],
+            options={
+                'unique_together': {('subject', 'date')},
+            },
+        ),
+    ]
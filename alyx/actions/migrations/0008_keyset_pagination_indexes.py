@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actions', '0007_waterledger'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='session',
+            index=models.Index(fields=['start_time', 'id'], name='actions_ses_start_t_2c6ed5_idx'),
+        ),
+    ]
@@ -5,6 +5,8 @@ from math import inf
 from django.conf import settings
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
 from alyx.base import BaseModel, modify_fields, alyx_mail
@@ -60,8 +62,9 @@ class Weighing(BaseModel):
 
     def save(self, *args, **kwargs):
         super(Weighing, self).save(*args, **kwargs)
-        from actions.notifications import check_weighing
-        check_weighing(self.subject)
+        # the weighing check replays the history of the subject, it is run by the job queue
+        from misc.jobs import enqueue
+        enqueue('check_weighing', key=str(self.subject_id), subject=str(self.subject_id))
 
     def __str__(self):
         return 'Weighing %.2f g for %s' % (self.weight,
@@ -97,14 +100,18 @@ class WaterAdministration(BaseModel):
     water_type = models.ForeignKey(WaterType, null=True, blank=True, on_delete=models.SET_NULL)
     adlib = models.BooleanField(default=False)
 
+    @staticmethod
+    def subject_water_type(subject):
+        """Default water type of the water administrations of a subject."""
+        wr = WaterRestriction.objects.filter(subject=subject).\
+            order_by('start_time').last()
+        if wr:
+            return wr.water_type
+        return WaterType.objects.get(pk=_default_water_type())
+
     def save(self, *args, **kwargs):
         if not self.water_type:
-            wr = WaterRestriction.objects.filter(subject=self.subject).\
-                order_by('start_time').last()
-            if wr:
-                self.water_type = wr.water_type
-            else:
-                self.water_type = WaterType.objects.get(pk=_default_water_type())
+            self.water_type = self.subject_water_type(self.subject)
         return super(WaterAdministration, self).save(*args, **kwargs)
 
     def expected(self):
@@ -242,6 +249,10 @@ class Session(BaseAction):
     n_trials = models.IntegerField(blank=True, null=True)
     n_correct_trials = models.IntegerField(blank=True, null=True)
 
+    class Meta:
+        # keyset pagination of the sessions
+        indexes = [models.Index(fields=['start_time', 'id'])]
+
     def save(self, *args, **kwargs):
         # Default project is the subject's project.
         if not self.project_id:
@@ -287,6 +298,120 @@ class OtherAction(BaseAction):
     pass
 
 
+class WaterLedger(BaseModel):
+    """
+    Daily weight and water values of a subject, as computed by WaterControl. This is
+    maintained automatically from the weighings, water administrations and water
+    restrictions (see actions.water_ledger), and should not be edited by hand.
+    """
+    subject = models.ForeignKey(
+        'subjects.Subject', related_name='water_ledger', on_delete=models.CASCADE)
+    date = models.DateField()
+    weight = models.FloatField(default=0)
+    weighing_at = models.FloatField(null=True, blank=True)
+    reference_weight = models.FloatField(default=0)
+    expected_weight = models.FloatField(default=0)
+    min_weight = models.FloatField(default=0)
+    percentage_weight = models.FloatField(default=0)
+    given_water_reward = models.FloatField(default=0)
+    given_water_supplement = models.FloatField(default=0)
+    given_water_total = models.FloatField(default=0)
+    expected_water = models.FloatField(default=0)
+    excess_water = models.FloatField(default=0)
+    is_water_restricted = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = [('subject', 'date')]
+
+    def __str__(self):
+        return 'Water ledger of %s on %s' % (self.subject, self.date)
+
+
+@receiver(post_save, sender=Weighing)
+@receiver(post_save, sender=WaterAdministration)
+@receiver(post_save, sender=WaterRestriction)
+@receiver(post_delete, sender=Weighing)
+@receiver(post_delete, sender=WaterAdministration)
+@receiver(post_delete, sender=WaterRestriction)
+@receiver(post_save, sender='subjects.Subject')
+@receiver(post_delete, sender='subjects.Subject')
+@receiver(post_save, sender=Lab)
+@receiver(post_delete, sender=Lab)
+def invalidate_water_control_cache(sender, instance=None, **kwargs):
+    """Remove the cached WaterControl instances that depend on the saved or deleted object."""
+    from actions.water_control import invalidate_water_control
+    if sender is Lab:
+        subject_ids = list(instance.subject_set.values_list('pk', flat=True))
+    elif hasattr(instance, 'subject_id'):
+        subject_ids = [instance.subject_id]
+        # The subject of the record before it was modified.
+        origin = getattr(instance, '_ledger_origin', None)
+        if origin:
+            subject_ids.append(origin[0])
+    else:
+        subject_ids = [instance.pk]
+    invalidate_water_control(subject_ids)
+
+
+@receiver(pre_save, sender=Weighing)
+@receiver(pre_save, sender=WaterAdministration)
+@receiver(pre_save, sender=WaterRestriction)
+def stash_water_ledger_origin(sender, instance=None, raw=False, **kwargs):
+    """Remember the subject and date of an existing record before it is modified, so
+    that the water ledger is also updated from its former date."""
+    if raw:
+        return
+    from actions.water_ledger import ledger_origin
+    instance._ledger_origin = ledger_origin(sender, instance)
+
+
+@receiver(post_save, sender=Weighing)
+@receiver(post_save, sender=WaterAdministration)
+@receiver(post_save, sender=WaterRestriction)
+def update_water_ledger_on_save(sender, instance=None, raw=False, **kwargs):
+    if raw:
+        return
+    from actions.water_ledger import update_water_ledger_for
+    update_water_ledger_for(sender, instance)
+
+
+@receiver(post_delete, sender=Weighing)
+@receiver(post_delete, sender=WaterAdministration)
+@receiver(post_delete, sender=WaterRestriction)
+def update_water_ledger_on_delete(sender, instance=None, **kwargs):
+    from actions.water_ledger import update_water_ledger_for
+    update_water_ledger_for(sender, instance, deleted=True)
+
+
+def post_bulk_create(sender, instances):
+    """Run the updates of the post_save signals and of Weighing.save() after some weighings
+    or water administrations have been created with bulk_create(), once per subject instead
+    of once per record."""
+    from actions.water_control import invalidate_water_control
+    from actions.water_ledger import update_water_ledger_for_many
+    from misc.jobs import enqueue
+    subjects = {instance.subject_id for instance in instances}
+    invalidate_water_control(list(subjects))
+    update_water_ledger_for_many(sender, instances)
+    if sender is Weighing:
+        for subject in subjects:
+            enqueue('check_weighing', key=str(subject), subject=str(subject))
+
+
+@receiver(post_save, sender='subjects.Subject')
+@receiver(post_save, sender=Lab)
+def invalidate_water_ledger_on_save(sender, instance=None, raw=False, **kwargs):
+    """The ledger depends on the subject (birth date, implant weight...) and on the
+    weight percentages of its lab: drop it, it will be computed again when requested."""
+    if raw or kwargs.get('created'):
+        return
+    from actions.water_ledger import invalidate_water_ledger
+    if sender is Lab:
+        invalidate_water_ledger(instance.subject_set.values('pk'))
+    else:
+        invalidate_water_ledger([instance.pk])
+
+
 # Notifications
 # ---------------------------------------------------------------------------------
 
@@ -31,9 +31,17 @@ def check_weighing(subject, date=None):
         create_notification('mouse_underweight', msg, subject)
 
 
-def check_water_administration(subject, date=None):
+def check_subject_weighing(subject):
+    """Job enqueued when some weighings of a subject are added."""
+    from subjects.models import Subject
+    subject = Subject.objects.filter(pk=subject).first()
+    if subject is not None:
+        check_weighing(subject)
+
+
+def check_water_administration(subject, date=None, wc=None):
     date = date or timezone.now()
-    wc = subject.reinit_water_control()
+    wc = wc or subject.reinit_water_control()
     remaining = wc.remaining_water(date=date)
     wa = wc.last_water_administration_at(date=date)
     if not wa:
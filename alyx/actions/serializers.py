@@ -1,13 +1,17 @@
+import json
+
 from rest_framework import serializers
 from django.contrib.admin.models import LogEntry, ADDITION
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
 
 from .models import (ProcedureType, Session, WaterAdministration, Weighing, WaterType,
-                     WaterRestriction)
+                     WaterRestriction, post_bulk_create)
 from subjects.models import Subject, Project
-from data.models import Dataset, DatasetType
+from data.models import Dataset, DatasetType, prefetch_data_urls
 from misc.models import LabLocation, Lab
+from alyx.base import SparseFieldsMixin, ValuesSerializer, sparse_eager_loading
 
 SESSION_FIELDS = ('subject', 'users', 'location', 'procedures', 'lab', 'project', 'type',
                   'task_protocol', 'number', 'start_time', 'end_time', 'narrative',
@@ -28,6 +32,42 @@ def _log_entry(instance, user):
     return instance
 
 
+def _log_entries(instances, user):
+    """Bulk version of _log_entry()."""
+    if not instances:
+        return
+    content_type_id = ContentType.objects.get_for_model(instances[0]).pk
+    LogEntry.objects.bulk_create([
+        LogEntry(user_id=user.pk, content_type_id=content_type_id,
+                 object_id=str(instance.pk), object_repr=str(instance)[:200],
+                 action_flag=ADDITION, change_message=json.dumps([{'added': {}}]))
+        for instance in instances])
+
+
+class BulkCreateListSerializer(serializers.ListSerializer):
+    """
+    List serializer creating all the validated weighings or water administrations in one
+    transaction with bulk_create(). The post-save updates (water control, water ledger,
+    weighing notifications) are run once per subject.
+    """
+    def create(self, validated_data):
+        model = self.child.Meta.model
+        instances = [model(**attrs) for attrs in validated_data]
+        if model is WaterAdministration:
+            water_types = {}
+            for instance in instances:
+                if not instance.water_type:
+                    if instance.subject_id not in water_types:
+                        water_types[instance.subject_id] = \
+                            WaterAdministration.subject_water_type(instance.subject)
+                    instance.water_type = water_types[instance.subject_id]
+        with transaction.atomic():
+            model.objects.bulk_create(instances)
+            _log_entries(instances, self.context['request'].user)
+            post_bulk_create(model, instances)
+        return instances
+
+
 class BaseActionSerializer(serializers.HyperlinkedModelSerializer):
     subject = serializers.SlugRelatedField(
         read_only=False,
@@ -108,12 +148,13 @@ class SessionWaterAdminSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'water_type', 'water_administered')
 
 
-class SessionListSerializer(BaseActionSerializer):
+class SessionListSerializer(SparseFieldsMixin, BaseActionSerializer):
 
     @staticmethod
-    def setup_eager_loading(queryset):
+    def setup_eager_loading(queryset, fields=None):
         """ Perform necessary eager loading of data to avoid horrible performance."""
-        queryset = queryset.select_related('subject', 'lab')
+        queryset = sparse_eager_loading(
+            queryset, fields, select_related={'subject': ['subject'], 'lab': ['lab']})
         return queryset.order_by('-start_time')
 
     class Meta:
@@ -121,7 +162,11 @@ class SessionListSerializer(BaseActionSerializer):
         fields = ('subject', 'start_time', 'number', 'lab', 'url')
 
 
-class SessionDetailSerializer(BaseActionSerializer):
+class SessionListValuesSerializer(ValuesSerializer):
+    serializer_class = SessionListSerializer
+
+
+class SessionDetailSerializer(SparseFieldsMixin, BaseActionSerializer):
 
     data_dataset_session_related = SessionDatasetsSerializer(read_only=True, many=True)
     wateradmin_session_related = SessionWaterAdminSerializer(read_only=True, many=True)
@@ -130,14 +175,20 @@ class SessionDetailSerializer(BaseActionSerializer):
                                            queryset=Project.objects.all(), required=False)
 
     @staticmethod
-    def setup_eager_loading(queryset):
-        queryset = queryset.prefetch_related(
-            'data_dataset_session_related',
-            'data_dataset_session_related__dataset_type',
-            'data_dataset_session_related__file_records',
-            'data_dataset_session_related__file_records__data_repository',
-            'wateradmin_session_related',
-        )
+    def setup_eager_loading(queryset, fields=None):
+        queryset = sparse_eager_loading(
+            queryset, fields,
+            prefetch_related={
+                'data_dataset_session_related': [
+                    'data_dataset_session_related',
+                    'data_dataset_session_related__dataset_type',
+                    prefetch_data_urls('data_dataset_session_related__'),
+                ],
+                'wateradmin_session_related': [
+                    'wateradmin_session_related',
+                    'wateradmin_session_related__water_type',
+                ],
+            })
         return queryset.order_by('-start_time')
 
     class Meta:
@@ -175,6 +226,7 @@ class WeighingDetailSerializer(serializers.HyperlinkedModelSerializer):
         model = Weighing
         fields = ('subject', 'date_time', 'weight',
                   'user', 'url')
+        list_serializer_class = BulkCreateListSerializer
 
 
 class WaterTypeDetailSerializer(serializers.HyperlinkedModelSerializer):
@@ -240,3 +292,4 @@ class WaterAdministrationDetailSerializer(serializers.HyperlinkedModelSerializer
         fields = ('subject', 'date_time', 'water_administered', 'water_type', 'user', 'url',
                   'session', 'adlib')
         extra_kwargs = {'url': {'view_name': 'water-administration-detail'}}
+        list_serializer_class = BulkCreateListSerializer
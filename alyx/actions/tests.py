@@ -4,12 +4,17 @@ from django.test import TestCase
 from django.utils import timezone
 
 from alyx import base
-from actions.water_control import to_date
+from actions.water_control import (
+    to_date, water_control, water_control_many, water_control_cache_stats,
+    invalidate_water_control, cached_water_control_many)
+from actions.water_ledger import (
+    current_water_ledger, water_ledger, water_ledger_at, rebuild_water_ledger)
 from actions.models import (
-    WaterAdministration, WaterRestriction, WaterType, Weighing,
+    WaterAdministration, WaterRestriction, WaterType, Weighing, WaterLedger,
     Notification, NotificationRule, create_notification)
 from actions.notifications import check_water_administration
-from misc.models import LabMember, LabMembership, Lab
+from misc.jobs import run_jobs
+from misc.models import Job, LabMember, LabMembership, Lab
 from subjects.models import Subject
 
 
@@ -62,6 +67,141 @@ class WaterControlTests(TestCase):
         self.assertTrue(wa[0].expected() == wc.expected_water(date=wa[0].date_time))
         self.assertTrue(wa[40].expected() == wc.expected_water(date=wa[40].date_time))
 
+    def test_water_control_to_jsonable(self):
+        # the vectorized columns should match the column methods evaluated day by day
+        for lab in ('rweigh', 'zscore', 'mixed'):
+            self.sub.lab = Lab.objects.get(name=lab)
+            self.sub.save()
+            wc = self.sub.reinit_water_control()
+            start_date = self.start_date - datetime.timedelta(days=2)
+            end_date = self.start_date + datetime.timedelta(days=55, hours=3)
+            records = wc.to_jsonable(start_date=start_date, end_date=end_date)
+            self.assertEqual(len(records), 58)
+            for record in records:
+                date = datetime.datetime.combine(record['date'], start_date.time())
+                for col in wc._columns[1:]:
+                    self.assertEqual(repr(record[col]), repr(getattr(wc, col)(date=date)))
+
+    def test_water_control_many(self):
+        sub = Subject.objects.create(nickname='smallboy', birth_date='2018-09-01', lab=self.lab)
+        Weighing.objects.create(weight=20, subject=sub, date_time=self.start_date)
+        subjects = Subject.objects.filter(nickname__in=('bigboy', 'smallboy'))
+        # one query for the subjects, and one per history table
+        with self.assertNumQueries(4):
+            wcs = water_control_many(subjects)
+        self.assertEqual(len(wcs), 2)
+        for subject in subjects:
+            self.assertEqual(wcs[subject.id].to_jsonable(end_date='2018-12-01'),
+                             subject.water_control.to_jsonable(end_date='2018-12-01'))
+
+    def test_water_control_cache(self):
+        stats = water_control_cache_stats()
+        invalidate_water_control([self.sub.pk])
+        # the first access builds the water control, the next ones read it from the cache
+        # after checking the version of the water history (one query per table)
+        wc = Subject.objects.get(pk=self.sub.pk).water_control
+        sub = Subject.objects.get(pk=self.sub.pk)
+        with self.assertNumQueries(4):
+            cached = sub.water_control
+        self.assertEqual(cached.to_jsonable(end_date='2018-12-01'),
+                         wc.to_jsonable(end_date='2018-12-01'))
+        new_stats = water_control_cache_stats()
+        self.assertEqual(new_stats['misses'] - stats['misses'], 1)
+        self.assertEqual(new_stats['hits'] - stats['hits'], 1)
+
+        def _assert_fresh():
+            # the cached water control matches the one built from the database
+            sub = Subject.objects.get(pk=self.sub.pk)
+            wc = sub.water_control
+            self.assertEqual(wc.to_jsonable(end_date='2018-12-01'),
+                             water_control(sub).to_jsonable(end_date='2018-12-01'))
+            return wc
+
+        # new weighing
+        Weighing.objects.create(weight=30, subject=self.sub,
+                                date_time=datetime.datetime(2018, 10, 20, 12))
+        wc = _assert_fresh()
+        self.assertIn(30, [w for _, w in wc.weighings])
+        # deleted water administration
+        WaterAdministration.objects.filter(subject=self.sub).first().delete()
+        _assert_fresh()
+        # modified water restriction
+        self.wr.reference_weight = 30
+        self.wr.save()
+        self.assertEqual(_assert_fresh().reference_weight(), 30)
+        # modified weight percentages of the lab
+        self.lab.reference_weight_pct = .5
+        self.lab.save()
+        self.assertEqual(_assert_fresh().reference_weight_pct, .5)
+        # changes made without the signals of this process, as by another process
+        Weighing.objects.filter(subject=self.sub, weight=30).update(weight=31)
+        self.assertIn(31, [w for _, w in _assert_fresh().weighings])
+        self.assertIn(31, [w for _, w in cached_water_control_many([self.sub])[
+            self.sub.pk].weighings])
+
+    def test_water_ledger(self):
+        self.sub.lab = Lab.objects.get(name='mixed')
+        self.sub.save()
+
+        def _assert_ledger():
+            wc = self.sub.reinit_water_control()
+            expected = wc.to_jsonable(start_date='2018-09-28', end_date='2018-11-25')
+            self.assertEqual(water_ledger(self.sub, '2018-09-28', '2018-11-25'), expected)
+            # the second time, the days are read from the ledger table
+            self.assertEqual(water_ledger(self.sub, '2018-09-28', '2018-11-25'), expected)
+
+        _assert_ledger()
+        # only the days from the first weighing are stored
+        ledger = WaterLedger.objects.filter(subject=self.sub)
+        self.assertEqual(ledger.count(), 56)
+        # the stored days are dropped when the history changes, and computed again by the
+        # job queue
+        Weighing.objects.create(weight=30, subject=self.sub,
+                                date_time=datetime.datetime(2018, 10, 20, 12))
+        self.assertFalse(ledger.filter(date__gte=datetime.date(2018, 10, 19)).exists())
+        self.assertEqual(Job.objects.filter(name='update_water_ledger', key=str(self.sub.pk),
+                                            status=Job.PENDING).count(), 1)
+        run_jobs()
+        self.assertEqual(ledger.count(), 56)
+        self.assertEqual(ledger.get(date=datetime.date(2018, 10, 20)).weight, 30)
+        _assert_ledger()
+        WaterAdministration.objects.filter(subject=self.sub).first().delete()
+        _assert_ledger()
+        self.wr.reference_weight = 30
+        self.wr.save()
+        _assert_ledger()
+        self.wr.delete()
+        _assert_ledger()
+        # rebuilding the ledger stores all days until today
+        rebuild_water_ledger([self.sub])
+        self.assertTrue(ledger.count() > 56)
+        _assert_ledger()
+
+    def test_water_ledger_at(self):
+        # the current values are computed at the current time, not at noon
+        self.wr.end_time = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        self.wr.save()
+        wc = self.sub.reinit_water_control()
+        current = water_ledger_at(self.sub)
+        self.assertFalse(current['is_water_restricted'])
+        self.assertEqual(current['weight'], wc.weight())
+        self.assertAlmostEqual(current['expected_weight'], wc.expected_weight())
+        self.assertAlmostEqual(current['excess_water'], wc.excess_water())
+        # the current values of several subjects are computed with a constant number of
+        # queries: the versions of the water histories, then the missing histories
+        Subject.objects.create(nickname='smallboy', birth_date='2018-09-01', lab=self.lab)
+        subjects = list(Subject.objects.filter(
+            nickname__in=('bigboy', 'smallboy')).select_related('lab'))
+        invalidate_water_control([subject.pk for subject in subjects])
+        with self.assertNumQueries(7):
+            currents = current_water_ledger(subjects)
+        self.assertEqual(currents[self.sub.pk], current)
+        with self.assertNumQueries(4):
+            self.assertEqual(current_water_ledger(subjects), currents)
+        # the other days are read from the ledger
+        self.assertEqual(water_ledger_at(self.sub, '2018-10-20'),
+                         water_ledger(self.sub, '2018-10-20', '2018-10-20')[0])
+
     def test_water_control_thresholds(self):
         # test computation on reference weight lab alone
         self.sub.lab = Lab.objects.get(name='rweigh')
@@ -132,6 +272,7 @@ class NotificationTests(TestCase):
             subject=self.subject, weight=9,
             date_time=timezone.datetime(2018, 6, 9, 8, 0, 0)
         )
+        run_jobs()
         # No notification created here.
         self.assertTrue(len(Notification.objects.all()) == n)
 
@@ -140,6 +281,12 @@ class NotificationTests(TestCase):
             subject=self.subject, weight=7,
             date_time=timezone.datetime(2018, 6, 9, 12, 0, 0)
         )
+        # the check is deferred to the job queue, and coalesced with the one of the
+        # weighing of the setup
+        self.assertEqual(Notification.objects.count(), 0)
+        self.assertEqual(Job.objects.filter(name='check_weighing', key=str(self.subject.pk),
+                                            status=Job.PENDING).count(), 1)
+        self.assertEqual(run_jobs(), 1)
         notif = Notification.objects.last()
         self.assertTrue(notif.title.startswith('WARNING: test weight was 70.0%'))
 
@@ -148,6 +295,7 @@ class NotificationTests(TestCase):
             subject=self.subject, weight=8.6,
             date_time=timezone.datetime(2018, 6, 9, 16, 0, 0)
         )
+        run_jobs()
         notif = Notification.objects.last()
         self.assertTrue(notif.title.startswith('Warning'))
 
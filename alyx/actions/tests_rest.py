@@ -1,14 +1,23 @@
+from django.conf import settings
+from django.contrib.admin.models import LogEntry
 from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils.timezone import now
 from datetime import timedelta
 import json
+from unittest import mock
 
 from alyx import base
 from alyx.base import BaseTests
 from subjects.models import Subject, Project
-from misc.models import Lab
-from actions.models import Session, WaterType, WaterAdministration
+from misc.models import Job, Lab
+from actions.models import Session, WaterType, WaterAdministration, Weighing
+from actions.water_control import WaterControl, water_control_version
+from actions.water_ledger import water_ledger, water_ledger_at
+from data.models import DataRepository, Dataset, DatasetType, FileRecord
 
 
 class APIActionsTests(BaseTests):
@@ -54,6 +63,55 @@ class APIActionsTests(BaseTests):
         self.assertEqual(d['water_type'], water_type)
         self.assertEqual(d['session'], ses_uuid)
 
+    def test_bulk_create_weighings(self):
+        subject2 = Subject.objects.exclude(pk=self.subject.pk).first()
+        # stored ledger days, which must be updated by the new weighings
+        water_ledger(self.subject)
+        url = reverse('weighing-create')
+        data = [{'subject': self.subject.nickname, 'weight': 12.3},
+                {'subject': self.subject.nickname, 'weight': 12.5},
+                {'subject': subject2.nickname, 'weight': 21.1}]
+        d = self.ar(self.client.post(url, data, format='json'), 201)
+        self.assertEqual([w['weight'] for w in d], [12.3, 12.5, 21.1])
+        self.assertTrue(all(w['url'] and w['user'] == 'test' for w in d))
+        # the post-save checks are enqueued once per subject
+        self.assertEqual(sorted(Job.objects.filter(
+            name='check_weighing', status=Job.PENDING).values_list('key', flat=True)),
+            sorted([str(self.subject.pk), str(subject2.pk)]))
+        self.assertEqual(Weighing.objects.filter(
+            pk__in=[w['url'][-36:] for w in d]).count(), 3)
+        self.assertEqual(LogEntry.objects.filter(
+            object_id__in=[w['url'][-36:] for w in d]).count(), 3)
+        self.assertIn(water_ledger_at(self.subject)['weight'], (12.3, 12.5))
+        # nothing is created when a weighing is invalid
+        n = Weighing.objects.count()
+        data = [{'subject': self.subject.nickname, 'weight': 12.3},
+                {'subject': 'nobody', 'weight': 12.5}]
+        r = self.client.post(url, data, format='json')
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.data[0], {})
+        self.assertTrue('subject' in r.data[1])
+        self.assertEqual(Weighing.objects.count(), n)
+
+    def test_bulk_create_water_administrations(self):
+        url = reverse('water-administration-create')
+        ses_uuid = Session.objects.last().id
+        water_type = WaterType.objects.last().name
+        data = [{'subject': self.subject.nickname, 'water_administered': 1.1,
+                 'session': str(ses_uuid), 'water_type': water_type},
+                {'subject': self.subject.nickname, 'water_administered': 1.2}]
+        d = self.ar(self.client.post(url, data, format='json'), 201)
+        self.assertEqual(len(d), 2)
+        self.assertEqual(d[0]['water_type'], water_type)
+        self.assertEqual(d[0]['session'], ses_uuid)
+        # the default water type of the subject
+        wa = WaterAdministration(subject=self.subject)
+        wa.save()
+        self.assertEqual(d[1]['water_type'], wa.water_type.name)
+        # a single water administration is still accepted
+        d = self.ar(self.client.post(url, data[1], format='json'), 201)
+        self.assertEqual(d['water_administered'], 1.2)
+
     def test_list_water_administration_1(self):
         url = reverse('water-administration-create')
         response = self.client.get(url)
@@ -119,6 +177,43 @@ class APIActionsTests(BaseTests):
         for i in range(2, 5):
             assert d['records'][i]['weight'] > 0
 
+    def test_weighing_plot(self):
+        self.client.post(reverse('weighing-create'),
+                         {'subject': self.subject, 'weight': 12.3})
+        url = reverse('weighing-plot', kwargs={'subject_id': self.subject.id})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        etag = response['ETag']
+        # The plot has not changed.
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # The ETag is computed from the database, not from a per-process cache, and
+        # changes with the weighings modified by another process.
+        caches[getattr(settings, 'WATER_CONTROL_CACHE', 'default')].clear()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # The plot is drawn from a water control of the same version, not from the outdated
+        # one of the per-process cache, and the version is computed once per request.
+        Subject.objects.get(pk=self.subject.pk).water_control
+        Weighing.objects.filter(subject=self.subject).update(weight=12.4)
+        plot = WaterControl.plot
+        with mock.patch.object(WaterControl, 'plot', autospec=True,
+                               side_effect=plot) as mock_plot, \
+                mock.patch('actions.views.water_control_version',
+                           side_effect=water_control_version) as mock_version:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([w for _, w in mock_plot.call_args[0][0].weighings], [12.4])
+        self.assertEqual(mock_version.call_count, 1)
+        etag = response['ETag']
+        # A new weighing changes the plot.
+        self.client.post(reverse('weighing-create'),
+                         {'subject': self.subject, 'weight': 12.5})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
     def test_sessions(self):
         a_dict4json = {'String': 'this is not a JSON'}
         ses_dict = {'subject': self.subject,
@@ -185,6 +280,61 @@ class APIActionsTests(BaseTests):
         d = self.ar(self.client.get(d[0]['url']))
         self.assertEqual(d['wateradmin_session_related'][0]['water_administered'], 1)
 
+    def _create_datasets(self, session, n):
+        dtype, _ = DatasetType.objects.get_or_create(
+            name='dtype', defaults={'filename_pattern': 'a.b.*'})
+        main, _ = DataRepository.objects.get_or_create(
+            name='main', data_url='http://main/', globus_is_personal=False)
+        local, _ = DataRepository.objects.get_or_create(
+            name='local', data_url='http://local/', globus_is_personal=True)
+        datasets = []
+        for _ in range(n):
+            dataset = Dataset.objects.create(
+                session=session, name='a.b.npy', dataset_type=dtype)
+            for repo in (local, main):
+                FileRecord.objects.create(dataset=dataset, data_repository=repo, exists=True,
+                                          relative_path='%s/a.b.npy' % dataset.pk)
+            datasets.append(dataset)
+        return datasets
+
+    def test_session_detail_data_urls(self):
+        session = Session.objects.create(subject=self.subject, start_time='2019-01-01')
+        url = reverse('session-detail', args=[session.pk])
+        self._create_datasets(session, 2)
+        with CaptureQueriesContext(connection) as ctx:
+            d = self.ar(self.client.get(url))
+        n_queries = len(ctx)
+        datasets = self._create_datasets(session, 10)
+        with self.assertNumQueries(n_queries):
+            d = self.ar(self.client.get(url))
+        # the non-personal repository is preferred
+        data_urls = {ds['id']: ds['data_url'] for ds in d['data_dataset_session_related']}
+        self.assertEqual(len(data_urls), 12)
+        self.assertTrue(all(u.startswith('http://main/') for u in data_urls.values()))
+        self.assertEqual(data_urls[str(datasets[0].pk)], datasets[0].data_url())
+
+    def test_sessions_values_serializer(self):
+        Session.objects.create(subject=self.subject, lab=self.lab01, number=1,
+                               start_time='2019-01-01T10:00:00')
+        for url in (reverse('session-list'),
+                    reverse('session-list') + '?lab=superlab&fields=subject,url',
+                    reverse('session-list') + '?cursor=&limit=10'):
+            fast = self.client.get(url).content
+            with self.settings(FAST_LIST_SERIALIZERS=False):
+                slow = self.client.get(url).content
+            self.assertEqual(fast, slow)
+
+    def test_sessions_cursor_pagination(self):
+        n = Session.objects.count()
+        url = reverse('session-list') + '?cursor=&limit=%d' % max(1, n // 3)
+        ids = []
+        while url:
+            r = self.client.get(url)
+            ids.extend(s['url'][-36:] for s in self.ar(r))
+            url = r.data['next']
+        self.assertEqual(len(ids), n)
+        self.assertEqual(len(set(ids)), n)
+
     def test_list_retrieve_water_restrictions(self):
         url = reverse('water-restriction-list')
         response = self.client.get(url)
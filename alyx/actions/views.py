@@ -2,11 +2,15 @@ from datetime import timedelta, date
 import itertools
 from operator import itemgetter
 
+from django.conf import settings
+from django.core.cache import caches
 from django.db.models import Count, Q, F, ExpressionWrapper, FloatField
 from django.db.models.deletion import Collector
 from django.http import HttpResponse
 from django.urls import reverse
 from django.utils.safestring import mark_safe
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views.generic.list import ListView
 
 import django_filters
@@ -15,13 +19,16 @@ from rest_framework import generics, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from alyx.base import KeysetPagination, StreamingListMixin, ValuesListMixin
 from subjects.models import Subject
-from .water_control import water_control, date as get_date
+from .water_control import cached_water_control, water_control_version, date as get_date
+from .water_ledger import water_ledger
 from .models import (
     BaseAction, Session, WaterAdministration, WaterRestriction,
     Weighing, WaterType, LabLocation)
 from .serializers import (LabLocationSerializer,
                           SessionListSerializer,
+                          SessionListValuesSerializer,
                           SessionDetailSerializer,
                           WaterAdministrationDetailSerializer,
                           WeighingDetailSerializer,
@@ -109,7 +116,7 @@ class WaterHistoryListView(ListView):
 
     def get_queryset(self):
         subject = Subject.objects.get(pk=self.kwargs['subject_id'])
-        return water_control(subject).to_jsonable()[::-1]
+        return water_ledger(subject)[::-1]
 
 
 def last_monday(reqdate=None):
@@ -165,13 +172,42 @@ class TrainingListView(ListView):
         yield from training_days(reqdate=self.monday)
 
 
+def _weighing_plot_version(request, subject_id):
+    """The version of the water history of the subject, computed once per request."""
+    if not hasattr(request, '_water_control_version'):
+        request._water_control_version = water_control_version(subject_id)
+    return request._water_control_version
+
+
+def _weighing_plot_etag(request, subject_id=None):
+    if not request.user.is_authenticated or subject_id in (None, 'None'):
+        return None
+    return '%s-%s' % (subject_id, _weighing_plot_version(request, subject_id))
+
+
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_weighing_plot_etag)
 def weighing_plot(request, subject_id=None):
+    """Render the weighing plot of a subject as a PNG image.
+
+    The images are cached for each version of the water history of the subject, and the
+    version is sent as an ETag so that browsers only download a plot when it has changed.
+    The plot is drawn from a WaterControl instance of the same version.
+
+    """
     if not request.user.is_authenticated:
         return HttpResponse('')
     if subject_id in (None, 'None'):
         return HttpResponse('')
-    wc = water_control(Subject.objects.get(pk=subject_id))
-    return wc.plot()
+    cache = caches[getattr(settings, 'WEIGHING_PLOT_CACHE', 'default')]
+    version = _weighing_plot_version(request, subject_id)
+    key = 'weighing_plot:%s-%s' % (subject_id, version)
+    png = cache.get(key)
+    if png is None:
+        subject = Subject.objects.select_related('lab').get(pk=subject_id)
+        png = cached_water_control(subject, version=version).plot().content
+        cache.set(key, png)
+    return HttpResponse(png, content_type='image/png')
 
 
 class SessionFilter(FilterSet):
@@ -250,14 +286,21 @@ class WaterAdministrationFilter(FilterSet):
         exclude = ['json']
 
 
-class SessionAPIList(generics.ListCreateAPIView):
+class SessionAPIList(ValuesListMixin, StreamingListMixin, generics.ListCreateAPIView):
     """
     List and create sessions - view in summary form
     """
     queryset = Session.objects.all()
-    queryset = SessionListSerializer.setup_eager_loading(queryset)
+    values_serializer_class = SessionListValuesSerializer
     permission_classes = (permissions.IsAuthenticated,)
     filter_class = SessionFilter
+    pagination_class = KeysetPagination
+    cursor_ordering = ('start_time', 'id')
+
+    def get_queryset(self):
+        # Only load the relations of the requested fields.
+        return SessionListSerializer.setup_eager_loading(
+            Session.objects.all(), SessionListSerializer.requested_fields(self.request))
 
     def get_serializer_class(self):
         if not self.request:
@@ -273,14 +316,25 @@ class SessionAPIDetail(generics.RetrieveUpdateDestroyAPIView):
     Detail of one session
     """
     queryset = Session.objects.all().order_by('-start_time')
-    queryset = SessionDetailSerializer.setup_eager_loading(queryset)
     serializer_class = SessionDetailSerializer
     permission_classes = (permissions.IsAuthenticated,)
 
+    def get_queryset(self):
+        return SessionDetailSerializer.setup_eager_loading(
+            Session.objects.all(), SessionDetailSerializer.requested_fields(self.request))
+
+
+class BulkCreateMixin(object):
+    """Create all the objects of a JSON list in a single request."""
+    def get_serializer(self, *args, **kwargs):
+        if isinstance(kwargs.get('data', None), list):
+            kwargs['many'] = True
+        return super(BulkCreateMixin, self).get_serializer(*args, **kwargs)
+
 
-class WeighingAPIListCreate(generics.ListCreateAPIView):
+class WeighingAPIListCreate(BulkCreateMixin, generics.ListCreateAPIView):
     """
-    Lists or creates a new weighing.
+    Lists or creates a new weighing, or several weighings given as a JSON list.
     """
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = WeighingDetailSerializer
@@ -305,9 +359,10 @@ class WaterTypeList(generics.ListCreateAPIView):
     lookup_field = 'name'
 
 
-class WaterAdministrationAPIListCreate(generics.ListCreateAPIView):
+class WaterAdministrationAPIListCreate(BulkCreateMixin, generics.ListCreateAPIView):
     """
-    Lists or creates a new water administration.
+    Lists or creates a new water administration, or several water administrations given as
+    a JSON list.
     """
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = WaterAdministrationDetailSerializer
@@ -344,7 +399,7 @@ class WaterRequirement(APIView):
         start_date = request.query_params.get('start_date', None)
         end_date = request.query_params.get('end_date', None)
         subject = Subject.objects.get(nickname=nickname)
-        records = subject.water_control.to_jsonable(start_date=start_date, end_date=end_date)
+        records = water_ledger(subject, start_date=start_date, end_date=end_date)
         data = {'subject': nickname, 'implant_weight': subject.implant_weight, 'records': records}
         return Response(data)
 
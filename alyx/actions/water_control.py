@@ -3,11 +3,14 @@ import csv
 from datetime import datetime, date, timedelta
 from dateutil.rrule import HOURLY
 import functools
+import hashlib
 import io
 import logging
 from operator import attrgetter, itemgetter
 import os.path as op
 
+from django.conf import settings
+from django.core.cache import caches
 from django.urls import reverse
 from django.utils.html import format_html
 from django.http import HttpResponse
@@ -75,6 +78,24 @@ def expected_weighing_mean_std(sex, age_w):
         return d[age_w]
 
 
+@functools.lru_cache(maxsize=None)
+def _get_table_arrays(sex):
+    """Return the reference table as (first age, means, stds), the arrays being indexed by
+    the age in weeks minus the first age."""
+    d = _get_table(sex)
+    ages = range(min(d), max(d) + 1)
+    means = np.array([d[age][0] for age in ages], dtype=np.float64)
+    stds = np.array([d[age][1] for age in ages], dtype=np.float64)
+    return min(d), means, stds
+
+
+def expected_weighing_mean_std_array(sex, age_w):
+    """Vectorized version of expected_weighing_mean_std() for an array of ages in weeks."""
+    age_min, means, stds = _get_table_arrays(sex)
+    i = np.clip(np.asarray(age_w) - age_min, 0, len(means) - 1)
+    return means[i], stds[i]
+
+
 def to_weeks(birth_date, dt):
     if not birth_date:
         logger.warning("No birth date specified!")
@@ -86,6 +107,19 @@ def to_weeks(birth_date, dt):
     return (dt - birth_date).days // 7
 
 
+def to_weeks_array(birth_date, dts):
+    """Vectorized version of to_weeks() for a datetime64 array."""
+    return ((dts - np.datetime64(birth_date, 'us')) // np.timedelta64(1, 'D')) // 7
+
+
+def _datetime64(dates):
+    return np.array(dates, dtype='datetime64[us]')
+
+
+def _day64(date):
+    return np.datetime64(date.date(), 'D')
+
+
 def restrict_dates(dates, start, end, *arrs):
     assert isinstance(start, datetime)
     assert isinstance(end, datetime)
@@ -101,9 +135,25 @@ def find_color(w, e, thresholds):
     return PALETTE['green']
 
 
+def weight_status(percentage, threshold):
+    """Return 0 if the weight percentage is fine (or unknown), 1 if it is less than 2%
+    above the threshold, 2 if it is below the threshold."""
+    thresh_remind = threshold + 0.02
+    if percentage == 0:
+        return 0
+    elif (percentage / 100) < threshold:
+        return 2
+    elif (percentage / 100) < thresh_remind:
+        return 1
+    else:
+        return 0
+
+
 def return_figure(f):
+    import matplotlib.pyplot as plt
     buf = io.BytesIO()
     f.savefig(buf, format='png')
+    plt.close(f)
     buf.seek(0)
     return HttpResponse(buf.read(), content_type="image/png")
 
@@ -138,6 +188,8 @@ class WaterControl(object):
         self.zscore_weight_pct = zscore_weight_pct
         self.thresholds = []
         self.timezone = timezone
+        # Sorted columnar arrays of the history, built lazily by _columnar().
+        self._arrays = None
 
     def today(self):
         """The date at the timezone if the current subject."""
@@ -178,6 +230,7 @@ class WaterControl(object):
         assert end_date is None or isinstance(end_date, datetime)
         self._check_water_restrictions()
         self.water_restrictions.append((start_date, end_date, reference_weight))
+        self._arrays = None
 
     def end_current_water_restriction(self):
         """If the mouse is under water restriction, end it."""
@@ -189,6 +242,7 @@ class WaterControl(object):
             logger.warning("The mouse %s is not currently under water restriction.", self.nickname)
             return
         self.water_restrictions[-1] = (s, self.today(), wr)
+        self._arrays = None
 
     def current_water_restriction(self):
         """Return the date of the current water restriction if there is one, or None."""
@@ -209,11 +263,10 @@ class WaterControl(object):
         """If the subject was under water restriction at the specified date, return
         the start of that water restriction."""
         date = date or self.today()
-        water_restrictions_before = [
-            (s, e, rw) for (s, e, rw) in self.water_restrictions if s.date() <= date.date()]
-        if not water_restrictions_before:
+        before = np.flatnonzero(self._columnar()['wr_start_days'] <= _day64(date))
+        if not len(before):
             return
-        s, e, rw = water_restrictions_before[-1]
+        s, e, rw = self.water_restrictions[before[-1]]
         # Return None if the mouse was not under water restriction at the specified date.
         if e is not None and date > e:
             return None
@@ -224,6 +277,7 @@ class WaterControl(object):
     def add_weighing(self, date, weighing):
         """Add a weighing."""
         self.weighings.append((tzone_convert(date, self.timezone), weighing))
+        self._arrays = None
 
     def set_reference_weight(self, date, weight):
         """Set a non-default reference weight."""
@@ -231,6 +285,35 @@ class WaterControl(object):
 
     def add_water_administration(self, date, volume, session=None):
         self.water_administrations.append((tzone_convert(date, self.timezone), volume, session))
+        self._arrays = None
+
+    def _columnar(self):
+        """Return the history as a dictionary of arrays sorted by date.
+
+        The weighings and water administrations are sorted in place, and the arrays are
+        rebuilt after every change so that date lookups are binary searches.
+
+        """
+        if self._arrays is not None:
+            return self._arrays
+        self.weighings[:] = sorted(self.weighings, key=itemgetter(0))
+        self.water_administrations[:] = sorted(self.water_administrations, key=itemgetter(0))
+        was = self.water_administrations
+        wrs = self.water_restrictions
+        wa_times = _datetime64([d for d, _, _ in was])
+        self._arrays = {
+            'weighing_days': _datetime64([d for d, _ in self.weighings]).astype('datetime64[D]'),
+            'weights': np.array([w for _, w in self.weighings], dtype=np.float64),
+            'wa_times': wa_times,
+            'wa_days': wa_times.astype('datetime64[D]'),
+            'wa_volumes': np.array([w or 0. for _, w, _ in was], dtype=np.float64),
+            'wa_valid': np.array([w is not None for _, w, _ in was], dtype=bool),
+            'wa_session': np.array([bool(ses) for _, _, ses in was], dtype=bool),
+            'wr_start_days': _datetime64([s for s, _, _ in wrs]).astype('datetime64[D]'),
+            'wr_ends': _datetime64([e for _, e, _ in wrs]),
+            'wr_has_end': np.array([e is not None for _, e, _ in wrs], dtype=bool),
+        }
+        return self._arrays
 
     def add_threshold(self, percentage=None, bgcolor=None, fgcolor=None, line_style=None):
         """Add a threshold for the plot."""
@@ -247,6 +330,10 @@ class WaterControl(object):
         wr = self.water_restriction_at(date)
         if not wr:
             return
+        return self._restriction_reference_weighing(wr)
+
+    def _restriction_reference_weighing(self, wr):
+        """Return the reference weighing of the water restriction started at `wr`."""
         # get the reference weight of the valid water restriction at the time
         ref_weight = [
             (d, w) for d, e, w in self.water_restrictions
@@ -267,18 +354,18 @@ class WaterControl(object):
         """Return the last known weight of the subject before the specified date."""
         date = date or self.today()
         assert isinstance(date, datetime)
-        # Sort the weighings.
-        self.weighings[:] = sorted(self.weighings, key=itemgetter(0))
-        weighings_before = [(d, w) for (d, w) in self.weighings if d.date() <= date.date()]
-        if weighings_before:
-            return weighings_before[-1]
+        days = self._columnar()['weighing_days']
+        i = np.searchsorted(days, _day64(date), side='right')
+        if i > 0:
+            return self.weighings[i - 1]
 
     def weighing_at(self, date=None):
         """Return the weight of the subject at the specified date."""
         date = date or self.today()
         assert isinstance(date, datetime)
-        weighings_at = [(d, w) for (d, w) in self.weighings if d.date() == date.date()]
-        return weighings_at[0][1] if weighings_at else None
+        days = self._columnar()['weighing_days']
+        i = np.searchsorted(days, _day64(date), side='left')
+        return self.weighings[i][1] if i < len(days) and days[i] == _day64(date) else None
 
     def current_weighing(self):
         """Return the last known weight."""
@@ -363,11 +450,10 @@ class WaterControl(object):
     def last_water_administration_at(self, date=None):
         """Return the last known water administration of the subject before the specified date."""
         date = date or self.today()
-        # Sort the water administrations.
-        self.water_administrations[:] = sorted(self.water_administrations, key=itemgetter(0))
-        wa_before = [(d, w, h) for (d, w, h) in self.water_administrations if d <= date]
-        if wa_before:
-            return wa_before[-1]
+        times = self._columnar()['wa_times']
+        i = np.searchsorted(times, np.datetime64(date, 'us'), side='right')
+        if i > 0:
+            return self.water_administrations[i - 1]
 
     def expected_water(self, date=None):
         """Return the expected water for the specified date."""
@@ -383,9 +469,12 @@ class WaterControl(object):
         """Return the amount of water given at a specified date."""
         date = date or self.today()
         assert isinstance(date, datetime)
+        days = self._columnar()['wa_days']
+        i0 = np.searchsorted(days, _day64(date), side='left')
+        i1 = np.searchsorted(days, _day64(date), side='right')
         totw = 0
-        for (d, w, ses) in self.water_administrations:
-            if d.date() != date.date() or w is None:
+        for (d, w, ses) in self.water_administrations[i0:i1]:
+            if w is None:
                 continue
             if has_session is None:
                 totw += w
@@ -431,31 +520,150 @@ class WaterControl(object):
 
     def weight_status(self, date=None):
         threshold = max(self.zscore_weight_pct, self.reference_weight_pct)
-        thresh_remind = threshold + 0.02
-        w = self.percentage_weight(date=date)
-        if w == 0:
-            return 0
-        elif (w / 100) < threshold:
-            return 2
-        elif (w / 100) < thresh_remind:
-            return 1
+        return weight_status(self.percentage_weight(date=date), threshold)
+
+    def _weight_series(self, dates):
+        """Return the index of the water restriction (-1 if none), the reference weight,
+        the zscore weight and the expected weight at each date of a datetime64 array.
+
+        This gives the same values as the water_restriction_at(), reference_weight(),
+        zscore_weight() and expected_weight() methods called for each date.
+
+        """
+        arr = self._columnar()
+        n = len(dates)
+        days = dates.astype('datetime64[D]')
+        iw = self.implant_weight
+
+        # Water restriction at each date: the last one started on or before the day,
+        # unless it ended before the date.
+        nwr = len(self.water_restrictions)
+        started = arr['wr_start_days'][np.newaxis, :] <= days[:, np.newaxis]
+        iwr = nwr - 1 - np.argmax(started[:, ::-1], axis=1) if nwr else np.zeros(n, dtype=int)
+        iwr[~started.any(axis=1)] = -1
+        ended = np.append(arr['wr_has_end'], False)[iwr]
+        ended[ended] = dates[ended] > arr['wr_ends'][iwr[ended]]
+        iwr[ended] = -1
+        is_restricted = iwr >= 0
+
+        # Reference weighing at each date.
+        has_ref = np.zeros(n, dtype=bool)
+        ref_dates = dates.copy()
+        ref_weight = np.zeros(n, dtype=np.float64)
+        refs = [(iwr == i, self._restriction_reference_weighing(self.water_restrictions[i][0]))
+                for i in np.unique(iwr[is_restricted])]
+        if self.reference_weighing:
+            refs.append((dates >= np.datetime64(self.reference_weighing[0], 'us'),
+                         self.reference_weighing))
+        for mask, rw in refs:
+            has_ref[mask] = bool(rw)
+            if rw:
+                ref_dates[mask] = np.datetime64(rw[0], 'us')
+                ref_weight[mask] = rw[1]
+
+        # zscore weight.
+        zscore_weight = np.zeros(n, dtype=np.float64)
+        if not self.birth_date:
+            if has_ref.any():
+                logger.warning("The birth date of %s has not been specified.", self.nickname)
+        elif has_ref.any():
+            mrw_ref, srw_ref = expected_weighing_mean_std_array(
+                self.sex, to_weeks_array(self.birth_date, ref_dates[has_ref]))
+            zscore = (ref_weight[has_ref] - iw - mrw_ref) / srw_ref
+            mrw_date, srw_date = expected_weighing_mean_std_array(
+                self.sex, to_weeks_array(self.birth_date, dates[has_ref]))
+            zscore_weight[has_ref] = (srw_date * zscore) + mrw_date + iw
+
+        # Expected weight.
+        pct_sum = (self.reference_weight_pct + self.zscore_weight_pct)
+        if pct_sum == 0:
+            expected_weight = np.zeros(n, dtype=np.float64)
         else:
-            return 0
+            pz = self.zscore_weight_pct / pct_sum
+            pr = self.reference_weight_pct / pct_sum
+            expected_weight = pz * zscore_weight + pr * ref_weight
+        return iwr, ref_weight, zscore_weight, expected_weight
+
+    def columns_between(self, start_date, end_date):
+        """Return a dictionary {column: list} with the values of all columns for every day
+        between the two dates.
+
+        This gives the same values as calling the column methods for each day of
+        date_range(start_date, end_date), but computes each column for the whole
+        range at once.
+
+        """
+        assert isinstance(start_date, datetime)
+        assert isinstance(end_date, datetime)
+        n = (end_date.date() - start_date.date()).days + 1
+        if n <= 0:
+            return {col: [] for col in self._columns}
+        arr = self._columnar()
+        dates = np.datetime64(start_date, 'us') + np.arange(n) * np.timedelta64(1, 'D')
+        days = dates.astype('datetime64[D]')
+        iw = self.implant_weight
+
+        # Last weighing before each day, and weighing on each day.
+        weighing_days = arr['weighing_days']
+        weights = np.append(arr['weights'], 0.)
+        iwb = np.searchsorted(weighing_days, days, side='right') - 1
+        has_weight = iwb >= 0
+        weight = weights[iwb]
+        iwa = np.searchsorted(weighing_days, days, side='left')
+        weighed = np.append(weighing_days, np.datetime64('NaT'))[iwa] == days
+
+        iwr, ref_weight, zscore_weight, expected_weight = self._weight_series(dates)
+        is_restricted = iwr >= 0
+        pct_sum = (self.reference_weight_pct + self.zscore_weight_pct)
+        min_weight = (zscore_weight * self.zscore_weight_pct +
+                      ref_weight * self.reference_weight_pct)
+        percentage_weight = np.zeros(n, dtype=np.float64)
+        pos = (expected_weight - iw) > 0
+        percentage_weight[pos] = 100 * (weight[pos] - iw) / (expected_weight[pos] - iw)
+
+        # Water.
+        expected_water = np.where(
+            weight < 0.8 * expected_weight, 0.05 * (weight - iw), 0.04 * (weight - iw))
+        offsets = (arr['wa_days'] - days[0]).astype(np.int64)
+        valid = arr['wa_valid'] & (offsets >= 0) & (offsets < n)
+
+        def _given_water(mask):
+            ind = offsets[mask]
+            given = np.bincount(ind, weights=arr['wa_volumes'][mask], minlength=n)
+            return given, np.bincount(ind, minlength=n) > 0
+
+        reward = _given_water(valid & arr['wa_session'])
+        supplement = _given_water(valid & ~arr['wa_session'])
+        total = _given_water(valid)
+        excess_water = -(expected_water - total[0])
+
+        def _or_zero(values, present):
+            # The scalar methods return an integer 0 when there is no data.
+            return [v if p else 0 for v, p in zip(values.tolist(), present.tolist())]
+
+        return {
+            'date': days.tolist(),
+            'weight': _or_zero(weight, has_weight),
+            'weighing_at': [w if p else None for w, p in zip(
+                np.append(arr['weights'], 0.)[iwa].tolist(), weighed.tolist())],
+            'reference_weight': ref_weight.tolist(),
+            'expected_weight': _or_zero(expected_weight, np.full(n, pct_sum != 0)),
+            'min_weight': min_weight.tolist(),
+            'percentage_weight': percentage_weight.tolist(),
+            'given_water_reward': _or_zero(*reward),
+            'given_water_supplement': _or_zero(*supplement),
+            'given_water_total': _or_zero(*total),
+            'expected_water': expected_water.tolist(),
+            'excess_water': excess_water.tolist(),
+            'is_water_restricted': is_restricted.tolist(),
+        }
 
     def to_jsonable(self, start_date=None, end_date=None):
         start_date = to_date(start_date) if start_date else self.first_date()
         end_date = to_date(end_date) if end_date else self.today()
-        out = []
-        for d in date_range(start_date, end_date):
-            obj = {}
-            for col in self._columns:
-                if col == 'date':
-                    obj['date'] = d.date()
-                else:
-                    obj[col] = getattr(self, col)(date=d)
-            out.append(obj)
-        # return json.dumps(out, cls=DjangoJSONEncoder)
-        return out
+        columns = self.columns_between(start_date, end_date)
+        return [{col: columns[col][i] for col in self._columns}
+                for i in range(len(columns['date']))]
 
     def plot(self, start=None, end=None):
         import matplotlib
@@ -478,15 +686,8 @@ class WaterControl(object):
             weights = np.array(weights, dtype=np.float64)
             start = start or weighing_dates.min()
             end = end or weighing_dates.max()
-            expected_weights = np.array(
-                [self.expected_weight(date) for date in weighing_dates],
-                dtype=np.float64)
-            zscore_weights = np.array(
-                [self.zscore_weight(date) for date in weighing_dates],
-                dtype=np.float64)
-            reference_weights = np.array(
-                [self.reference_weight(date) for date in weighing_dates],
-                dtype=np.float64)
+            _, reference_weights, zscore_weights, expected_weights = self._weight_series(
+                _datetime64(weighing_dates))
 
         # spans is a list of pairs (date, color) where there are changes of background colors.
         for start_wr, end_wr, ref_weight in self.water_restrictions:
@@ -532,8 +733,8 @@ class WaterControl(object):
         return return_figure(f)
 
 
-def water_control(subject):
-    assert subject is not None
+def _make_water_control(subject, water_restrictions, water_administrations, weighings):
+    """Create the WaterControl instance of a subject from its already fetched history."""
     lab = subject.lab
 
     # By default, if there is only one lab, use it for the subject.
@@ -559,7 +760,7 @@ def water_control(subject):
     wc.add_threshold(percentage=rw_pct + zw_pct, bgcolor=PALETTE['orange'], fgcolor='#FFC28E')
     wc.add_threshold(percentage=.7, bgcolor=PALETTE['red'], fgcolor='#F08699', line_style='--')
     # Water restrictions.
-    wrs = sorted(list(subject.actions_waterrestrictions.all()), key=attrgetter('start_time'))
+    wrs = sorted(list(water_restrictions), key=attrgetter('start_time'))
     # Reference weight.
     last_wr = wrs[-1] if wrs else None
     if last_wr and last_wr.reference_weight:
@@ -568,13 +769,194 @@ def water_control(subject):
         wc.add_water_restriction(wr.start_time, wr.end_time, wr.reference_weight)
 
     # Water administrations.
-    was = sorted(list(subject.water_administrations.all()), key=attrgetter('date_time'))
+    was = sorted(list(water_administrations), key=attrgetter('date_time'))
     for wa in was:
         wc.add_water_administration(wa.date_time, wa.water_administered, session=wa.session_id)
 
     # Weighings
-    ws = sorted(list(subject.weighings.all()), key=attrgetter('date_time'))
+    ws = sorted(list(weighings), key=attrgetter('date_time'))
     for w in ws:
         wc.add_weighing(w.date_time, w.weight)
 
     return wc
+
+
+def water_control(subject):
+    assert subject is not None
+    return _make_water_control(
+        subject,
+        subject.actions_waterrestrictions.all(),
+        subject.water_administrations.all(),
+        subject.weighings.all(),
+    )
+
+
+def water_control_many(subjects):
+    """Return a dictionary {subject_id: WaterControl} for a queryset or a list of subjects.
+
+    The water restrictions, water administrations and weighings of all subjects are
+    fetched with three queries in total, instead of three queries per subject.
+
+    """
+    from actions.models import WaterAdministration, WaterRestriction, Weighing
+
+    if hasattr(subjects, 'select_related'):
+        subjects = subjects.select_related('lab')
+    subjects = list(subjects)
+    ids = [subject.id for subject in subjects]
+
+    def _group(model, *fields):
+        out = {}
+        for obj in model.objects.filter(subject_id__in=ids).only('subject', *fields):
+            out.setdefault(obj.subject_id, []).append(obj)
+        return out
+
+    wrs = _group(WaterRestriction, 'start_time', 'end_time', 'reference_weight')
+    was = _group(WaterAdministration, 'date_time', 'water_administered', 'session')
+    ws = _group(Weighing, 'date_time', 'weight')
+    return {
+        subject.id: _make_water_control(
+            subject, wrs.get(subject.id, []), was.get(subject.id, []), ws.get(subject.id, []))
+        for subject in subjects}
+
+
+# Cross-request cache
+# ------------------------------------------------------------------------------------------------
+
+def _water_control_cache():
+    """The cache used for the WaterControl instances, configured by the WATER_CONTROL_CACHE
+    setting (the default cache otherwise)."""
+    return caches[getattr(settings, 'WATER_CONTROL_CACHE', 'default')]
+
+
+def _cache_key(subject_id):
+    return 'water_control:%s' % subject_id
+
+
+def _count(name, n=1):
+    if not n:
+        return
+    cache = _water_control_cache()
+    key = 'water_control_stats:%s' % name
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key, n)
+    except ValueError:
+        # The counter has been evicted in the meantime.
+        cache.set(key, n, timeout=None)
+
+
+def water_control_cache_stats():
+    """Return the number of hits and misses of the WaterControl cache."""
+    cache = _water_control_cache()
+    stats = cache.get_many(['water_control_stats:hits', 'water_control_stats:misses'])
+    return {
+        'hits': stats.get('water_control_stats:hits', 0),
+        'misses': stats.get('water_control_stats:misses', 0),
+    }
+
+
+def water_control_versions(subject_ids):
+    """Return a dictionary {subject_id: version stamp} of the water history of some subjects:
+    a hash of the fields of the subject, its lab, weighings, water administrations and water
+    restrictions that the WaterControl instance depends on. It is computed from the database
+    with four queries, so that it is the same in all processes and changes as soon as the
+    history is modified, with or without the signals of the process."""
+    from subjects.models import Subject
+    from actions.models import WaterAdministration, WaterRestriction, Weighing
+    subject_ids = list(subject_ids)
+    querysets = (
+        Subject.objects.filter(pk__in=subject_ids).values_list(
+            'pk', 'nickname', 'birth_date', 'sex', 'implant_weight', 'lab__timezone',
+            'lab__reference_weight_pct', 'lab__zscore_weight_pct'),
+        Weighing.objects.filter(subject_id__in=subject_ids).order_by(
+            'subject_id', 'pk').values_list('subject_id', 'pk', 'date_time', 'weight'),
+        WaterAdministration.objects.filter(subject_id__in=subject_ids).order_by(
+            'subject_id', 'pk').values_list(
+            'subject_id', 'pk', 'date_time', 'water_administered', 'session_id'),
+        WaterRestriction.objects.filter(subject_id__in=subject_ids).order_by(
+            'subject_id', 'pk').values_list(
+            'subject_id', 'pk', 'start_time', 'end_time', 'reference_weight'),
+    )
+    # the ids are given as UUIDs or as strings
+    md5s = {str(subject_id): hashlib.md5() for subject_id in subject_ids}
+    for i, queryset in enumerate(querysets):
+        rows = {}
+        for row in queryset:
+            rows.setdefault(str(row[0]), []).append(row[1:])
+        for subject_id, md5 in md5s.items():
+            md5.update(repr((i, rows.get(subject_id, []))).encode())
+    return {subject_id: md5s[str(subject_id)].hexdigest() for subject_id in subject_ids}
+
+
+def water_control_version(subject_id):
+    """Return the version stamp of the water history of a subject, see
+    water_control_versions()."""
+    return water_control_versions([subject_id])[subject_id]
+
+
+def cache_water_control(wc, version=None):
+    """Store a WaterControl instance in the cache, with the version stamp of the water
+    history it was built from. The stamp should be computed before the instance is built,
+    it defaults to the current one."""
+    if version is None:
+        version = water_control_version(wc.subject_id)
+    _water_control_cache().set(_cache_key(wc.subject_id), (version, wc))
+
+
+def invalidate_water_control(subject_ids):
+    """Remove the WaterControl instances of some subjects from the cache."""
+    _water_control_cache().delete_many([_cache_key(subject_id) for subject_id in subject_ids])
+
+
+def _cached(entry, version):
+    """The WaterControl instance of a cache entry if it has the expected version."""
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+
+def cached_water_control(subject, version=None):
+    """Return the WaterControl instance of a subject from the cache, building it from the
+    database on a miss.
+
+    The cached instances are checked against the current version stamp of the water
+    history (computed if not given), so that an instance outdated by another process,
+    whose signals did not reach the cache of this process, is built again.
+
+    """
+    assert subject is not None
+    if version is None:
+        version = water_control_version(subject.id)
+    wc = _cached(_water_control_cache().get(_cache_key(subject.id)), version)
+    if wc is not None:
+        _count('hits')
+        return wc
+    _count('misses')
+    wc = water_control(subject)
+    cache_water_control(wc, version)
+    return wc
+
+
+def cached_water_control_many(subjects):
+    """Same as water_control_many(), but only the subjects missing from the cache, or whose
+    cached instance is outdated, are fetched from the database."""
+    subjects = list(subjects)
+    cache = _water_control_cache()
+    versions = water_control_versions([subject.id for subject in subjects])
+    cached = cache.get_many([_cache_key(subject.id) for subject in subjects])
+    out = {}
+    missing = []
+    for subject in subjects:
+        wc = _cached(cached.get(_cache_key(subject.id)), versions[subject.id])
+        if wc is None:
+            missing.append(subject)
+        else:
+            out[subject.id] = wc
+    _count('hits', len(out))
+    _count('misses', len(missing))
+    if missing:
+        wcs = water_control_many(missing)
+        cache.set_many({_cache_key(subject_id): (versions[subject_id], wc)
+                        for subject_id, wc in wcs.items()})
+        out.update(wcs)
+    return out
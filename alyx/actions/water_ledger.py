@@ -0,0 +1,262 @@
+"""Daily water ledger of the subjects.
+
+The ledger stores, for every subject and every day, the values of the WaterControl columns
+evaluated at noon on that day (the same convention as `to_date()` for dates given as
+strings). When a weighing, water administration or water restriction is saved or deleted,
+the days from its date are dropped, and computed again by a job of the queue (see
+misc.jobs) so that the request does not replay the history of the subject. Days that are
+not stored yet (for example the days after the last request) are computed and stored the
+first time they are requested.
+The current values, at the current time, are given by `current_water_ledger()` for a list
+of subjects.
+
+"""
+
+from datetime import date, datetime, timedelta
+import logging
+
+from django.db import transaction
+from django.db.models import Max, Min
+
+from actions.models import WaterLedger, WaterRestriction
+from actions.water_control import (
+    WaterControl, water_control, water_control_many, cached_water_control_many,
+    date_to_datetime, to_date, tzone_convert, today)
+from misc.jobs import enqueue
+
+
+logger = logging.getLogger(__name__)
+
+
+LEDGER_COLUMNS = WaterControl._columns
+
+
+def _to_day(d):
+    if d is None:
+        return None
+    if isinstance(d, str):
+        return to_date(d).date()
+    if isinstance(d, datetime):
+        return d.date()
+    return d
+
+
+def _today(subject):
+    return tzone_convert(today(), subject.timezone()).date()
+
+
+def _date_field(model):
+    return 'start_time' if model is WaterRestriction else 'date_time'
+
+
+def _start_day(model, d):
+    """First day of the ledger affected by a record of a given model at a given date.
+
+    The water restrictions change the reference weight of other restrictions, so the whole
+    ledger is recomputed. The other records are shifted by one day to account for the
+    conversion to the timezone of the subject.
+
+    """
+    if model is WaterRestriction or d is None:
+        return None
+    return d.date() - timedelta(days=1)
+
+
+def _merge(starts, subject_id, start):
+    if subject_id not in starts:
+        starts[subject_id] = start
+    elif starts[subject_id] is None or start is None:
+        starts[subject_id] = None
+    else:
+        starts[subject_id] = min(start, starts[subject_id])
+
+
+def ledger_origin(model, instance):
+    """Return the (subject_id, start day) of a record as currently stored in the database."""
+    if instance._state.adding or instance.pk is None:
+        return
+    field = _date_field(model)
+    old = model.objects.filter(pk=instance.pk).values_list('subject_id', field).first()
+    if old:
+        return old[0], _start_day(model, old[1])
+
+
+def _ledger_starts(model, instance):
+    starts = {}
+    _merge(starts, instance.subject_id,
+           _start_day(model, getattr(instance, _date_field(model))))
+    origin = getattr(instance, '_ledger_origin', None)
+    if origin:
+        _merge(starts, *origin)
+    return starts
+
+
+def _drop_water_ledger(subject_id, start):
+    """Drop the days of the ledger of a subject from a given day (all days if None), and
+    enqueue the job computing them again until the last stored day."""
+    rows = WaterLedger.objects.filter(subject_id=subject_id)
+    if start is not None:
+        rows = rows.filter(date__gte=start)
+    last = rows.aggregate(last=Max('date'))['last']
+    if last is None:
+        # Nothing stored from that day: the days will be computed when requested.
+        return
+    rows.delete()
+    enqueue('update_water_ledger', key=str(subject_id),
+            subject=str(subject_id), end_date=last.isoformat())
+
+
+def update_water_ledger_for(model, instance, deleted=False):
+    """Drop the outdated days of the ledger after a weighing, water administration or water
+    restriction has been saved or deleted. They are computed again by a job of the queue,
+    or when requested."""
+    for subject_id, start in _ledger_starts(model, instance).items():
+        _drop_water_ledger(subject_id, start)
+
+
+def update_water_ledger_for_many(model, instances):
+    """Same as update_water_ledger_for() for some new records, once per subject."""
+    starts = {}
+    for instance in instances:
+        _merge(starts, instance.subject_id,
+               _start_day(model, getattr(instance, _date_field(model))))
+    for subject_id, start in starts.items():
+        _drop_water_ledger(subject_id, start)
+
+
+def invalidate_water_ledger(subject_ids, start_date=None):
+    """Delete the ledger days of some subjects from a given date (all days by default)."""
+    rows = WaterLedger.objects.filter(subject_id__in=subject_ids)
+    if start_date is not None:
+        rows = rows.filter(date__gte=start_date)
+    rows.delete()
+
+
+def _ledger_rows(subject, wc, start_date, end_date):
+    """Compute the ledger rows between two dates, excluding the days before the history."""
+    first_date = wc.first_date()
+    if first_date is None:
+        return []
+    start_date = max(start_date, first_date.date())
+    columns = wc.columns_between(date_to_datetime(start_date), date_to_datetime(end_date))
+    return [
+        WaterLedger(subject=subject, **{col: columns[col][i] for col in LEDGER_COLUMNS})
+        for i in range(len(columns['date']))]
+
+
+def update_water_ledger(subject, start_date=None):
+    """Recompute the stored days of the ledger of a subject from a given date.
+
+    Without a date, or if the date is before the first stored day, the whole ledger is
+    recomputed until today.
+
+    """
+    start_date = _to_day(start_date)
+    stored = WaterLedger.objects.filter(subject=subject).aggregate(
+        first=Min('date'), last=Max('date'))
+    if start_date is not None and stored['first'] is None:
+        # Nothing stored yet: the ledger will be computed when requested.
+        return
+    elif start_date is not None and start_date > stored['first']:
+        end_date = stored['last']
+        if end_date < start_date:
+            return
+    else:
+        end_date = max(filter(None, (stored['last'], _today(subject))))
+        start_date = None
+    rows = _ledger_rows(subject, water_control(subject), start_date or date.min, end_date)
+    with transaction.atomic():
+        invalidate_water_ledger([subject.pk], start_date=start_date)
+        WaterLedger.objects.bulk_create(rows, batch_size=1000)
+
+
+def water_ledger(subject, start_date=None, end_date=None):
+    """Return the ledger of a subject between two dates, as a list of dictionaries with the
+    same keys as WaterControl.to_jsonable().
+
+    The start date defaults to the first day of the ledger, and the end date to today.
+    The missing days are computed and stored. Days before the first weighing or water
+    administration of the subject are computed but not stored.
+
+    """
+    start_date = _to_day(start_date)
+    end_date = _to_day(end_date) or _today(subject)
+    rows = WaterLedger.objects.filter(subject=subject)
+    if start_date is None:
+        start_date = rows.order_by('date').values_list('date', flat=True).first()
+        if start_date is None:
+            update_water_ledger(subject)
+            start_date = rows.order_by('date').values_list('date', flat=True).first()
+        if start_date is None:
+            return []
+    rows = rows.filter(date__gte=start_date, date__lte=end_date).order_by('date')
+    n = (end_date - start_date).days + 1
+    if n <= 0:
+        return []
+    if rows.count() == n:
+        return list(rows.values(*LEDGER_COLUMNS))
+    # Compute the requested days and store the missing ones.
+    wc = water_control(subject)
+    first_date = wc.first_date()
+    columns = wc.columns_between(date_to_datetime(start_date), date_to_datetime(end_date))
+    records = [{col: columns[col][i] for col in LEDGER_COLUMNS} for i in range(n)]
+    WaterLedger.objects.bulk_create(
+        [WaterLedger(subject=subject, **record) for record in records
+         if first_date and record['date'] >= first_date.date()],
+        batch_size=1000, ignore_conflicts=True)
+    return records
+
+
+def current_water_ledger(subjects):
+    """Return the ledger values of some subjects at the current time, as a dictionary
+    {subject_id: record}. The values are computed at the current time instead of noon, like
+    the WaterControl methods called without a date (a restriction that ended this morning
+    is over, for example), from the cached WaterControl instances of all the subjects."""
+    out = {}
+    for subject_id, wc in cached_water_control_many(subjects).items():
+        now = wc.today()
+        columns = wc.columns_between(now, now)
+        out[subject_id] = {col: columns[col][0] for col in LEDGER_COLUMNS}
+    return out
+
+
+def water_ledger_at(subject, date=None):
+    """Return the ledger of a subject at a given date, or at the current time without a
+    date (see current_water_ledger())."""
+    if date is None:
+        return current_water_ledger([subject])[subject.pk]
+    records = water_ledger(subject, start_date=date, end_date=date)
+    return records[0] if records else None
+
+
+def fill_water_ledger(subject, end_date):
+    """Job computing and storing the days of the ledger of a subject until a given date,
+    after some of them have been dropped by a change of its history."""
+    from subjects.models import Subject
+    subject = Subject.objects.filter(pk=subject).select_related('lab').first()
+    if subject is None:
+        return
+    end_date = _to_day(end_date)
+    rows = _ledger_rows(subject, water_control(subject), date.min, end_date)
+    # The stored days are replaced, in case the history has changed while this job was
+    # computing them (the change has enqueued another job).
+    with transaction.atomic():
+        WaterLedger.objects.filter(subject=subject, date__lte=end_date).delete()
+        WaterLedger.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def rebuild_water_ledger(subjects, batch_size=100):
+    """Recompute the whole ledger of some subjects until today."""
+    subjects = list(subjects)
+    for i in range(0, len(subjects), batch_size):
+        batch = subjects[i:i + batch_size]
+        wcs = water_control_many(batch)
+        rows = []
+        for subject in batch:
+            rows.extend(_ledger_rows(
+                subject, wcs[subject.pk], date.min, _today(subject)))
+        with transaction.atomic():
+            invalidate_water_ledger([subject.pk for subject in batch])
+            WaterLedger.objects.bulk_create(rows, batch_size=1000)
+        logger.info("Rebuilt the water ledger of %d/%d subjects.", i + len(batch), len(subjects))
@@ -1,3 +1,5 @@
+import base64
+from datetime import datetime
 import json
 import logging
 import os
@@ -7,22 +9,32 @@ import sys
 import pytz
 import uuid
 from collections import OrderedDict
+from urllib.parse import quote
 
 from django import forms
 from django.db import models
 from django.db import connection
+from django.db.models import F, Q, prefetch_related_objects
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.postgres.fields import JSONField
 from django.core.mail import send_mail
 from django.core.management import call_command
+from django.http import StreamingHttpResponse
 from django.template.response import TemplateResponse
 from django.urls import reverse
 from django.utils import termcolors, timezone
+from django.utils.http import RFC3986_SUBDELIMS
 
 from dateutil.parser import parse
 from reversion.admin import VersionAdmin
+from rest_framework import relations, serializers
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.reverse import reverse as api_reverse
 from rest_framework.test import APITestCase
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
 
 
 logger = logging.getLogger(__name__)
@@ -332,6 +344,377 @@ class BaseInlineAdmin(admin.TabularInline):
     }
 
 
+def _query_param_list(request, param):
+    value = request.query_params.get(param, None)
+    if value is None:
+        return None
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+class SparseFieldsMixin(object):
+    """
+    Serializer mixin pruning the fields of the responses to GET requests with the `fields`
+    and `exclude` query parameters, as comma-separated field names. For example
+    `?fields=url,name,file_size` or `?exclude=file_records`.
+    """
+    @classmethod
+    def requested_fields(cls, request):
+        """Return the names of the fields serialized for a request, or None for all fields."""
+        if request is None or request.method != 'GET':
+            return None
+        fields = _query_param_list(request, 'fields')
+        exclude = _query_param_list(request, 'exclude')
+        if fields is None and exclude is None:
+            return None
+        names = set(cls().fields)
+        if fields is not None:
+            names &= set(fields)
+        return names - set(exclude or ())
+
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        fields = self.requested_fields(self.context.get('request', None))
+        if fields is not None:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+
+
+def sparse_eager_loading(queryset, fields=None, select_related=None, prefetch_related=None):
+    """Eager load the relations used by some serializer fields (all fields by default).
+    The relations are given as dictionaries {field name: [lookups]}."""
+    def _lookups(relations):
+        lookups = OrderedDict()
+        for field, field_lookups in (relations or {}).items():
+            if fields is None or field in fields:
+                lookups.update((lookup, None) for lookup in field_lookups)
+        return list(lookups)
+    select_lookups = _lookups(select_related)
+    if select_lookups:
+        queryset = queryset.select_related(*select_lookups)
+    prefetch_lookups = _lookups(prefetch_related)
+    if prefetch_lookups:
+        queryset = queryset.prefetch_related(*prefetch_lookups)
+    return queryset
+
+
+def _row_value(row, field):
+    # the rows are dictionaries with the values serializers
+    return row[field] if isinstance(row, dict) else getattr(row, field)
+
+
+def _estimated_count(queryset):
+    """Number of rows of a queryset estimated by the PostgreSQL query planner."""
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+class KeysetPagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination, or keyset pagination when the `cursor` query parameter is given
+    (empty for the first page, then taken from the `next` link).
+
+    In keyset mode the rows are ordered by the `cursor_ordering` fields of the view, a
+    nullable field followed by the primary key (by default the primary key only), and a page
+    starts right after the last row of the previous page. The pages are stable under
+    concurrent inserts and each page is an index range scan instead of an ever larger offset.
+    The count is only computed with `count=exact`, or estimated with `count=estimate`.
+    """
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        self.limit = self.get_limit(request)
+        if not self.keyset or self.limit is None:
+            self.keyset = False
+            return super(KeysetPagination, self).paginate_queryset(queryset, request, view=view)
+        self.request = request
+        self.ordering = getattr(view, 'cursor_ordering', ('pk',))
+        count = request.query_params.get(self.count_query_param, None)
+        if count == 'exact':
+            self.count = queryset.count()
+        elif count == 'estimate':
+            self.count = _estimated_count(queryset)
+        else:
+            self.count = None
+        queryset = queryset.order_by(*self._order_by())
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self._after(position))
+        rows = list(queryset[:self.limit + 1])
+        self.next_position = None
+        if len(rows) > self.limit:
+            rows = rows[:self.limit]
+            self.next_position = [_row_value(rows[-1], field) for field in self.ordering]
+        return rows
+
+    def _order_by(self):
+        first = self.ordering[0]
+        if len(self.ordering) == 1:
+            return [first]
+        return [F(first).asc(nulls_last=True)] + list(self.ordering[1:])
+
+    def _after(self, position):
+        """Filter of the rows after a position, with the nulls of the first field last."""
+        if len(self.ordering) == 1:
+            return Q(**{self.ordering[0] + '__gt': position[0]})
+        (field, pk), (value, last_pk) = self.ordering, position
+        if value is None:
+            return Q(**{field + '__isnull': True, pk + '__gt': last_pk})
+        return (Q(**{field + '__gt': value}) |
+                Q(**{field: value, pk + '__gt': last_pk}) |
+                Q(**{field + '__isnull': True}))
+
+    def encode_cursor(self, position):
+        # NB: not DjangoJSONEncoder, which truncates the microseconds of the datetimes
+        values = [value.isoformat() if isinstance(value, datetime) else
+                  (str(value) if value is not None else None) for value in position]
+        return base64.urlsafe_b64encode(json.dumps(values).encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param, None)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+        except (TypeError, ValueError):
+            position = None
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound("Invalid cursor")
+        return position
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_next_link()
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super(KeysetPagination, self).get_previous_link()
+        return None
+
+
+def _identity(value):
+    return value
+
+
+class ValuesSerializer(object):
+    """
+    Read-only serializer of rows fetched with `values()`, with the same output as the many=True
+    serializer of `serializer_class`, but without model instances, field descriptors or
+    `reverse()` calls per row.
+
+    The fields are mapped to lookups: the model fields to their source, the slug related
+    fields to `<source>__<slug_field>` and the hyperlinked fields to the key of the linked
+    object, whose URL is built from a template reversed once. The other fields (method
+    fields, nested serializers) are given a lookup in `lookups`, or are computed from the row
+    by a `get_<field name>(row)` method, which can use the `extra_lookups`. The `prepare(rows)`
+    hook is called before serializing some rows, for example to fetch nested objects in bulk.
+    """
+    serializer_class = None
+    lookups = {}
+    extra_lookups = ()
+    url_sentinel = '00000000-0000-4000-8000-000000000000'
+
+    def __init__(self, instance=None, context=None, **kwargs):
+        self.instance = instance
+        self.context = context or {}
+        # the fields pruned by SparseFieldsMixin are pruned here too
+        serializer = self.serializer_class(context=self.context)
+        self.fields = [field for field in serializer.fields.values()
+                       if not field.write_only and not self._is_skipped(field)]
+        self._converters = None
+
+    def _is_skipped(self, field):
+        # DRF skips the optional fields without attribute on the instance
+        name = field.field_name
+        if field.required or name in self.lookups or hasattr(self, 'get_' + name):
+            return False
+        model = self.serializer_class.Meta.model
+        return field.source != '*' and not hasattr(model, field.source_attrs[0])
+
+    @property
+    def data(self):
+        return self.to_representation(self.instance)
+
+    def get_lookups(self):
+        lookups = [lookup for lookup, _ in self.converters.values() if lookup is not None]
+        return list(OrderedDict.fromkeys(['pk'] + lookups + list(self.extra_lookups)))
+
+    def get_queryset(self, queryset, extra_lookups=()):
+        """Return the rows of a queryset with the lookups used by the serializer."""
+        lookups = self.get_lookups()
+        lookups += [lookup for lookup in extra_lookups if lookup not in lookups]
+        return queryset.prefetch_related(None).values(*lookups)
+
+    @property
+    def converters(self):
+        if self._converters is None:
+            self._converters = OrderedDict(
+                (field.field_name, self._converter(field)) for field in self.fields)
+        return self._converters
+
+    def _converter(self, field):
+        """Return the lookup of a field and the function converting its value."""
+        name = field.field_name
+        method = getattr(self, 'get_' + name, None)
+        if method is not None:
+            return None, method
+        if name in self.lookups:
+            return self.lookups[name], _identity
+        if isinstance(field, relations.HyperlinkedIdentityField):
+            return field.lookup_field, self.url_template(field)
+        if isinstance(field, relations.HyperlinkedRelatedField):
+            lookup = field.source
+            if field.lookup_field != 'pk':
+                lookup += '__' + field.lookup_field
+            return lookup, self.url_template(field)
+        if isinstance(field, relations.SlugRelatedField):
+            return field.source + '__' + field.slug_field, _identity
+        if isinstance(field, (relations.RelatedField, relations.ManyRelatedField,
+                              serializers.BaseSerializer, serializers.SerializerMethodField)):
+            raise ValueError("The field `%s` needs a lookup or a get_%s() method." % (
+                name, name))
+        return field.source, field.to_representation
+
+    def url_template(self, field):
+        """Return a function building the URL of the object linked by a hyperlinked field from
+        the value of its lookup field, with a single call to reverse()."""
+        url = api_reverse(field.view_name, kwargs={field.lookup_url_kwarg: self.url_sentinel},
+                          request=self.context.get('request', None))
+        prefix, suffix = url.split(self.url_sentinel)
+        return lambda value: prefix + quote(str(value), safe=RFC3986_SUBDELIMS + '/~:@') + suffix
+
+    def prepare(self, rows):
+        pass
+
+    def represent(self, row):
+        ret = OrderedDict()
+        for name, (lookup, convert) in self.converters.items():
+            if lookup is None:
+                ret[name] = convert(row)
+            else:
+                value = row[lookup]
+                ret[name] = convert(value) if value is not None else None
+        return ret
+
+    def to_representation(self, rows):
+        rows = list(rows)
+        self.prepare(rows)
+        return [self.represent(row) for row in rows]
+
+
+class ValuesListMixin(object):
+    """
+    List view mixin serializing the rows of the GET requests with `values_serializer_class`,
+    a ValuesSerializer with the same output as the serializer of the view, unless the
+    FAST_LIST_SERIALIZERS setting is False.
+    """
+    values_serializer_class = None
+
+    def use_values_serializer(self):
+        # decided once per request, the rows of a streamed response are serialized later
+        if not hasattr(self, '_use_values_serializer'):
+            self._use_values_serializer = (
+                self.values_serializer_class is not None and
+                getattr(settings, 'FAST_LIST_SERIALIZERS', True) and
+                self.request is not None and self.request.method == 'GET')
+        return self._use_values_serializer
+
+    def filter_queryset(self, queryset):
+        queryset = super(ValuesListMixin, self).filter_queryset(queryset)
+        # The same explicit ordering with and without the values serializer, the ties of the
+        # default ordering are broken by the last cursor field (the primary key). The keyset
+        # pagination orders the rows by all the cursor fields.
+        ordering = queryset.query.order_by or queryset.model._meta.ordering
+        tie_breaker = getattr(self, 'cursor_ordering', ('pk',))[-1]
+        queryset = queryset.order_by(*ordering, tie_breaker)
+        if self.use_values_serializer():
+            serializer = self.values_serializer_class(context=self.get_serializer_context())
+            queryset = serializer.get_queryset(
+                queryset, extra_lookups=getattr(self, 'cursor_ordering', ()))
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        if kwargs.get('many', False) and self.use_values_serializer():
+            kwargs['context'] = self.get_serializer_context()
+            return self.values_serializer_class(*args, **kwargs)
+        return super(ValuesListMixin, self).get_serializer(*args, **kwargs)
+
+
+class StreamingListMixin(object):
+    """
+    List view mixin streaming the whole filtered list, without pagination, when the `stream`
+    query parameter is given: `?stream=json` for a JSON array, `?stream=ndjson` for one JSON
+    object per line.
+
+    The rows are fetched with a server-side cursor and serialized `stream_chunk_size` at a
+    time, so that the memory of the worker does not grow with the size of the list and the
+    response starts before the last rows are read.
+    """
+    stream_query_param = 'stream'
+    stream_chunk_size = 1000
+    stream_content_types = {
+        'json': 'application/json',
+        'ndjson': 'application/x-ndjson',
+    }
+
+    def list(self, request, *args, **kwargs):
+        stream = request.query_params.get(self.stream_query_param, None)
+        if stream is None:
+            return super(StreamingListMixin, self).list(request, *args, **kwargs)
+        if stream not in self.stream_content_types:
+            raise NotFound("Unknown stream format `%s`, must be one of %s" % (
+                stream, ', '.join(sorted(self.stream_content_types))))
+        queryset = self.filter_queryset(self.get_queryset())
+        chunks = self.iter_stream_chunks(queryset)
+        content = self._iter_ndjson(chunks) if stream == 'ndjson' else self._iter_json(chunks)
+        return StreamingHttpResponse(content, content_type=self.stream_content_types[stream])
+
+    def iter_stream_chunks(self, queryset):
+        """Yield the serialized rows of a queryset as lists of at most `stream_chunk_size`."""
+        # The prefetches are ignored by iterator(), they are done on every chunk instead.
+        lookups = queryset._prefetch_related_lookups
+        rows = queryset.prefetch_related(None).iterator(chunk_size=self.stream_chunk_size)
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == self.stream_chunk_size:
+                yield self._serialize_chunk(chunk, lookups)
+                chunk = []
+        if chunk:
+            yield self._serialize_chunk(chunk, lookups)
+
+    def _serialize_chunk(self, chunk, lookups):
+        prefetch_related_objects(chunk, *lookups)
+        return self.get_serializer(chunk, many=True).data
+
+    def _dumps(self, obj):
+        return json.dumps(obj, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+
+    def _iter_json(self, chunks):
+        sep = '['
+        for chunk in chunks:
+            yield sep + ','.join(self._dumps(obj) for obj in chunk)
+            sep = ','
+        yield ']' if sep == ',' else '[]'
+
+    def _iter_ndjson(self, chunks):
+        for chunk in chunks:
+            yield ''.join(self._dumps(obj) + '\n' for obj in chunk)
+
+
 class BaseTests(APITestCase):
     @classmethod
     def setUpTestData(cls):
@@ -194,6 +194,46 @@ REST_FRAMEWORK = {
     # ),
     'PAGE_SIZE': 250,
 }
+# Serialize the dataset, file record and session lists from values() rows (same output).
+FAST_LIST_SERIALIZERS = True
+
+# Caches
+# https://docs.djangoproject.com/en/stable/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # WaterControl instances of the subjects, checked on read against the version of their
+    # water history in the database, so that they are also correct with several processes.
+    # A shared backend (memcached, database...) avoids building them in every process.
+    'water_control': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'water_control',
+        'TIMEOUT': 3600,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    # Rendered weighing plots, keyed by subject and version of the water history.
+    # A FileBasedCache keeps them on disk across restarts.
+    'weighing_plot': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'weighing_plot',
+        'TIMEOUT': 7 * 24 * 3600,
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+}
+WATER_CONTROL_CACHE = 'water_control'
+WEIGHING_PLOT_CACHE = 'weighing_plot'
+
+# Lifetime in seconds, and maximum number, of the Globus endpoints and directory listings
+# cached by each process.
+GLOBUS_CACHE_TTL = 300
+GLOBUS_CACHE_SIZE = 10000
+# Seconds between two checks of the dataset types of the database by the dataset type
+# classifier of each process (the misses are always checked).
+DATASET_TYPE_CLASSIFIER_TTL = 60
+# Maximum number of concurrent directory listings per Globus endpoint when crawling.
+GLOBUS_ENDPOINT_CONCURRENCY = 8
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
@@ -82,12 +82,24 @@ urlpatterns = [
     path('downloads/<uuid:pk>', dv.DownloadDetail.as_view(),
          name="download-detail"),
 
+    path('export/<str:table>.<str:export_format>', dv.ColumnarExport.as_view(),
+         name="columnar-export"),
+
     path('files', dv.FileRecordList.as_view(),
          name="filerecord-list"),
 
     path('files/<uuid:pk>', dv.FileRecordDetail.as_view(),
          name="filerecord-detail"),
 
+    path('jobs', mv.JobList.as_view(),
+         name="job-list"),
+
+    path('jobs/<uuid:pk>', mv.JobDetail.as_view(),
+         name="job-detail"),
+
+    path('jobs/<uuid:pk>/cancel', mv.JobCancel.as_view(),
+         name="job-cancel"),
+
     path('labs', mv.LabList.as_view(),
          name="lab-list"),
 
@@ -4,7 +4,7 @@ from django_admin_listfilter_dropdown.filters import RelatedDropdownFilter
 from rangefilter.filter import DateRangeFilter
 
 from .models import (DataRepositoryType, DataRepository, DataFormat, DatasetType,
-                     Dataset, FileRecord, Download)
+                     Dataset, FileRecord, Download, TransferTask)
 from alyx.base import BaseAdmin, BaseInlineAdmin, DefaultListFilter, get_admin_url
 
 
@@ -142,6 +142,20 @@ class FileRecordAdmin(BaseAdmin):
         return getattr(obj.dataset, 'created_datetime', None)
 
 
+class TransferTaskAdmin(BaseAdmin):
+    fields = ('task_id', 'source_data_repository', 'destination_data_repository', 'status',
+              'bytes', 'bytes_transferred', 'created_datetime', 'completion_datetime')
+    list_display = fields
+    readonly_fields = fields
+    list_filter = ('status', 'destination_data_repository__name')
+    search_fields = ('task_id',)
+    ordering = ('-created_datetime',)
+
+    def get_queryset(self, request):
+        qs = super(TransferTaskAdmin, self).get_queryset(request)
+        return qs.select_related('source_data_repository', 'destination_data_repository')
+
+
 class DownloadAdmin(BaseAdmin):
     fields = ('user', 'dataset', 'first_download', 'last_download', 'count', 'projects')
     autocomplete_fields = ('dataset',)
@@ -170,4 +184,5 @@ admin.site.register(DataFormat, DataFormatAdmin)
 admin.site.register(DatasetType, DatasetTypeAdmin)
 admin.site.register(Dataset, DatasetAdmin)
 admin.site.register(FileRecord, FileRecordAdmin)
+admin.site.register(TransferTask, TransferTaskAdmin)
 admin.site.register(Download, DownloadAdmin)
@@ -0,0 +1,231 @@
+"""Columnar exports of the sessions, datasets and file records.
+
+A table is exported from the filtered queryset of its model, with the same filters as the
+corresponding REST list endpoint. The related names (subject nickname, dataset type,
+data repository...) are flattened into columns. The rows are fetched in chunks with
+`values_list()`, without instantiating the model objects, and written as:
+
+* `parquet`: a Parquet file, one row group per chunk (requires pyarrow),
+* `arrow`: an Arrow IPC file, one record batch per chunk (requires pyarrow),
+* `npy`: a zip archive of ALF files `<table>.<column>.npy`, one per column.
+
+"""
+
+from collections import OrderedDict
+from datetime import timezone
+from itertools import islice
+import logging
+import tempfile
+import zipfile
+
+from django.apps import apps
+from django.conf import settings
+from django.utils.module_loading import import_string
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+EXPORT_FORMATS = ('parquet', 'arrow', 'npy')
+
+# Table name: (model, filterset, {column: (lookup, kind)}). The integer columns are
+# nullable, they are stored as floats with NaN for the missing values in the npy files.
+EXPORT_TABLES = OrderedDict([
+    ('sessions', ('actions.Session', 'actions.views.SessionFilter', OrderedDict([
+        ('id', ('id', 'uuid')),
+        ('subject', ('subject__nickname', 'str')),
+        ('lab', ('lab__name', 'str')),
+        ('location', ('location__name', 'str')),
+        ('project', ('project__name', 'str')),
+        ('type', ('type', 'str')),
+        ('number', ('number', 'int')),
+        ('task_protocol', ('task_protocol', 'str')),
+        ('n_trials', ('n_trials', 'int')),
+        ('n_correct_trials', ('n_correct_trials', 'int')),
+        ('start_time', ('start_time', 'datetime')),
+        ('end_time', ('end_time', 'datetime')),
+        ('parent_session', ('parent_session_id', 'uuid')),
+    ]))),
+    ('datasets', ('data.Dataset', 'data.views.DatasetFilter', OrderedDict([
+        ('id', ('id', 'uuid')),
+        ('name', ('name', 'str')),
+        ('session', ('session_id', 'uuid')),
+        ('subject', ('session__subject__nickname', 'str')),
+        ('session_start_time', ('session__start_time', 'datetime')),
+        ('experiment_number', ('session__number', 'int')),
+        ('dataset_type', ('dataset_type__name', 'str')),
+        ('data_format', ('data_format__name', 'str')),
+        ('created_by', ('created_by__username', 'str')),
+        ('created_datetime', ('created_datetime', 'datetime')),
+        ('file_size', ('file_size', 'int')),
+        ('md5', ('md5', 'uuid')),
+        ('has_remote_copy', ('has_remote_copy', 'bool')),
+        ('has_local_copy', ('has_local_copy', 'bool')),
+    ]))),
+    ('files', ('data.FileRecord', 'data.views.FileRecordFilter', OrderedDict([
+        ('id', ('id', 'uuid')),
+        ('dataset', ('dataset_id', 'uuid')),
+        ('dataset_name', ('dataset__name', 'str')),
+        ('session', ('dataset__session_id', 'uuid')),
+        ('subject', ('dataset__session__subject__nickname', 'str')),
+        ('data_repository', ('data_repository__name', 'str')),
+        ('relative_path', ('relative_path', 'str')),
+        ('exists', ('exists', 'bool')),
+    ]))),
+])
+
+_NPY_DTYPES = {
+    'str': np.str_,
+    'uuid': np.str_,
+    'int': np.float64,
+    'bool': np.bool_,
+    'datetime': 'datetime64[us]',
+}
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa
+    except ImportError:
+        raise ImportError("The Parquet and Arrow exports require pyarrow.")
+    return pyarrow
+
+
+def export_queryset(table, params=None):
+    """Return the queryset of a table, filtered with the query parameters of its list
+    endpoint, and the columns of the table."""
+    if table not in EXPORT_TABLES:
+        raise ValueError("Unknown table `%s`, must be one of %s." % (
+            table, ', '.join(EXPORT_TABLES)))
+    model, filterset_class, columns = EXPORT_TABLES[table]
+    queryset = apps.get_model(model).objects.all()
+    filterset = import_string(filterset_class)(params or {}, queryset=queryset)
+    if not filterset.is_valid():
+        raise ValueError("Invalid filters: %s" % dict(filterset.errors))
+    return filterset.qs, columns
+
+
+def iter_column_chunks(queryset, columns, chunk_size=10000):
+    """Yield the columns of the rows of a queryset, as tuples of values, `chunk_size` rows
+    at a time."""
+    lookups = [lookup for lookup, _ in columns.values()]
+    rows = queryset.values_list(*lookups).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield list(zip(*chunk))
+
+
+def _python_values(kind, values):
+    if kind == 'uuid':
+        return [str(v) if v is not None else None for v in values]
+    return values
+
+
+def _utc(value):
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+
+def _npy_array(kind, values):
+    if kind in ('str', 'uuid'):
+        return np.array([str(v) if v is not None else '' for v in values], dtype=np.str_)
+    if kind == 'int':
+        return np.array([v if v is not None else np.nan for v in values], dtype=np.float64)
+    if kind == 'datetime':
+        return np.array([_utc(v) if v is not None else None for v in values],
+                        dtype='datetime64[us]')
+    return np.array(values, dtype=_NPY_DTYPES[kind])
+
+
+def _write_arrow(chunks, columns, fileobj, export_format):
+    pa = _import_pyarrow()
+    types = {
+        'str': pa.string(),
+        'uuid': pa.string(),
+        'int': pa.int64(),
+        'bool': pa.bool_(),
+        # naive datetimes in the server time zone unless USE_TZ is set
+        'datetime': pa.timestamp('us', tz='UTC' if settings.USE_TZ else None),
+    }
+    kinds = [kind for _, kind in columns.values()]
+    schema = pa.schema([(name, types[kind]) for name, kind in zip(columns, kinds)])
+    if export_format == 'parquet':
+        writer = pa.parquet.ParquetWriter(fileobj, schema)
+    else:
+        writer = pa.ipc.new_file(fileobj, schema)
+    n_rows = 0
+    try:
+        for chunk in chunks:
+            batch = pa.record_batch(
+                [pa.array(_python_values(kind, values), type=types[kind])
+                 for kind, values in zip(kinds, chunk)], schema=schema)
+            if export_format == 'parquet':
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+            n_rows += batch.num_rows
+    finally:
+        writer.close()
+    return n_rows
+
+
+def _npy_dtype(kind, dtypes):
+    """The dtype of a column from the dtypes of its chunks: the strings are as wide as the
+    longest one."""
+    if kind in ('str', 'uuid'):
+        return np.dtype((np.str_, max([d.itemsize // 4 for d in dtypes] + [1])))
+    return np.dtype(_NPY_DTYPES[kind])
+
+
+def _write_npy(table, chunks, columns, fileobj):
+    """Write the columns to a zip archive of npy files. The chunks of every column are
+    spooled to a temporary file, so that only one chunk is held in memory, then copied
+    after the header of its npy file, which needs the number of rows and the width of the
+    strings."""
+    kinds = [kind for _, kind in columns.values()]
+    spools = [tempfile.TemporaryFile() for _ in kinds]
+    # dtypes of the chunks of every column
+    chunk_dtypes = [[] for _ in kinds]
+    n_rows = 0
+    try:
+        for chunk in chunks:
+            for spool, dtypes, kind, values in zip(spools, chunk_dtypes, kinds, chunk):
+                array = _npy_array(kind, values)
+                np.save(spool, array)
+                dtypes.append(array.dtype)
+            n_rows += len(chunk[0])
+        with zipfile.ZipFile(fileobj, 'w') as zf:
+            for name, kind, spool, dtypes in zip(columns, kinds, spools, chunk_dtypes):
+                dtype = _npy_dtype(kind, dtypes)
+                header = {'descr': np.lib.format.dtype_to_descr(dtype),
+                          'fortran_order': False, 'shape': (n_rows,)}
+                spool.seek(0)
+                with zf.open('%s.%s.npy' % (table, name), 'w', force_zip64=True) as f:
+                    np.lib.format.write_array_header_1_0(f, header)
+                    for _ in dtypes:
+                        f.write(np.load(spool).astype(dtype).tobytes())
+    finally:
+        for spool in spools:
+            spool.close()
+    return n_rows
+
+
+def export_table(table, fileobj, export_format, params=None, chunk_size=10000):
+    """Write a table, filtered with the query parameters of its list endpoint, to a binary
+    file object in a columnar format. Return the number of exported rows."""
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format `%s`, must be one of %s." % (
+            export_format, ', '.join(EXPORT_FORMATS)))
+    if export_format in ('parquet', 'arrow'):
+        _import_pyarrow()
+    queryset, columns = export_queryset(table, params)
+    chunks = iter_column_chunks(queryset, columns, chunk_size=chunk_size)
+    if export_format == 'npy':
+        n_rows = _write_npy(table, chunks, columns, fileobj)
+    else:
+        n_rows = _write_arrow(chunks, columns, fileobj, export_format)
+    logger.info("Exported %d %s to %s.", n_rows, table, export_format)
+    return n_rows
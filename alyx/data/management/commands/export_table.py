@@ -0,0 +1,46 @@
+import os.path as op
+
+from django.core.management import BaseCommand, CommandError
+from django.http import QueryDict
+
+from data.export import EXPORT_FORMATS, EXPORT_TABLES, export_table
+
+
+class Command(BaseCommand):
+    help = ("Export the sessions, datasets or file records to a columnar file (Parquet, "
+            "Arrow IPC, or a zip archive of ALF npy files), with the filters of the "
+            "corresponding REST list endpoint.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('table', choices=list(EXPORT_TABLES))
+        parser.add_argument('output', help='Output file')
+        parser.add_argument('--format', dest='export_format', choices=EXPORT_FORMATS,
+                            help='Export format, by default the extension of the output file')
+        parser.add_argument('--filter', action='append', default=[], metavar='NAME=VALUE',
+                            help='Filter of the list endpoint, for example subject=ZM_1085 '
+                            '(can be repeated)')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Number of rows fetched and written at a time')
+
+    def handle(self, *args, **options):
+        export_format = options['export_format']
+        if export_format is None:
+            export_format = op.splitext(options['output'])[1].lstrip('.')
+            export_format = 'npy' if export_format == 'zip' else export_format
+        if export_format not in EXPORT_FORMATS:
+            raise CommandError("Unknown export format, use --format (%s)." %
+                               ', '.join(EXPORT_FORMATS))
+        params = QueryDict(mutable=True)
+        for item in options['filter']:
+            name, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError("Invalid filter `%s`, must be NAME=VALUE." % item)
+            params.appendlist(name, value)
+        with open(options['output'], 'wb') as f:
+            try:
+                n_rows = export_table(options['table'], f, export_format, params=params,
+                                      chunk_size=options['chunk_size'])
+            except (ImportError, ValueError) as e:
+                raise CommandError(str(e))
+        self.stdout.write("Exported %d %s to %s." % (n_rows, options['table'],
+                                                     options['output']))
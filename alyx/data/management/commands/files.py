@@ -1,10 +1,11 @@
 import logging
+from django.contrib.auth import get_user_model
 from django.core.management import BaseCommand
 from django.db.models import Count, Q
 
 from actions.models import Session
 from data import transfers
-from data.models import Dataset, DatasetType, DataRepository, FileRecord
+from data.models import Dataset, DataRepository, FileRecord
 from misc.models import Lab
 logging.getLogger(__name__).setLevel(logging.WARNING)
 
@@ -81,6 +82,13 @@ class Command(BaseCommand):
         parser.add_argument('--path', help='path')
         parser.add_argument('--limit', help='limit to a maximum number of datasets')
         parser.add_argument('--user', help='select datasets created by a given user')
+        parser.add_argument('--threads', type=int, default=8,
+                            help='number of concurrent Globus requests per endpoint')
+        parser.add_argument('--checkpoint',
+                            help='checkpoint file of a resumable scan, checksum or crawl')
+        parser.add_argument('--processes', type=int,
+                            help='number of hashing processes (number of CPUs by default)')
+        parser.add_argument('--rate', type=float, help='maximum reading rate in MB/s')
 
     def handle(self, *args, **options):
         action = options.get('action')
@@ -94,10 +102,26 @@ class Command(BaseCommand):
 
         if action == 'bulksync':
             _create_missing_file_records_main_globus(dry_run=dry, lab=lab)
-            transfers.bulk_sync(dry_run=dry, lab=lab)
+            report = transfers.bulk_sync(dry_run=dry, lab=lab, n_threads=options['threads'])
+            if not dry:
+                for ep in report:
+                    self.stdout.write(
+                        "Endpoint %s: %d files in %d directories listed in %.1f s." % (
+                            ep['endpoint'], ep['files'], ep['directories'], ep['duration']))
+                self.stdout.write("Globus cache: %s" % transfers.globus_cache_stats())
 
         if action == 'bulktransfer':
-            transfers.bulk_transfer(dry_run=dry, lab=lab)
+            report = transfers.bulk_transfer(dry_run=dry, lab=lab)
+            for pair in report:
+                self.stdout.write(
+                    "%s to %s: %d files (%d bytes) in %d tasks%s." % (
+                        pair['source_data_repository'], pair['destination_data_repository'],
+                        pair['files'], pair['bytes'], pair['tasks'], ' (dry)' if dry else ''))
+
+        if action == 'poll':
+            counts = transfers.poll_transfer_tasks()
+            for status, n in sorted(counts.items()):
+                self.stdout.write("%d transfer tasks %s." % (n, status.lower()))
 
         if action == 'login':
             transfers.create_globus_token()
@@ -109,16 +133,43 @@ class Command(BaseCommand):
                 self.stdout.write("Synchronizing file status of %s" % str(dataset))
                 if not dry:
                     transfers.update_file_exists(dataset)
+            self.stdout.write("Globus cache: %s" % transfers.globus_cache_stats())
+
+        if action == 'scan':
+            if not data_repository:
+                raise ValueError("Please specify a data_repository.")
+            data_repository = DataRepository.objects.get(name=data_repository)
+            report = transfers.scan_repository(
+                data_repository, root=path, n_threads=options['threads'],
+                checkpoint=options.get('checkpoint'), dry_run=dry)
+            self.stdout.write(
+                "Scanned %d directories (%d files) in %.1f s: %d file records and %d "
+                "datasets updated%s." % (
+                    report['directories'], report['files'], report['duration'],
+                    report['file_records'], report['datasets'], ' (dry)' if dry else ''))
+
+        if action == 'checksum':
+            if not data_repository:
+                raise ValueError("Please specify a data_repository.")
+            data_repository = DataRepository.objects.get(name=data_repository)
+            report = transfers.checksum_repository(
+                data_repository, root=path, n_processes=options.get('processes'),
+                rate=options.get('rate'), checkpoint=options.get('checkpoint'), dry_run=dry)
+            self.stdout.write(
+                "Hashed %d files (%d MB) in %.1f s: %d MD5s stored, %d mismatches, %d files "
+                "not found%s." % (
+                    report['files'], report['bytes'] // 1000000, report['duration'],
+                    report['stored'], len(report['mismatches']), report['missing'],
+                    ' (dry)' if dry else ''))
+            for pk in report['mismatches']:
+                self.stdout.write("MD5 mismatch: file record %s" % pk)
 
         if action == 'syncfast':
-            with open(path, 'r') as f:
-                existing = {p.strip(): True for p in f.readlines()}
-            for fr in FileRecord.objects.filter(exists=False):
-                path = transfers._get_absolute_path(fr)
-                if existing.get(path, None):
-                    self.stdout.write("File %s exists, updating." % path)
-                    fr.exists = True
-                    fr.save()
+            report = transfers.sync_manifest(path, dry_run=dry)
+            self.stdout.write(
+                "%d paths: %d file records matched, %d updated, %d paths unmatched%s." % (
+                    report['paths'], report['matched'], report['updated'], report['unmatched'],
+                    ' (dry)' if dry else ''))
 
         if action == 'transfer':
             for dataset in _iter_datasets(dataset_id, limit=limit, user=user):
@@ -141,11 +192,10 @@ class Command(BaseCommand):
             dr.data_url = 'http://ibl.flatironinstitute.org/cortexlab/Subjects/'
             dr.save()
 
-            qs = DatasetType.objects.filter(filename_pattern__isnull=False)
             dt = None
             for d in FileRecord.objects.all().select_related('dataset'):
                 try:
-                    dt = transfers.get_dataset_type(d.relative_path, qs=qs)
+                    dt = transfers.get_dataset_type(d.relative_path)
                 except ValueError:
                     dt = None
                     continue
@@ -182,6 +232,14 @@ class Command(BaseCommand):
             if not data_repository:
                 raise ValueError("Please specify a data_repository.")
             data_repository = DataRepository.objects.get(name=data_repository)
-            for dir_path, filenames in transfers.iter_registered_directories(
-                    data_repository=data_repository, path=path):
-                print(dir_path, filenames)
+            if user:
+                user = get_user_model().objects.get(username=user)
+            report = transfers.autoregister(
+                data_repository, path=path, user=user, dry_run=dry,
+                n_threads=options['threads'], checkpoint=options.get('checkpoint'))
+            self.stdout.write(
+                "Crawled %d directories: %d files registered in %d directories%s." % (
+                    report['directories'], report['files'], report['registered'],
+                    ' (dry)' if dry else ''))
+            for rel_dir_path in report['errors']:
+                self.stdout.write("Unable to register %s" % rel_dir_path)
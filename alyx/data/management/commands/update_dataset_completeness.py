@@ -0,0 +1,24 @@
+from django.core.management import BaseCommand
+from data.models import Dataset, update_dataset_completeness
+
+
+class Command(BaseCommand):
+    help = ("Recompute the completeness flags (has_remote_copy, has_local_copy) of the "
+            "datasets from their file records.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lab', help='Only the datasets of the sessions of this lab')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Number of datasets updated per query')
+
+    def handle(self, *args, **options):
+        datasets = Dataset.objects.order_by('pk')
+        if options.get('lab'):
+            datasets = datasets.filter(session__lab__name=options['lab'])
+        dataset_ids = list(datasets.values_list('pk', flat=True))
+        batch_size = options['batch_size']
+        for i in range(0, len(dataset_ids), batch_size):
+            update_dataset_completeness(dataset_ids[i:i + batch_size])
+        n_complete = datasets.filter(has_remote_copy=True, has_local_copy=True).count()
+        self.stdout.write("Updated the completeness of %d datasets (%d complete)." % (
+            len(dataset_ids), n_complete))
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:38
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0004_dataset_filesize_int64'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransferTask',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(blank=True, help_text='Long name', max_length=255)),
+                ('json', django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='Structured data, formatted in a user-defined way', null=True)),
+                ('task_id', models.UUIDField(help_text='Globus task UUID', unique=True)),
+                ('status', models.CharField(choices=[('ACTIVE', 'Active'), ('INACTIVE', 'Inactive'), ('SUCCEEDED', 'Succeeded'), ('FAILED', 'Failed')], db_index=True, default='ACTIVE', max_length=16)),
+                ('bytes', models.BigIntegerField(default=0, help_text='Number of bytes to transfer')),
+                ('bytes_transferred', models.BigIntegerField(default=0)),
+                ('created_datetime', models.DateTimeField(default=django.utils.timezone.now)),
+                ('completion_datetime', models.DateTimeField(blank=True, null=True)),
+                ('destination_data_repository', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='destination_transfer_tasks', to='data.DataRepository')),
+                ('file_records', models.ManyToManyField(blank=True, help_text='Destination file records of the transfer', related_name='transfer_tasks', to='data.FileRecord')),
+                ('source_data_repository', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='source_transfer_tasks', to='data.DataRepository')),
+            ],
+            options={
+                'ordering': ('-created_datetime',),
+            },
+        ),
+    ]
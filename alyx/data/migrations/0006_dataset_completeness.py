@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0005_transfertask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='has_local_copy',
+            field=models.BooleanField(db_index=True, default=False, editable=False, help_text='Whether a file record on a personal repository exists'),
+        ),
+        migrations.AddField(
+            model_name='dataset',
+            name='has_remote_copy',
+            field=models.BooleanField(db_index=True, default=True, editable=False, help_text='Whether all the file records on the main (non-personal) repositories exist'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-17 06:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0006_dataset_completeness'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dataset',
+            index=models.Index(fields=['created_datetime', 'id'], name='data_datase_created_180cf5_idx'),
+        ),
+    ]
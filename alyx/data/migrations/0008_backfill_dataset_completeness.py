@@ -0,0 +1,23 @@
+from django.db import migrations
+from django.db.models import Exists, OuterRef
+
+
+def update_dataset_completeness(apps, schema_editor):
+    # Same update as data.models.update_dataset_completeness(), on the historical models.
+    Dataset = apps.get_model('data', 'Dataset')
+    FileRecord = apps.get_model('data', 'FileRecord')
+    records = FileRecord.objects.filter(dataset=OuterRef('pk')).values('pk')
+    missing_remote = records.filter(exists=False, data_repository__globus_is_personal=False)
+    local = records.filter(exists=True, data_repository__globus_is_personal=True)
+    Dataset.objects.update(has_remote_copy=~Exists(missing_remote), has_local_copy=Exists(local))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0007_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(update_dataset_completeness, migrations.RunPython.noop),
+    ]
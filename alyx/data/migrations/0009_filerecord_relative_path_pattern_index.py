@@ -0,0 +1,31 @@
+from django.db import migrations
+
+
+INDEX = 'data_filerecord_relative_path_like'
+
+
+def create_index(apps, schema_editor):
+    # Index for the `relative_path__startswith` lookups of the repository scans, the
+    # unique index of the relative paths does not serve LIKE prefixes in a non-C locale.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS %s ON data_filerecord '
+        '(data_repository_id, relative_path varchar_pattern_ops)' % INDEX)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS %s' % INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0008_backfill_dataset_completeness'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -3,6 +3,9 @@ import os.path as op
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.db import models
+from django.db.models import Exists, OuterRef
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
 from alyx.settings import TIME_ZONE, AUTH_USER_MODEL
@@ -183,6 +186,13 @@ class DatasetType(BaseModel):
         return "<DatasetType %s>" % self.name
 
 
+@receiver(post_save, sender=DatasetType)
+@receiver(post_delete, sender=DatasetType)
+def invalidate_dataset_type_classifier_on_change(sender, instance=None, **kwargs):
+    from data.transfers import invalidate_dataset_type_classifier
+    invalidate_dataset_type_classifier()
+
+
 class BaseExperimentalData(BaseModel):
     """
     Abstract base class for all data acquisition models. Never used directly.
@@ -261,12 +271,27 @@ class Dataset(BaseExperimentalData):
         DataFormat, blank=False, null=False, on_delete=models.SET_DEFAULT,
         default=default_data_format)
 
+    # Completeness flags, maintained by update_dataset_completeness().
+    has_remote_copy = models.BooleanField(
+        default=True, db_index=True, editable=False,
+        help_text="Whether all the file records on the main (non-personal) repositories exist")
+
+    has_local_copy = models.BooleanField(
+        default=False, db_index=True, editable=False,
+        help_text="Whether a file record on a personal repository exists")
+
+    class Meta:
+        # keyset pagination of the datasets
+        indexes = [models.Index(fields=['created_datetime', 'id'])]
+
     def data_url(self):
-        records = self.file_records.filter(data_repository__data_url__isnull=False,
-                                           exists=True)
+        # uses the records of prefetch_data_urls() when they have been prefetched
+        records = getattr(self, '_data_url_records', None)
+        if records is None:
+            records = _data_url_records(self.file_records.all())[:1]
         # returns preferentially globus non-personal endpoint
-        if records:
-            return records.order_by('data_repository__globus_is_personal')[0].data_url()
+        for record in records:
+            return record.data_url()
 
     def __str__(self):
         date = self.created_datetime.strftime('%d/%m/%Y at %H:%M')
@@ -312,16 +337,107 @@ class FileRecord(BaseModel):
         unique_together = (('data_repository', 'relative_path'),)
 
     def data_url(self):
-        root = self.data_repository.data_url
-        if not root:
-            return None
-        from data.transfers import _add_uuid_to_filename
-        return _add_uuid_to_filename(root + self.relative_path, self.dataset.pk)
+        return _data_url(self.data_repository.data_url, self.relative_path, self.dataset_id)
 
     def __str__(self):
         return "<FileRecord '%s' by %s>" % (self.relative_path, self.dataset.created_by)
 
 
+def _data_url(root, relative_path, dataset_id):
+    """URL of a file record from the data URL of its repository."""
+    if not root:
+        return None
+    from data.transfers import _add_uuid_to_filename
+    return _add_uuid_to_filename(root + relative_path, dataset_id)
+
+
+def _data_url_records(records):
+    return records.filter(
+        data_repository__data_url__isnull=False, exists=True).select_related(
+        'data_repository').order_by('data_repository__globus_is_personal')
+
+
+def prefetch_data_urls(prefix=''):
+    """Prefetch of the file records used by Dataset.data_url(), to get the data URLs of many
+    datasets in a single query. The prefix is the lookup of the datasets, for example
+    `data_dataset_session_related__` from the sessions."""
+    return models.Prefetch(prefix + 'file_records',
+                           queryset=_data_url_records(FileRecord.objects.all()),
+                           to_attr='_data_url_records')
+
+
+def update_dataset_completeness(datasets=None):
+    """Recompute the completeness flags of some datasets, given as a list or a queryset of
+    dataset ids (all datasets by default). Return the number of updated datasets."""
+    records = FileRecord.objects.filter(dataset=OuterRef('pk')).values('pk')
+    missing_remote = records.filter(exists=False, data_repository__globus_is_personal=False)
+    local = records.filter(exists=True, data_repository__globus_is_personal=True)
+    qs = Dataset.objects.all()
+    if datasets is not None:
+        qs = qs.filter(pk__in=datasets)
+    return qs.update(has_remote_copy=~Exists(missing_remote), has_local_copy=Exists(local))
+
+
+@receiver(post_save, sender=FileRecord)
+@receiver(post_delete, sender=FileRecord)
+def update_dataset_completeness_on_file_change(sender, instance=None, **kwargs):
+    update_dataset_completeness([instance.dataset_id])
+
+
+@receiver(post_save, sender=DataRepository)
+def update_dataset_completeness_on_repository_change(sender, instance=None, created=False,
+                                                     **kwargs):
+    if not created:
+        update_dataset_completeness(
+            FileRecord.objects.filter(data_repository=instance).values('dataset'))
+
+
+# Transfer tasks
+# ------------------------------------------------------------------------------------------------
+
+class TransferTask(BaseModel):
+    """
+    A Globus transfer task submitted to fill missing files of a data repository. The file
+    records are the destination files, which exist once the task has succeeded.
+    """
+    ACTIVE = 'ACTIVE'
+    INACTIVE = 'INACTIVE'
+    SUCCEEDED = 'SUCCEEDED'
+    FAILED = 'FAILED'
+    STATUS_CHOICES = (
+        (ACTIVE, 'Active'),
+        (INACTIVE, 'Inactive'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+    # statuses of the tasks that may still transfer their files
+    IN_FLIGHT = (ACTIVE, INACTIVE)
+
+    task_id = models.UUIDField(unique=True, help_text="Globus task UUID")
+    source_data_repository = models.ForeignKey(
+        DataRepository, related_name='source_transfer_tasks', on_delete=models.CASCADE)
+    destination_data_repository = models.ForeignKey(
+        DataRepository, related_name='destination_transfer_tasks', on_delete=models.CASCADE)
+    file_records = models.ManyToManyField(
+        'FileRecord', related_name='transfer_tasks', blank=True,
+        help_text="Destination file records of the transfer")
+    status = models.CharField(
+        max_length=16, choices=STATUS_CHOICES, default=ACTIVE, db_index=True)
+    bytes = models.BigIntegerField(
+        default=0, help_text="Number of bytes to transfer")
+    bytes_transferred = models.BigIntegerField(default=0)
+    created_datetime = models.DateTimeField(default=timezone.now)
+    completion_datetime = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('-created_datetime',)
+
+    def __str__(self):
+        return "<TransferTask %s from %s to %s (%s)>" % (
+            self.task_id, self.source_data_repository.name,
+            self.destination_data_repository.name, self.status)
+
+
 # Download table
 # ------------------------------------------------------------------------------------------------
 
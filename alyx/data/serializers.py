@@ -1,8 +1,11 @@
+from collections import defaultdict
+
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
 
+from alyx.base import SparseFieldsMixin, ValuesSerializer, sparse_eager_loading
 from .models import (DataRepositoryType, DataRepository, DataFormat, DatasetType,
-                     Dataset, Download, FileRecord,)
+                     Dataset, Download, FileRecord, _data_url)
 from .transfers import _get_session
 from actions.models import Session
 from subjects.models import Subject
@@ -92,7 +95,7 @@ class DatasetFileRecordsSerializer(serializers.ModelSerializer):
                   'exists')
 
 
-class DatasetSerializer(serializers.HyperlinkedModelSerializer):
+class DatasetSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     created_by = serializers.SlugRelatedField(
         read_only=False, slug_field='username',
         queryset=get_user_model().objects.all(),
@@ -135,14 +138,20 @@ class DatasetSerializer(serializers.HyperlinkedModelSerializer):
     number = serializers.IntegerField(required=False)
 
     @staticmethod
-    def setup_eager_loading(queryset):
+    def setup_eager_loading(queryset, fields=None):
         """ Perform necessary eager loading of data to avoid horrible performance."""
-        queryset = queryset.select_related(
-            'created_by', 'dataset_type', 'data_format', 'session',
-            'session__subject')
-        queryset = queryset.prefetch_related(
-            'file_records', 'file_records__data_repository')
-        return queryset
+        return sparse_eager_loading(
+            queryset, fields,
+            select_related={
+                'created_by': ['created_by'],
+                'dataset_type': ['dataset_type'],
+                'data_format': ['data_format'],
+                'session': ['session', 'session__subject'],
+                'experiment_number': ['session'],
+            },
+            prefetch_related={
+                'file_records': ['file_records', 'file_records__data_repository'],
+            })
 
     def get_experiment_number(self, obj):
         return obj.session.number if obj and obj.session else None
@@ -182,6 +191,39 @@ class DatasetSerializer(serializers.HyperlinkedModelSerializer):
         }
 
 
+class FileRecordValuesSerializer(ValuesSerializer):
+    serializer_class = FileRecordSerializer
+
+
+class DatasetFileRecordsValuesSerializer(ValuesSerializer):
+    serializer_class = DatasetFileRecordsSerializer
+    lookups = {'data_repository_path': 'data_repository__globus_path'}
+    extra_lookups = ('dataset_id', 'data_repository__data_url')
+
+    def get_data_url(self, row):
+        return _data_url(row['data_repository__data_url'], row['relative_path'],
+                         row['dataset_id'])
+
+
+class DatasetValuesSerializer(ValuesSerializer):
+    serializer_class = DatasetSerializer
+    lookups = {'experiment_number': 'session__number'}
+
+    def prepare(self, rows):
+        # the file records of all the rows in one query
+        self._file_records = defaultdict(list)
+        if 'file_records' not in self.converters or not rows:
+            return
+        serializer = DatasetFileRecordsValuesSerializer(context=self.context)
+        records = serializer.get_queryset(
+            FileRecord.objects.filter(dataset_id__in=[row['pk'] for row in rows]))
+        for record in records:
+            self._file_records[record['dataset_id']].append(serializer.represent(record))
+
+    def get_file_records(self, row):
+        return self._file_records.get(row['pk'], [])
+
+
 class DownloadSerializer(serializers.HyperlinkedModelSerializer):
 
     # dataset = DatasetSerializer(many=False, read_only=True)
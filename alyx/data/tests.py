@@ -1,3 +1,722 @@
-# from django.test import TestCase
+import gzip
+import hashlib
+import importlib
+import importlib.util
+import io
+import itertools
+import os
+import os.path as op
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import uuid
+import zipfile
 
-# Create your tests here.
+from django.apps import apps
+from django.core.management import call_command, CommandError
+from django.db.models.query import QuerySet
+from django.test import TestCase
+import globus_sdk
+import numpy as np
+
+from actions.models import Session
+from data.models import (
+    DataFormat, DataRepository, Dataset, DatasetType, FileRecord, TransferTask,
+    update_dataset_completeness)
+from data import transfers
+from data.export import EXPORT_TABLES, export_table
+from data.transfers import (
+    _add_uuid_to_filename, _filename_matches_pattern, get_dataset_type, DatasetTypeClassifier,
+    bulk_sync, bulk_transfer, TTLCache, globus_ls, globus_cache_stats, clear_globus_cache,
+    _plan_bulk_transfer, _record_transfer_tasks, poll_transfer_tasks, _incomplete_dataset_ids,
+    scan_repository, checksum_repository, RateLimiter, sync_manifest, crawl_directories,
+    autoregister)
+from misc.models import Lab
+from subjects.models import Subject
+
+
+class FakeTransferClient(object):
+    """A Globus transfer client that lists files from a dictionary, for offline tests.
+
+    `files` is a dictionary {endpoint_id: {absolute path of a file: size}}.
+
+    """
+    def __init__(self, files=None, disconnected=(), tasks=None, failures=None):
+        self.files = files or {}
+        self.disconnected = set(disconnected)
+        self.tasks = tasks or {}
+        # number of times the listing of a directory fails
+        self.failures = failures or {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _log(self, *args):
+        with self._lock:
+            self.calls.append(args)
+
+    def get_endpoint(self, endpoint_id):
+        self._log('get_endpoint', endpoint_id)
+        return {'display_name': str(endpoint_id),
+                'gcp_connected': False if endpoint_id in self.disconnected else None}
+
+    def operation_ls(self, endpoint_id, path=None):
+        self._log('operation_ls', endpoint_id, path)
+        path = path.rstrip('/')
+        with self._lock:
+            if self.failures.get(path, 0) > 0:
+                self.failures[path] -= 1
+                raise globus_sdk.GlobusError("Unable to list %s" % path)
+        files = self.files.get(endpoint_id, {})
+        subdirs = sorted({p[len(path) + 1:].split('/')[0] for p in files
+                          if op.dirname(p).startswith(path + '/')})
+        return [{'name': op.basename(p), 'size': size, 'type': 'file'}
+                for p, size in files.items()
+                if op.dirname(p) == path] + [{'name': d, 'type': 'dir'} for d in subdirs]
+
+    def task_list(self, filter=None, limit=None):
+        self._log('task_list', filter)
+        task_ids = filter.split(':')[1].split(',')
+        return [dict(task_id=task_id, **self.tasks[task_id])
+                for task_id in task_ids if task_id in self.tasks][:limit]
+
+
+class DatasetTypeClassifierTests(TestCase):
+    def setUp(self):
+        patterns = ('spikes.times.*', 'spikes.clusters.*', '*.timestamps.*', 'clusters.*',
+                    '_ibl_trials.*', 'eye.*.mj2', 'raw(ephys|video).*', 'SPIKES.amps*')
+        for i, pattern in enumerate(patterns):
+            DatasetType.objects.create(name='dt%d' % i, filename_pattern=pattern)
+
+    def test_classifier(self):
+        dataset_types = DatasetType.objects.filter(filename_pattern__isnull=False)
+        classifier = DatasetTypeClassifier(dataset_types)
+        filenames = ('spikes.times.npy', 'Spikes.Times.npy', 'spikes.amps.npy',
+                     'alf/probe00/spikes.clusters.npy', 'clusters.depths.npy',
+                     'camera.timestamps.npy', 'spikes.timestamps.npy', '_ibl_trials.choice.npy',
+                     '_iblXtrials.choice.npy', 'eye.movie.mj2', 'eye.mj2', 'rawephys.bin',
+                     'rawvideo.mp4', 'raw.bin', 'spikes', '')
+        # the classifier gives the same matches as testing every pattern
+        for filename in filenames:
+            expected = [dt for dt in dataset_types if dt.filename_pattern.strip() and
+                        _filename_matches_pattern(filename, dt.filename_pattern)]
+            self.assertEqual(classifier.match(filename), expected)
+
+    def test_get_dataset_type(self):
+        self.assertEqual(get_dataset_type('a/b/spikes.times.npy').name, 'dt0')
+        with self.assertRaises(ValueError) as e:
+            get_dataset_type('spikes.clusters.timestamps.npy')
+        self.assertIn('Multiple matching dataset types', str(e.exception))
+        with self.assertRaises(ValueError) as e:
+            get_dataset_type('unknown.npy')
+        self.assertIn('No dataset type found', str(e.exception))
+
+        # the classifier is updated when the dataset types change
+        DatasetType.objects.create(name='dtunknown', filename_pattern='unknown.*')
+        self.assertEqual(get_dataset_type('unknown.npy').name, 'dtunknown')
+        dt = DatasetType.objects.get(name='dt0')
+        dt.filename_pattern = 'spikes.times2.*'
+        dt.save()
+        self.assertEqual(get_dataset_type('spikes.times2.npy').name, 'dt0')
+        dt.delete()
+        with self.assertRaises(ValueError):
+            get_dataset_type('spikes.times2.npy')
+
+    def test_get_dataset_type_other_process(self):
+        # changes made without the signals of this process, as by another process
+        get_dataset_type('spikes.times.npy')
+        DatasetType.objects.bulk_create(
+            [DatasetType(name='dtother', filename_pattern='other.*')])
+        self.assertEqual(get_dataset_type('other.npy').name, 'dtother')
+        DatasetType.objects.filter(name='dt0').update(filename_pattern='spikes.times3.*')
+        with mock.patch('alyx.settings.DATASET_TYPE_CLASSIFIER_TTL', 0):
+            with self.assertRaises(ValueError):
+                get_dataset_type('spikes.times.npy')
+
+
+class GlobusCacheTests(TestCase):
+    def test_ttl_cache(self):
+        c = TTLCache(ttl=60, maxsize=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEqual(c.get('a'), 1)
+        # the least recently used item is evicted
+        c.set('c', 3)
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('c'), 3)
+        self.assertEqual(c.stats(), {'size': 2, 'hits': 3, 'misses': 1})
+        # the items expire
+        c.ttl = 0
+        c.set('a', 1)
+        self.assertIsNone(c.get('a'))
+
+    def test_globus_ls(self):
+        clear_globus_cache()
+        ep = uuid.uuid4()
+        gc = FakeTransferClient({ep: {'/data/a.npy': 1, '/data/b.npy': 2}})
+        for _ in range(3):
+            files = globus_ls(gc, ep, '/data')
+        self.assertEqual(sorted(f['name'] for f in files), ['a.npy', 'b.npy'])
+        self.assertEqual(len(gc.calls), 1)
+        stats = globus_cache_stats()['listings']
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+
+class DatasetCompletenessTests(TestCase):
+    def setUp(self):
+        self.main = DataRepository.objects.create(name='main', globus_is_personal=False)
+        self.local = DataRepository.objects.create(name='local', globus_is_personal=True)
+        self.dataset = Dataset.objects.create(name='a.b.npy')
+
+    def _flags(self):
+        self.dataset.refresh_from_db()
+        return self.dataset.has_remote_copy, self.dataset.has_local_copy
+
+    def _incomplete(self):
+        return set(pk for pk, in _incomplete_dataset_ids())
+
+    def test_completeness_signals(self):
+        self.assertEqual(self._flags(), (True, False))
+        remote = FileRecord.objects.create(
+            dataset=self.dataset, data_repository=self.main, relative_path='a/a.b.npy')
+        local = FileRecord.objects.create(
+            dataset=self.dataset, data_repository=self.local, relative_path='a/a.b.npy',
+            exists=True)
+        self.assertEqual(self._flags(), (False, True))
+        self.assertEqual(self._incomplete(), {self.dataset.pk})
+        remote.exists = True
+        remote.save()
+        self.assertEqual(self._flags(), (True, True))
+        self.assertEqual(self._incomplete(), set())
+        local.delete()
+        self.assertEqual(self._flags(), (True, False))
+        # changing the type of a repository updates the datasets of its files
+        self.main.globus_is_personal = True
+        self.main.save()
+        self.assertEqual(self._flags(), (True, True))
+
+    def test_update_dataset_completeness(self):
+        FileRecord.objects.bulk_create([FileRecord(
+            dataset=self.dataset, data_repository=self.local, relative_path='a/a.b.npy',
+            exists=True)])
+        self.assertEqual(self._flags(), (True, False))
+        with self.assertNumQueries(1):
+            self.assertEqual(update_dataset_completeness(), 1)
+        self.assertEqual(self._flags(), (True, True))
+
+    def test_completeness_migration(self):
+        # the existing datasets are updated by the migration adding the flags
+        migration = importlib.import_module(
+            'data.migrations.0008_backfill_dataset_completeness')
+        FileRecord.objects.bulk_create([FileRecord(
+            dataset=self.dataset, data_repository=self.local, relative_path='a/a.b.npy',
+            exists=True)])
+        migration.update_dataset_completeness(apps, None)
+        self.assertEqual(self._flags(), (True, True))
+
+
+class ColumnarExportTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        lab = Lab.objects.create(name='exportlab')
+        self.subject = Subject.objects.create(nickname='export_subject', lab=lab)
+        self.session = Session.objects.create(subject=self.subject, lab=lab, number=3)
+        self.repo = DataRepository.objects.create(name='export_repo')
+        self.datasets = [
+            Dataset.objects.create(name='a.%d.npy' % i, session=self.session, file_size=i)
+            for i in range(5)]
+        Dataset.objects.create(name='other.npy')
+        for dataset in self.datasets:
+            FileRecord.objects.create(dataset=dataset, data_repository=self.repo,
+                                      relative_path='a/%s' % dataset.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _load_npy(self, f, table):
+        with zipfile.ZipFile(f) as zf:
+            return {op.splitext(name)[0][len(table) + 1:]: np.load(zf.open(name))
+                    for name in zf.namelist()}
+
+    def test_export_npy(self):
+        f = io.BytesIO()
+        with mock.patch.object(QuerySet, 'iterator', autospec=True,
+                               side_effect=QuerySet.iterator) as iterator:
+            n = export_table('datasets', f, 'npy', params={'subject': 'export_subject'},
+                             chunk_size=2)
+        self.assertEqual(n, 5)
+        # the rows are fetched with values_list() in chunks
+        self.assertEqual(iterator.call_args[1], {'chunk_size': 2})
+        arrays = self._load_npy(f, 'datasets')
+        self.assertEqual(list(arrays), list(EXPORT_TABLES['datasets'][2]))
+        order = np.argsort(arrays['file_size'])
+        self.assertEqual(list(arrays['name'][order]), [d.name for d in self.datasets])
+        self.assertTrue(np.all(arrays['subject'] == 'export_subject'))
+        self.assertTrue(np.all(arrays['experiment_number'] == 3))
+        self.assertTrue(np.all(arrays['session'] == str(self.session.pk)))
+        self.assertEqual(arrays['created_datetime'].dtype, np.dtype('datetime64[us]'))
+        self.assertFalse(np.any(np.isnat(arrays['session_start_time'])))
+        self.assertTrue(np.all(arrays['md5'] == ''))
+
+    def test_export_npy_string_width(self):
+        # the strings of the chunks are written with the width of the longest one
+        self.datasets[-1].name = 'a.longer_name.npy'
+        self.datasets[-1].save()
+        f = io.BytesIO()
+        n = export_table('datasets', f, 'npy', params={'subject': 'export_subject'},
+                         chunk_size=2)
+        self.assertEqual(n, 5)
+        arrays = self._load_npy(f, 'datasets')
+        self.assertEqual(arrays['name'].dtype, np.dtype('<U17'))
+        self.assertEqual(sorted(arrays['name']), sorted(d.name for d in self.datasets))
+        self.assertEqual(sorted(arrays['file_size']), list(range(5)))
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "requires pyarrow")
+    def test_export_parquet_arrow(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        path = op.join(self.tmpdir.name, 'sessions.parquet')
+        call_command('export_table', 'sessions', path, '--chunk-size', '1',
+                     '--filter', 'subject=export_subject', stdout=io.StringIO())
+        table = pq.read_table(path)
+        self.assertEqual(table.column_names, list(EXPORT_TABLES['sessions'][2]))
+        self.assertEqual(table.column('id').to_pylist(), [str(self.session.pk)])
+        self.assertEqual(table.column('number').to_pylist(), [3])
+        self.assertEqual(table.column('start_time').to_pylist(), [self.session.start_time])
+        f = io.BytesIO()
+        self.assertEqual(export_table('files', f, 'arrow', chunk_size=2), 5)
+        f.seek(0)
+        reader = pa.ipc.open_file(f)
+        self.assertEqual(reader.num_record_batches, 3)
+        table = reader.read_all()
+        self.assertEqual(sorted(table.column('relative_path').to_pylist()),
+                         sorted('a/%s' % d.name for d in self.datasets))
+
+    def test_export_npy_empty(self):
+        f = io.BytesIO()
+        self.assertEqual(export_table('files', f, 'npy', params={'exists': 'true'}), 0)
+        arrays = self._load_npy(f, 'files')
+        self.assertEqual(arrays['id'].shape, (0,))
+        self.assertEqual(arrays['exists'].dtype, np.bool_)
+
+    def test_export_errors(self):
+        with self.assertRaises(ValueError):
+            export_table('subjects', io.BytesIO(), 'npy')
+        with self.assertRaises(ValueError):
+            export_table('datasets', io.BytesIO(), 'csv')
+        with self.assertRaises(ValueError):
+            export_table('sessions', io.BytesIO(), 'npy', params={'performance_gte': 'x'})
+
+    def test_export_table_command(self):
+        path = op.join(self.tmpdir.name, 'files.zip')
+        out = io.StringIO()
+        call_command('export_table', 'files', path, '--filter',
+                     'dataset=%s' % self.datasets[0].pk, stdout=out)
+        self.assertIn('Exported 1 files', out.getvalue())
+        with open(path, 'rb') as f:
+            arrays = self._load_npy(f, 'files')
+        self.assertEqual(list(arrays['relative_path']), ['a/a.0.npy'])
+        self.assertEqual(list(arrays['data_repository']), ['export_repo'])
+        with self.assertRaises(CommandError):
+            call_command('export_table', 'files', op.join(self.tmpdir.name, 'files.csv'))
+
+
+class BulkSyncTests(TestCase):
+    def setUp(self):
+        clear_globus_cache()
+        self.lab = Lab.objects.create(name='synclab')
+        self.subject = Subject.objects.create(nickname='syncboy', lab=self.lab)
+        self.session = Session.objects.create(subject=self.subject, number=1)
+        self.endpoints = [uuid.uuid4(), uuid.uuid4(), uuid.uuid4()]
+        self.repos = [
+            DataRepository.objects.create(
+                name='repo%d' % i, globus_path='/mnt/repo%d/' % i, globus_endpoint_id=ep,
+                globus_is_personal=False)
+            for i, ep in enumerate(self.endpoints)]
+        self.lab.repositories.add(*self.repos)
+        dt = DatasetType.objects.create(name='spikes.times', filename_pattern='spikes.times.*')
+        df = DataFormat.objects.create(name='npy', file_extension='.npy')
+        self.datasets = []
+        for i in range(6):
+            dataset = Dataset.objects.create(
+                name='spikes.times.npy', session=self.session, dataset_type=dt, data_format=df)
+            self.datasets.append(dataset)
+            for repo in self.repos:
+                FileRecord.objects.create(
+                    dataset=dataset, data_repository=repo,
+                    relative_path='syncboy/2019-01-01/%03d/spikes.times.%d.npy' % (i // 2, i))
+
+    def test_bulk_sync(self):
+        files = {ep: {} for ep in self.endpoints}
+        # on the first endpoint, the files of all directories exist, one with the UUID
+        for fr in FileRecord.objects.filter(data_repository=self.repos[0]):
+            path = '/mnt/repo0/' + fr.relative_path
+            if fr.dataset == self.datasets[0]:
+                path = _add_uuid_to_filename(path, fr.dataset.pk)
+            files[self.endpoints[0]][path] = 1234
+        # on the second endpoint, no file exists
+        # the third endpoint is not connected
+        gc = FakeTransferClient(files, disconnected=[self.endpoints[2]])
+
+        report = bulk_sync(gc=gc, lab='synclab', n_threads=2, chunk_size=2)
+
+        # one listing per directory and connected endpoint, one endpoint query per endpoint
+        calls = [c[0] for c in gc.calls]
+        self.assertEqual(calls.count('get_endpoint'), 3)
+        self.assertEqual(calls.count('operation_ls'), 6)
+        self.assertEqual(sorted(r['endpoint'] for r in report),
+                         sorted(str(ep) for ep in self.endpoints[:2]))
+        for r in report:
+            self.assertEqual((r['directories'], r['files']), (3, 6))
+        # the listed files exist, the file size of the datasets has been set
+        for fr in FileRecord.objects.all():
+            self.assertEqual(fr.exists, fr.data_repository == self.repos[0])
+        for dataset in Dataset.objects.filter(session=self.session):
+            self.assertEqual(dataset.file_size, 1234)
+            # the files of the other main repositories are missing
+            self.assertFalse(dataset.has_remote_copy)
+        for repo in self.repos[1:]:
+            repo.globus_is_personal = True
+            repo.save()
+        for dataset in Dataset.objects.filter(session=self.session):
+            self.assertTrue(dataset.has_remote_copy)
+
+
+class ScanRepositoryTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.repo = DataRepository.objects.create(name='mounted', globus_is_personal=False)
+        self.file_records = []
+        for i in range(4):
+            dataset = Dataset.objects.create(name='spikes.times.npy')
+            self.file_records.append(FileRecord.objects.create(
+                dataset=dataset, data_repository=self.repo, exists=i == 3,
+                relative_path='scanboy/2019-01-01/%03d/alf/spikes.times.npy' % i))
+        # the first file on disk has the dataset UUID, the last one is missing
+        for i, fr in enumerate(self.file_records[:3]):
+            path = op.join(self.root, fr.relative_path)
+            if i == 0:
+                path = _add_uuid_to_filename(path, fr.dataset_id)
+            os.makedirs(op.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(b'0' * (10 + i))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _check(self):
+        for i, fr in enumerate(self.file_records):
+            fr = FileRecord.objects.select_related('dataset').get(pk=fr.pk)
+            self.assertEqual(fr.exists, i < 3)
+            self.assertEqual(fr.dataset.file_size, 10 + i if i < 3 else None)
+
+    def test_scan_repository(self):
+        report = scan_repository(self.repo, root=self.root, n_threads=2)
+        # 1 + 1 + 1 + 3 * 2 directories
+        self.assertEqual(report['directories'], 9)
+        self.assertEqual(report['files'], 3)
+        self.assertEqual((report['file_records'], report['datasets']), (4, 3))
+        self._check()
+
+    def test_scan_repository_path_variants(self):
+        prefixes = ('Data2/', '/', '')
+        for prefix, fr in zip(prefixes, self.file_records):
+            fr.relative_path = prefix + fr.relative_path
+            if not prefix:
+                fr.relative_path = fr.relative_path.replace('/', '\\')
+            fr.save()
+        report = scan_repository(self.repo, root=self.root, n_threads=2)
+        self.assertEqual((report['file_records'], report['datasets']), (4, 3))
+        self._check()
+
+    def test_scan_repository_resume(self):
+        checkpoint = op.join(self.root, 'scan.json')
+        reconcile = transfers._reconcile_directories
+        calls = []
+
+        def interrupted(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 5:
+                raise KeyboardInterrupt()
+            return reconcile(*args, **kwargs)
+
+        with mock.patch('data.transfers._reconcile_directories', side_effect=interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                scan_repository(self.repo, root=self.root, batch_size=1, checkpoint=checkpoint)
+        self.assertTrue(op.exists(checkpoint))
+        report = scan_repository(self.repo, root=self.root, batch_size=1, checkpoint=checkpoint)
+        self.assertEqual(report['directories'], 9)
+        self.assertFalse(op.exists(checkpoint))
+        self._check()
+
+
+class ChecksumRepositoryTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.repos = [DataRepository.objects.create(name='mounted%d' % i) for i in range(2)]
+        self.datasets = [Dataset.objects.create(name='d%d.npy' % i) for i in range(3)]
+        self.contents = [b'', b'abc' * 1000, b'0' * (1 << 20)]
+        self.expected = [uuid.UUID(hashlib.md5(c).hexdigest()) for c in self.contents]
+        for repo in self.repos:
+            for i, (dataset, content) in enumerate(zip(self.datasets, self.contents)):
+                relative_path = '%s/d%d.npy' % (repo.name, i)
+                FileRecord.objects.create(dataset=dataset, data_repository=repo,
+                                          relative_path=relative_path, exists=True)
+                path = op.join(self.root, relative_path)
+                if i == 1:
+                    path = _add_uuid_to_filename(path, dataset.pk)
+                os.makedirs(op.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    # the copy of the last dataset on the second repository is corrupt
+                    f.write(content + (b'1' if repo == self.repos[1] and i == 2 else b''))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_checksum_repository(self):
+        report = checksum_repository(self.repos[0], root=self.root, n_processes=2)
+        self.assertEqual((report['files'], report['stored'], report['mismatches']), (3, 3, []))
+        self.assertEqual(report['bytes'], sum(len(c) for c in self.contents))
+        for dataset, md5 in zip(self.datasets, self.expected):
+            dataset.refresh_from_db()
+            self.assertEqual(dataset.md5, md5)
+
+        checkpoint = op.join(self.root, 'checksum.json')
+        report = checksum_repository(self.repos[1], root=self.root, n_processes=2,
+                                     batch_size=2, checkpoint=checkpoint)
+        corrupt = FileRecord.objects.get(data_repository=self.repos[1], dataset=self.datasets[2])
+        self.assertEqual(report['mismatches'], [str(corrupt.pk)])
+        self.assertEqual(report['stored'], 0)
+        self.assertIn('md5_mismatch', corrupt.json)
+        self.assertFalse(op.exists(checkpoint))
+
+        # the flag is removed once the copy has been repaired
+        with open(op.join(self.root, corrupt.relative_path), 'wb') as f:
+            f.write(self.contents[2])
+        report = checksum_repository(self.repos[1], root=self.root, n_processes=2)
+        self.assertEqual(report['mismatches'], [])
+        corrupt.refresh_from_db()
+        self.assertIsNone(corrupt.json)
+
+    def test_checksum_repository_rate(self):
+        # the rate is limited on the size of the files on disk, the file sizes of the
+        # datasets are unknown
+        with mock.patch.object(RateLimiter, 'wait', autospec=True) as wait:
+            report = checksum_repository(self.repos[0], root=self.root, n_processes=2)
+        self.assertEqual(sorted(c[0][1] for c in wait.call_args_list),
+                         sorted(len(c) for c in self.contents))
+        self.assertEqual(report['bytes'], sum(len(c) for c in self.contents))
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=1)
+        t0 = time.perf_counter()
+        limiter.wait(100000)
+        limiter.wait(100000)
+        self.assertGreaterEqual(time.perf_counter() - t0, .09)
+
+
+class SyncManifestTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        repos = [DataRepository.objects.create(name='repo%d' % i, globus_path='/mnt/repo%d' % i)
+                 for i in range(2)]
+        dataset = Dataset.objects.create(name='a.npy')
+        paths = ('sub/001/a.npy', 'sub/002/a.npy', 'Data2/sub/003/a.npy', 'sub\\004\\a.npy')
+        self.file_records = [
+            FileRecord.objects.create(dataset=dataset, data_repository=repo, relative_path=p)
+            for repo in repos for p in paths]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _manifest(self, lines, compress=False):
+        path = op.join(self.tmpdir.name, 'manifest.txt' + ('.gz' if compress else ''))
+        with (gzip.open(path, 'wt') if compress else open(path, 'w')) as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def _existing(self):
+        return [fr.exists for fr in FileRecord.objects.filter(
+            pk__in=[fr.pk for fr in self.file_records]).order_by(
+            'data_repository__name', 'relative_path')]
+
+    def test_sync_manifest(self):
+        lines = ['/mnt/repo0/sub/001/a.npy', '/mnt/repo0/sub/003/a.npy',
+                 '/mnt/repo0/sub/004/a.npy', '/mnt/repo1/sub/002/a.npy',
+                 '/mnt/repo1/sub/005/a.npy', '/elsewhere/sub/001/a.npy', '']
+        path = self._manifest(lines)
+        report = sync_manifest(path, chunk_size=2, dry_run=True)
+        self.assertEqual(report, {'paths': 6, 'matched': 4, 'updated': 4, 'unmatched': 2})
+        self.assertFalse(any(self._existing()))
+        path = self._manifest(lines, compress=True)
+        report = sync_manifest(path, chunk_size=2)
+        self.assertEqual(report, {'paths': 6, 'matched': 4, 'updated': 4, 'unmatched': 2})
+        # ordered by repository and relative path
+        self.assertEqual(self._existing(), [True, True, False, True,
+                                            False, False, True, False])
+        # the paths of the existing file records are matched, but not updated again
+        report = sync_manifest(path, chunk_size=2)
+        self.assertEqual(report, {'paths': 6, 'matched': 4, 'updated': 0, 'unmatched': 2})
+
+
+class AutoregisterTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        lab = Lab.objects.create(name='crawllab')
+        self.subject = Subject.objects.create(nickname='crawlboy', lab=lab)
+        self.session = Session.objects.create(
+            subject=self.subject, number=1, start_time='2019-01-01T12:00:00')
+        self.endpoint = uuid.uuid4()
+        self.repo = DataRepository.objects.create(
+            name='crawled', globus_path='/data/', globus_endpoint_id=self.endpoint)
+        self.main = DataRepository.objects.create(name='crawlmain', globus_path='/main/')
+        lab.repositories.add(self.repo, self.main)
+        DatasetType.objects.create(name='spikes.times', filename_pattern='spikes.times.*')
+        DataFormat.objects.create(name='npy', file_extension='.npy')
+        self.files = {self.endpoint: {p: 1 for p in (
+            '/data/crawlboy/2019-01-01/001/session.metadata.json',
+            '/data/crawlboy/2019-01-01/001/alf/spikes.times.npy',
+            '/data/crawlboy/2019-01-01/001/alf/probe00/spikes.times.npy',
+            '/data/crawlboy/2019-01-01/001/alf/unknown.xyz',
+            '/data/crawlboy/2019-01-01/002/alf/spikes.times.npy',
+            '/data/other/spikes.times.npy',
+        )}}
+        # all directories: /data, crawlboy, 2019-01-01, 001, 001/alf, 001/alf/probe00, 002,
+        # 002/alf, other
+        self.n_directories = 9
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_autoregister(self):
+        # the listing of a directory fails twice then succeeds, another one always fails
+        gc = FakeTransferClient(self.files, failures={
+            '/data/crawlboy/2019-01-01': 2, '/data/other': 10})
+        report = autoregister(self.repo, tc=gc, n_threads=2, backoff=0)
+        self.assertEqual(report, {'directories': self.n_directories - 1, 'registered': 2,
+                                  'files': 2, 'errors': []})
+        frs = FileRecord.objects.filter(dataset__session=self.session)
+        self.assertEqual(sorted((fr.data_repository.name, fr.relative_path, fr.exists)
+                                for fr in frs), [
+            ('crawled', 'crawlboy/2019-01-01/001/alf/probe00/spikes.times.npy', True),
+            ('crawled', 'crawlboy/2019-01-01/001/alf/spikes.times.npy', True),
+            ('crawlmain', 'crawlboy/2019-01-01/001/alf/probe00/spikes.times.npy', False),
+            ('crawlmain', 'crawlboy/2019-01-01/001/alf/spikes.times.npy', False),
+        ])
+
+    def test_crawl_resume(self):
+        gc = FakeTransferClient(self.files)
+        checkpoint = op.join(self.tmpdir.name, 'crawl.json')
+        crawl = crawl_directories(self.repo, tc=gc, n_threads=1, checkpoint=checkpoint)
+        # interrupted in the second batch of 4 directories
+        crawled = [d for d, _, _ in itertools.islice(crawl, 5)]
+        crawl.close()
+        self.assertTrue(op.exists(checkpoint))
+        resumed = list(crawl_directories(self.repo, tc=gc, n_threads=1, checkpoint=checkpoint))
+        self.assertEqual(resumed[0][0], crawled[4])
+        self.assertEqual(len(set(crawled[:4]) | set(d for d, _, _ in resumed)),
+                         self.n_directories)
+        self.assertFalse(op.exists(checkpoint))
+        sessions = {d: s for d, _, s in resumed}
+        self.assertEqual(sessions['/data/crawlboy/2019-01-01/001/alf'],
+                         '/data/crawlboy/2019-01-01/001')
+        self.assertIsNone(sessions['/data/crawlboy/2019-01-01/002/alf'])
+
+
+class BulkTransferTests(TestCase):
+    def setUp(self):
+        lab = Lab.objects.create(name='transferlab')
+        subject = Subject.objects.create(nickname='transferboy', lab=lab)
+        session = Session.objects.create(subject=subject, number=1)
+        self.main = DataRepository.objects.create(
+            name='main', globus_path='/main/', globus_endpoint_id=uuid.uuid4(),
+            globus_is_personal=False)
+        self.locals = [DataRepository.objects.create(
+            name='local%d' % i, globus_path='/local%d/' % i, globus_endpoint_id=uuid.uuid4(),
+            globus_is_personal=True) for i in range(2)]
+        lab.repositories.add(self.main, *self.locals)
+        for i in range(7):
+            dataset = Dataset.objects.create(name='d%d' % i, session=session, file_size=100)
+            path = 'transferboy/2019-01-01/001/d%d.npy' % i
+            FileRecord.objects.create(dataset=dataset, data_repository=self.main,
+                                      relative_path=path, exists=i == 6)
+            # the first 4 files only exist on the first local repository
+            FileRecord.objects.create(dataset=dataset, data_repository=self.locals[0],
+                                      relative_path=path, exists=i < 4)
+            FileRecord.objects.create(dataset=dataset, data_repository=self.locals[1],
+                                      relative_path=path, exists=i >= 3)
+
+    def test_bulk_transfer_dry(self):
+        with self.assertNumQueries(2):
+            report = bulk_transfer(dry_run=True, lab='transferlab', max_files=2)
+        self.assertEqual(report, [
+            {'source_data_repository': 'local0', 'destination_data_repository': 'main',
+             'files': 4, 'bytes': 400, 'tasks': 2},
+            {'source_data_repository': 'local1', 'destination_data_repository': 'main',
+             'files': 2, 'bytes': 200, 'tasks': 1},
+        ])
+        report = bulk_transfer(dry_run=True, lab='transferlab', max_bytes=250)
+        self.assertEqual([r['tasks'] for r in report], [2, 1])
+
+    def test_bulk_transfer_failed_submission(self):
+        class SubmitClient(FakeTransferClient):
+            def submit_transfer(self, tdata):
+                self._log('submit_transfer', tdata['label'])
+                if tdata['label'] == 'local0 to main (2/2)':
+                    raise globus_sdk.GlobusError("Submission failed")
+                return {'task_id': str(uuid.uuid4()), 'message': 'submitted'}
+
+        gc = SubmitClient()
+        with mock.patch('data.transfers._transfer_data',
+                        side_effect=lambda gc, src, dst, files, label: {'label': label}), \
+                self.assertRaises(globus_sdk.GlobusError):
+            bulk_transfer(lab='transferlab', gc=gc, max_files=2, n_threads=3)
+        self.assertEqual(len(gc.calls), 3)
+        # the tasks submitted before or after the failure are recorded
+        self.assertEqual(TransferTask.objects.count(), 2)
+        report = bulk_transfer(dry_run=True, lab='transferlab', max_files=2)
+        self.assertEqual([r['files'] for r in report], [2])
+
+    def test_transfer_tasks(self):
+        plan = _plan_bulk_transfer(lab='transferlab')
+        (src_repo, dst_repo), files = list(plan.items())[0]
+        task_ids = [str(uuid.uuid4()) for _ in range(3)]
+        tasks = _record_transfer_tasks([
+            (src_repo, dst_repo, files[:2], {'task_id': task_ids[0]}),
+            (src_repo, dst_repo, files[2:3], {'task_id': task_ids[1]}),
+            (src_repo, dst_repo, files[3:], {'task_id': task_ids[2]}),
+        ])
+        self.assertEqual([t.bytes for t in tasks], [200, 100, 100])
+        self.assertEqual(TransferTask.objects.get(task_id=task_ids[0]).file_records.count(), 2)
+        # the files being transferred are not planned again
+        report = bulk_transfer(dry_run=True, lab='transferlab')
+        self.assertEqual([r['files'] for r in report], [2])
+
+        gc = FakeTransferClient(tasks={
+            task_ids[0]: {'status': 'SUCCEEDED', 'bytes_transferred': 200,
+                          'completion_time': '2019-01-01T00:00:00+00:00'},
+            task_ids[1]: {'status': 'FAILED', 'bytes_transferred': 0},
+            task_ids[2]: {'status': 'ACTIVE', 'bytes_transferred': 50},
+        })
+        counts = poll_transfer_tasks(gc=gc, batch_size=2)
+        self.assertEqual(counts, {'SUCCEEDED': 1, 'FAILED': 1, 'ACTIVE': 1})
+        self.assertEqual([c[0] for c in gc.calls], ['task_list', 'task_list'])
+        # the files of the succeeded task exist
+        for fr in files[:2]:
+            self.assertTrue(FileRecord.objects.get(pk=fr[1].pk).exists)
+            self.assertTrue(Dataset.objects.get(pk=fr[1].dataset_id).has_remote_copy)
+        self.assertFalse(FileRecord.objects.get(pk=files[2][1].pk).exists)
+        task = TransferTask.objects.get(task_id=task_ids[0])
+        self.assertEqual(task.bytes_transferred, 200)
+        self.assertIsNotNone(task.completion_datetime)
+        # the file of the failed task is planned again, the one in flight is not
+        report = bulk_transfer(dry_run=True, lab='transferlab')
+        self.assertEqual([r['files'] for r in report], [1, 2])
+        # only the task in flight is polled again
+        gc.calls = []
+        self.assertEqual(poll_transfer_tasks(gc=gc), {'ACTIVE': 1})
+        self.assertEqual(len(gc.calls), 1)
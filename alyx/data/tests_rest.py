@@ -1,11 +1,21 @@
 import datetime
+import io
+import json
 import os.path as op
+from unittest import mock
+import uuid
+import zipfile
 
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+import numpy as np
 
-from alyx.base import BaseTests
-from data.models import Dataset, FileRecord, Download
+from alyx.base import BaseTests, ValuesSerializer
+from data.models import DataRepository, Dataset, FileRecord, Download
+from data.views import DatasetList
+from misc.jobs import run_jobs
 
 
 class APIDataTests(BaseTests):
@@ -155,6 +165,198 @@ class APIDataTests(BaseTests):
                                         '%Y-%m-%dT%H:%M:%S') for d in self.ar(r)]
         self.assertTrue(max(a) <= datetime.datetime(2018, 1, 1))
 
+    def test_dataset_cursor_pagination(self):
+        Dataset.objects.all().delete()
+        dates = ([datetime.datetime(2018, 1, 1, 12, 0, 0, 123456)] * 5 + [None] * 2 +
+                 [datetime.datetime(2017, 1, i, 12) for i in range(1, 4)])
+        datasets = [Dataset.objects.create(name='d%d' % i, created_datetime=d)
+                    for i, d in enumerate(dates)]
+        url = reverse('dataset-list') + '?cursor=&limit=3&count=exact'
+        pages = []
+        while url:
+            r = self.client.get(url)
+            d = self.ar(r)
+            self.assertIsNone(r.data['previous'])
+            pages.append([_['url'][-36:] for _ in d])
+            if len(pages) == 1:
+                self.assertEqual(r.data['count'], len(dates))
+                # a dataset inserted before the cursor does not shift the next pages
+                Dataset.objects.create(name='new', created_datetime=datetime.datetime(2016, 1, 1))
+            url = r.data['next']
+        self.assertEqual([len(page) for page in pages], [3, 3, 3, 1])
+        ids = [pk for page in pages for pk in page]
+        # ordered by created_datetime with the null dates last, then by id
+        expected = sorted(datasets, key=lambda d: (d.created_datetime is None,
+                                                   d.created_datetime or 0, str(d.pk)))
+        self.assertEqual(ids, [str(d.pk) for d in expected])
+        # the count is not computed by default
+        r = self.client.get(reverse('dataset-list') + '?cursor=')
+        self.assertIsNone(r.data['count'])
+        self.assertEqual(len(self.ar(r)), len(dates) + 1)
+        r = self.client.get(reverse('dataset-list') + '?cursor=invalid')
+        self.assertEqual(r.status_code, 404)
+
+    def test_filerecord_cursor_pagination(self):
+        repo = DataRepository.objects.create(name='cursor')
+        dataset = Dataset.objects.create(name='d')
+        frs = [FileRecord.objects.create(dataset=dataset, data_repository=repo,
+                                         relative_path='cursor/%d' % i) for i in range(5)]
+        url = reverse('filerecord-list') + '?cursor=&limit=2'
+        ids = []
+        while url:
+            with CaptureQueriesContext(connection) as ctx:
+                r = self.client.get(url)
+            ids.extend(fr['url'][-36:] for fr in self.ar(r))
+            url = r.data['next']
+            # the pages are ordered and filtered on the primary key only, which the
+            # primary key index serves
+            sql = [q['sql'] for q in ctx if 'FROM "data_filerecord"' in q['sql']][0]
+            self.assertRegex(sql, r'ORDER BY "data_filerecord"."id" ASC\s+LIMIT 3$')
+        self.assertEqual(ids, sorted(str(fr.pk) for fr in frs))
+
+    def test_dataset_sparse_fields(self):
+        data = {'name': 'sparse-dataset', 'dataset_type': 'dst', 'created_by': 'test',
+                'subject': self.subject, 'data_format': 'df', 'date': '2018-01-01',
+                'number': 2, 'file_size': 1234}
+        self.ar(self.client.post(reverse('dataset-list'), data), 201)
+        url = reverse('dataset-list') + '?name=sparse-dataset'
+        d = self.ar(self.client.get(url + '&fields=url,name,file_size'))
+        self.assertEqual(d, [{'url': d[0]['url'], 'name': 'sparse-dataset', 'file_size': 1234}])
+        full = self.ar(self.client.get(url))[0]
+        d = self.ar(self.client.get(url + '&exclude=file_records,session'))[0]
+        self.assertEqual(set(d), set(full) - {'file_records', 'session'})
+        # the file records are not prefetched when they are not requested
+        with CaptureQueriesContext(connection) as full_queries:
+            self.client.get(url)
+        n_full = len(full_queries)
+        with CaptureQueriesContext(connection) as sparse_queries:
+            self.client.get(url + '&exclude=file_records')
+        self.assertLess(len(sparse_queries), n_full)
+        d = self.ar(self.client.get(d['url'] + '?fields=name,md5'))
+        self.assertEqual(set(d), {'name', 'md5'})
+
+    def test_dataset_list_queries(self):
+        def _create(start, stop):
+            for i in range(start, stop):
+                data = {'name': 'n1-%d' % i, 'dataset_type': 'dst', 'created_by': 'test',
+                        'subject': self.subject, 'data_format': 'df', 'date': '2018-01-01'}
+                dataset = self.ar(self.client.post(reverse('dataset-list'), data), 201)
+                FileRecord.objects.create(
+                    dataset_id=dataset['url'][-36:], data_repository=repo, exists=True,
+                    relative_path='n1/%d' % i)
+
+        repo = DataRepository.objects.create(name='n1', data_url='http://n1/')
+        url = reverse('dataset-list') + '?limit=100&dataset_type=dst'
+        _create(0, 2)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url)
+        n_queries = len(ctx)
+        _create(2, 10)
+        with self.assertNumQueries(n_queries):
+            d = self.ar(self.client.get(url))
+        self.assertEqual(len(d), 10)
+        self.assertTrue(all(fr['data_url'].startswith('http://n1/n1/')
+                            for ds in d for fr in ds['file_records']))
+
+    def test_values_serializers(self):
+        repo = DataRepository.objects.create(name='vs', data_url='http://vs/', globus_path='/vs/')
+        for i in range(3):
+            data = {'name': 'vs-%d' % i, 'dataset_type': 'dst', 'created_by': 'test',
+                    'subject': self.subject, 'data_format': 'df', 'date': '2018-01-01',
+                    'number': 2, 'file_size': i}
+            if i:
+                data['md5'] = str(uuid.uuid4())
+            dataset = self.ar(self.client.post(reverse('dataset-list'), data), 201)
+            for j in range(i):
+                FileRecord.objects.create(
+                    dataset_id=dataset['url'][-36:], data_repository=repo, exists=bool(j),
+                    relative_path='vs/%d/%d' % (i, j), json={'j': j})
+        # the rows are in the same order with both serializers, including the ties
+        Dataset.objects.filter(name='vs-1').update(
+            created_datetime=Dataset.objects.get(name='vs-2').created_datetime)
+        urls = [
+            reverse('dataset-list'),
+            reverse('dataset-list') + '?dataset_type=dst&limit=2&offset=1',
+            reverse('dataset-list') + '?fields=url,file_records,experiment_number',
+            reverse('dataset-list') + '?cursor=&limit=2',
+            reverse('dataset-list') + '?stream=ndjson',
+            reverse('filerecord-list'),
+            reverse('filerecord-list') + '?exists=true',
+        ]
+        for url in urls:
+            with mock.patch.object(ValuesSerializer, 'represent', autospec=True,
+                                   side_effect=ValuesSerializer.represent) as represent:
+                r = self.client.get(url)
+                fast = b''.join(r.streaming_content) if r.streaming else r.content
+            self.assertTrue(represent.called)
+            with self.settings(FAST_LIST_SERIALIZERS=False):
+                r = self.client.get(url)
+                slow = b''.join(r.streaming_content) if r.streaming else r.content
+            self.assertEqual(fast, slow)
+        # the next page of a keyset pagination
+        d = self.client.get(reverse('dataset-list') + '?cursor=&limit=2').data
+        self.assertEqual(len(self.client.get(d['next']).data['results']), 1)
+
+    def test_dataset_stream(self):
+        for i in range(3):
+            data = {'name': 'stream-%d' % i, 'dataset_type': 'dst', 'created_by': 'test',
+                    'subject': self.subject, 'data_format': 'df', 'date': '2018-01-01',
+                    'number': 2, 'file_size': i}
+            self.ar(self.client.post(reverse('dataset-list'), data), 201)
+        url = reverse('dataset-list') + '?limit=100000'
+        expected = {d['url']: d for d in self.ar(self.client.get(url))}
+        # json array, serialized in chunks of two datasets
+        with mock.patch.object(DatasetList, 'stream_chunk_size', 2):
+            r = self.client.get(url + '&stream=json')
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.streaming)
+        d = json.loads(b''.join(r.streaming_content))
+        self.assertEqual({_['url']: _ for _ in d}, expected)
+        # newline-delimited json, with the filters and sparse fields of the list
+        r = self.client.get(url + '&stream=ndjson&name=stream-1&fields=name,file_size')
+        self.assertEqual(r['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(r.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         [{'name': 'stream-1', 'file_size': 1}])
+        # empty list
+        r = self.client.get(url + '&stream=json&name=nothing')
+        self.assertEqual(json.loads(b''.join(r.streaming_content)), [])
+        self.assertEqual(self.client.get(url + '&stream=xml').status_code, 404)
+
+    def test_columnar_export(self):
+        data = {'name': 'export-dataset', 'dataset_type': 'dst', 'created_by': 'test',
+                'subject': self.subject, 'data_format': 'df', 'date': '2018-01-01',
+                'number': 2, 'file_size': 1234}
+        self.ar(self.client.post(reverse('dataset-list'), data), 201)
+        url = reverse('columnar-export', args=['datasets', 'npy'])
+        r = self.client.get(url, data={'dataset_type': 'dst'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r['Content-Type'], 'application/zip')
+        self.assertIn('datasets.zip', r['Content-Disposition'])
+        with zipfile.ZipFile(io.BytesIO(b''.join(r.streaming_content))) as zf:
+            names = np.load(zf.open('datasets.name.npy'))
+            types = np.load(zf.open('datasets.dataset_type.npy'))
+        self.assertEqual(list(names), ['export-dataset'])
+        self.assertEqual(list(types), ['dst'])
+        r = self.client.get(reverse('columnar-export', args=['datasets', 'csv']))
+        self.assertEqual(r.status_code, 404)
+        r = self.client.get(url, data={'created_datetime_gte': 'notadate'})
+        self.assertEqual(r.status_code, 400)
+
+    def test_sync_file_status(self):
+        url = reverse('sync-file-status')
+        self.assertEqual(self.client.get(url).status_code, 404)
+        # the synchronization is enqueued, a second request returns the same pending job
+        d = self.ar(self.client.post(url), 202)
+        self.assertEqual(d['status'], 'PENDING')
+        self.assertEqual(self.ar(self.client.post(url), 202)['id'], d['id'])
+        report = [{'endpoint': 'ep', 'directories': 1, 'files': 2}]
+        with mock.patch('data.transfers.bulk_sync', return_value=report) as bulk_sync:
+            run_jobs()
+        bulk_sync.assert_called_once_with()
+        d = self.ar(self.client.get(url), 200)
+        self.assertEqual((d['status'], d['progress'], d['result']), ('SUCCEEDED', 1., report))
+
     def test_register_files(self):
         # create 4 repositories, 2 per lab
         self.client.post(reverse('datarepository-list'), {'name': 'dra1', 'hostname': 'hosta1'})
@@ -239,6 +441,41 @@ class APIDataTests(BaseTests):
         self.ar(r, 201)
         self._assert_registration(r, data)
 
+    def test_register_files_bulk(self):
+        # the number of queries does not depend on the number of files
+        data = {'path': '%s/2018-01-01/2/dir' % self.subject,
+                'filenames': 'a.a.e1',
+                'name': 'dr',
+                }
+        self.ar(self.client.post(reverse('register-file'), data), 201)
+        data['filenames'] = 'a.b.e1'
+        with CaptureQueriesContext(connection) as ctx:
+            self.ar(self.client.post(reverse('register-file'), data), 201)
+        n = len(ctx.captured_queries)
+        data['filenames'] = 'a.c.e1,a.c.e2,a.d.e1,a.d.e2'
+        with CaptureQueriesContext(connection) as ctx:
+            r = self.client.post(reverse('register-file'), data)
+        self.ar(r, 201)
+        self.assertEqual(len(ctx.captured_queries), n)
+        self.assertEqual([d['name'] for d in r.data], data['filenames'].split(','))
+        self.assertEqual([d['dataset_type'] for d in r.data], ['a.c', 'a.c', 'a.d', 'a.d'])
+
+        # registering again the same files does not duplicate them
+        data['filenames'] = 'a.a.e1,a.b.e1'
+        r = self.client.post(reverse('register-file'), data)
+        self.ar(r, 201)
+        self.assertEqual(Dataset.objects.filter(name__in=('a.a.e1', 'a.b.e1')).count(), 2)
+        self.assertEqual(FileRecord.objects.filter(
+            dataset__name__in=('a.a.e1', 'a.b.e1')).count(), 2)
+        for d in r.data:
+            self.assertEqual(len(d['file_records']), 1)
+
+        # nothing is registered if one of the files is invalid
+        data['filenames'] = 'a.a.e2,b.b.e1'
+        with self.assertRaises(ValueError):
+            self.client.post(reverse('register-file'), data)
+        self.assertFalse(Dataset.objects.filter(name='a.a.e2').exists())
+
     def _assert_registration(self, r, data):
         d0, d1 = r.data
         self.assertEqual(d0['name'], 'a.b.e1')
@@ -1,16 +1,31 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import functools
+import gzip
+import hashlib
 import json
 import logging
+import mmap
+from operator import itemgetter, or_
 import os
 import os.path as op
 import re
-
-from django.db.models import Case, When, Count, Q
+import threading
+import time
+import uuid
+
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import transaction
+from django.db.models import Q, prefetch_related_objects
+from django.utils.dateparse import parse_datetime
 import globus_sdk
-import numpy as np
 
 from alyx import settings
-from data.models import FileRecord, Dataset, DatasetType, DataFormat, DataRepository
+from data.models import (
+    FileRecord, Dataset, DatasetType, DataFormat, DataRepository, TransferTask,
+    update_dataset_completeness)
 from actions.models import Session
+from misc.jobs import report_progress
 
 logger = logging.getLogger(__name__)
 
@@ -59,45 +74,149 @@ def get_globus_transfer_rt():
         return json.load(f).get('transfer_rt', None)
 
 
-def globus_transfer_client():
-    transfer_rt = get_globus_transfer_rt()
-    if not transfer_rt:
-        create_globus_token()
+_transfer_client = None
+_transfer_client_lock = threading.Lock()
+
+
+def globus_transfer_client(new=False):
+    """Return the transfer client shared by all functions of the process.
+
+    The refresh token is read once, the access tokens are renewed by the authorizer.
+    Pass `new=True` to create a new client, after a new login for example.
+
+    """
+    global _transfer_client
+    with _transfer_client_lock:
+        if _transfer_client is not None and not new:
+            return _transfer_client
         transfer_rt = get_globus_transfer_rt()
-    client = create_globus_client()
-    authorizer = globus_sdk.RefreshTokenAuthorizer(transfer_rt, client)
-    tc = globus_sdk.TransferClient(authorizer=authorizer)
-    return tc
+        if not transfer_rt:
+            create_globus_token()
+            transfer_rt = get_globus_transfer_rt()
+        client = create_globus_client()
+        authorizer = globus_sdk.RefreshTokenAuthorizer(transfer_rt, client)
+        _transfer_client = globus_sdk.TransferClient(authorizer=authorizer)
+        return _transfer_client
+
+
+# Globus cache
+# ------------------------------------------------------------------------------------------------
+
+class TTLCache(object):
+    """A thread-safe dictionary whose items expire after `ttl` seconds, with at most
+    `maxsize` items, the least recently used ones being evicted first."""
+
+    def __init__(self, ttl=300, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._items[key]
+            self.misses += 1
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+
+_endpoint_cache = TTLCache(
+    ttl=getattr(settings, 'GLOBUS_CACHE_TTL', 300),
+    maxsize=getattr(settings, 'GLOBUS_CACHE_SIZE', 10000))
+_listing_cache = TTLCache(
+    ttl=getattr(settings, 'GLOBUS_CACHE_TTL', 300),
+    maxsize=getattr(settings, 'GLOBUS_CACHE_SIZE', 10000))
+
+
+def globus_get_endpoint(tc, endpoint_id):
+    """Return the metadata of a Globus endpoint, cached for GLOBUS_CACHE_TTL seconds."""
+    info = _endpoint_cache.get(endpoint_id)
+    if info is None:
+        info = tc.get_endpoint(endpoint_id)
+        _endpoint_cache.set(endpoint_id, info)
+    return info
+
+
+def globus_ls(tc, endpoint_id, path):
+    """Return the list of files of a directory on a Globus endpoint, cached for
+    GLOBUS_CACHE_TTL seconds.
+
+    The errors (e.g. for a missing directory) are raised and not cached.
+
+    """
+    key = (str(endpoint_id), path)
+    files = _listing_cache.get(key)
+    if files is None:
+        files = list(tc.operation_ls(endpoint_id, path=path))
+        _listing_cache.set(key, files)
+    return files
+
+
+def globus_cache_stats():
+    """Return the size, hits and misses of the endpoint and listing caches."""
+    return {'endpoints': _endpoint_cache.stats(), 'listings': _listing_cache.stats()}
+
+
+def clear_globus_cache():
+    _endpoint_cache.clear()
+    _listing_cache.clear()
 
 
 def _escape_label(label):
     return re.sub(r'[^a-zA-Z0-9 \-]', '-', label)
 
 
+def _normalize_relative_path(relative_path):
+    path = relative_path.replace('\\', '/')
+    # HACK
+    if path.startswith('Data2/'):
+        path = path[6:]
+    if path.startswith('/'):
+        path = path[1:]
+    return path
+
+
 def _get_absolute_path(file_record):
     path1 = file_record.data_repository.globus_path
-    path2 = file_record.relative_path
-    path2 = path2.replace('\\', '/')
-    # HACK
-    if path2.startswith('Data2/'):
-        path2 = path2[6:]
-    if path2.startswith('/'):
-        path2 = path2[1:]
+    path2 = _normalize_relative_path(file_record.relative_path)
     path = op.join(path1, path2)
     return path
 
 
 def _incomplete_dataset_ids():
     # a dataset is incomplete if
-    # -     there is no file on the flatiron Globus
+    # -     a file is missing on the flatiron Globus
     # and/or
     # -     none of globus personnal endpoints have a file
-    q1 = Q(file_records__exists=False) & Q(file_records__data_repository__globus_is_personal=False)
-    noremote = Dataset.objects.filter(q1)
-    q2 = Q(file_records__exists=True) & Q(file_records__data_repository__globus_is_personal=True)
-    nolocal = Dataset.objects.annotate(numok=Count(Case(When(q2, then=1)))).filter(numok=0)
-    return nolocal.values_list('id').union(noremote.values_list('id')).distinct()
-#    return FileRecord.objects.filter(exists=False).values_list('dataset', flat=True).distinct()
+    # (see the completeness flags maintained by update_dataset_completeness())
+    return Dataset.objects.filter(
+        Q(has_remote_copy=False) | Q(has_local_copy=False)).values_list('id')
 
 
 def _add_uuid_to_filename(fn, uuid):
@@ -149,6 +268,10 @@ def start_globus_transfer(source_file_id, destination_file_id, dry_run=False):
     # code = response.get('code', None)
 
     logger.info("%s (task UUID: %s)", message, task_id)
+    if task_id:
+        _record_transfer_tasks([(
+            source_fr.data_repository, destination_fr.data_repository,
+            [(source_fr, destination_fr)], response)])
     return response
 
 
@@ -159,7 +282,7 @@ def globus_file_exists(file_record):
     name = op.basename(path)
     name_uuid = _add_uuid_to_filename(name, file_record.dataset.pk)
     try:
-        existing = tc.operation_ls(file_record.data_repository.globus_endpoint_id, path=dir_path)
+        existing = globus_ls(tc, file_record.data_repository.globus_endpoint_id, dir_path)
     except globus_sdk.exc.TransferAPIError as e:
         logger.warning(e)
         return False
@@ -169,20 +292,107 @@ def globus_file_exists(file_record):
     return False
 
 
+@functools.lru_cache(maxsize=None)
+def _pattern_regex(pattern):
+    reg = pattern.replace('.', r'\.').replace('_', r'\_').replace('*', r'.+')
+    return re.compile(reg, re.IGNORECASE)
+
+
 def _filename_matches_pattern(filename, pattern):
     filename = op.basename(filename)
-    reg = pattern.replace('.', r'\.').replace('_', r'\_').replace('*', r'.+')
-    return re.match(reg, filename, re.IGNORECASE)
+    return _pattern_regex(pattern).match(filename)
+
+
+# Characters of a filename pattern that only match themselves (up to the case).
+_LITERAL_PATTERN = re.compile(r'^[a-zA-Z0-9\.\_\-]*')
+_SIMPLE_PATTERN = re.compile(r'^[a-zA-Z0-9\.\_\-\*]*$')
+
+
+class DatasetTypeClassifier(object):
+    """Find the dataset types whose filename pattern matches a filename.
+
+    The patterns are indexed by their literal prefix (the characters before the first
+    wildcard), so that only the patterns sharing the prefix of a filename are tested.
+    Patterns without a literal prefix (a leading wildcard, as in `*.timestamps.*`), or with
+    other regular expression characters, are not indexed: they are tested for every
+    filename, so the cost of a match grows with the number of such patterns.
+
+    """
+    def __init__(self, dataset_types):
+        # {prefix length: {lowercase prefix: [(order, compiled pattern, dataset type)]}}
+        self._prefixes = {}
+        self._others = []
+        for i, dt in enumerate(dataset_types):
+            pattern = dt.filename_pattern
+            if not pattern or not pattern.strip():
+                continue
+            item = (i, _pattern_regex(pattern), dt)
+            prefix = _LITERAL_PATTERN.match(pattern).group(0)
+            if prefix and _SIMPLE_PATTERN.match(pattern):
+                bucket = self._prefixes.setdefault(len(prefix), {})
+                bucket.setdefault(prefix.lower(), []).append(item)
+            else:
+                self._others.append(item)
+
+    def match(self, filename):
+        """Return the list of matching dataset types, in the order they were given."""
+        filename = op.basename(filename)
+        key = filename.lower()
+        candidates = list(self._others)
+        for n, bucket in self._prefixes.items():
+            candidates.extend(bucket.get(key[:n], ()))
+        return [dt for _, reg, dt in sorted(candidates, key=itemgetter(0))
+                if reg.match(filename)]
+
+
+# Classifier of the process: (version of the dataset types, time of the last check,
+# classifier).
+_classifier = None
+
+
+def _dataset_types_version():
+    """Hash of the ids and filename patterns of the dataset types in the database."""
+    rows = DatasetType.objects.order_by('pk').values_list('pk', 'filename_pattern')
+    return hashlib.md5(repr(list(rows)).encode()).hexdigest()
+
+
+def dataset_type_classifier(refresh=False):
+    """Return the classifier of all dataset types.
+
+    The classifier is kept in the process. It is rebuilt when a dataset type is saved or
+    deleted in the process, and when the dataset types of the database have changed, which
+    is checked at most every DATASET_TYPE_CLASSIFIER_TTL seconds (at once with `refresh`),
+    so that the changes made by the other processes are taken into account.
+
+    """
+    global _classifier
+    now = time.monotonic()
+    ttl = getattr(settings, 'DATASET_TYPE_CLASSIFIER_TTL', 60)
+    if _classifier is not None and not refresh and now - _classifier[1] < ttl:
+        return _classifier[2]
+    version = _dataset_types_version()
+    if _classifier is None or _classifier[0] != version:
+        classifier = DatasetTypeClassifier(
+            DatasetType.objects.filter(filename_pattern__isnull=False))
+    else:
+        classifier = _classifier[2]
+    _classifier = (version, now, classifier)
+    return classifier
+
+
+def invalidate_dataset_type_classifier():
+    global _classifier
+    _classifier = None
 
 
 def get_dataset_type(filename, qs=None):
-    dataset_types = []
-    qs = qs or DatasetType.objects.filter(filename_pattern__isnull=False)
-    for dt in qs:
-        if not dt.filename_pattern.strip():
-            continue
-        if _filename_matches_pattern(filename, dt.filename_pattern):
-            dataset_types.append(dt)
+    if qs is None:
+        dataset_types = dataset_type_classifier().match(filename)
+        if not dataset_types:
+            # The dataset type may have been created by another process since the last check.
+            dataset_types = dataset_type_classifier(refresh=True).match(filename)
+    else:
+        dataset_types = DatasetTypeClassifier(qs).match(filename)
     n = len(dataset_types)
     if n == 0:
         raise ValueError("No dataset type found for filename `%s`" % filename)
@@ -192,10 +402,20 @@ def get_dataset_type(filename, qs=None):
     return dataset_types[0]
 
 
-def get_data_format(filename):
+def get_data_format(filename, qs=None):
     file_extension = op.splitext(filename)[-1]
-    # This raises an error if there is 0 or 2+ matching data formats.
-    return DataFormat.objects.get(file_extension=file_extension)
+    if qs is None:
+        # This raises an error if there is 0 or 2+ matching data formats.
+        return DataFormat.objects.get(file_extension=file_extension)
+    # Same errors as above, with the data formats already fetched.
+    data_formats = [df for df in qs if df.file_extension == file_extension]
+    if len(data_formats) == 0:
+        raise DataFormat.DoesNotExist(
+            "No data format found for file extension `%s`" % file_extension)
+    elif len(data_formats) >= 2:
+        raise DataFormat.MultipleObjectsReturned(
+            "Multiple data formats found for file extension `%s`" % file_extension)
+    return data_formats[0]
 
 
 def _get_repositories_for_labs(labs):
@@ -243,28 +463,241 @@ def _create_dataset_file_records(
     return dataset
 
 
-def iter_registered_directories(data_repository=None, tc=None, path=None):
+def _create_dataset_file_records_bulk(
+        rel_dir_path=None, filenames=None, session=None, user=None,
+        repositories=None, exists_in=None):
+    """Same as _create_dataset_file_records() for several files in the same directory.
+
+    The dataset types and data formats are resolved in memory, the existing datasets and file
+    records are fetched with one query each, and the new or modified rows are written with
+    bulk queries in a single transaction.
+
+    Return a list of pairs (dataset, file_records) with all file records of each dataset.
+
+    """
+    assert session is not None
+
+    filenames = [filename for filename in filenames if filename]
+    exists_in = exists_in or ()
+    data_formats = list(DataFormat.objects.all())
+    prefetch_related_objects([session], 'users')
+
+    # Dataset type and data format of every file.
+    keys = {}
+    for filename in filenames:
+        dataset_type = get_dataset_type(filename)
+        data_format = get_data_format(filename, qs=data_formats)
+        assert dataset_type
+        assert data_format
+        keys[filename] = (filename, dataset_type, data_format)
+
+    with transaction.atomic():
+        # Existing datasets, and all their file records.
+        datasets = {}
+        for dataset in Dataset.objects.filter(session=session, name__in=keys).order_by('pk'):
+            key = (dataset.name, dataset.dataset_type_id, dataset.data_format_id)
+            datasets.setdefault(key, dataset)
+        file_records = {dataset.pk: [] for dataset in datasets.values()}
+        for fr in FileRecord.objects.filter(dataset__in=datasets.values()):
+            file_records[fr.dataset_id].append(fr)
+
+        # Create the missing datasets.
+        to_update, to_create = [], []
+        for filename, dataset_type, data_format in keys.values():
+            key = (filename, dataset_type.pk, data_format.pk)
+            dataset = datasets.get(key)
+            if dataset is None:
+                dataset = Dataset(name=filename, dataset_type=dataset_type,
+                                  data_format=data_format)
+                datasets[key] = dataset
+                file_records[dataset.pk] = []
+                to_create.append(dataset)
+            elif dataset.created_by_id != getattr(user, 'pk', None):
+                to_update.append(dataset)
+            dataset.session = session
+            dataset.dataset_type = dataset_type
+            dataset.data_format = data_format
+            # The user doesn't have to be the same when getting an existing dataset, but we
+            # still have to set the created_by field.
+            dataset.created_by = user
+            # Validate the fields (the foreign keys are already known to exist).
+            dataset.full_clean(
+                exclude=('session', 'created_by', 'dataset_type', 'data_format'),
+                validate_unique=False)
+        Dataset.objects.bulk_create(to_create)
+        Dataset.objects.bulk_update(to_update, ['created_by'])
+
+        # Create one file record per repository, or update the existing ones.
+        to_update, to_create = [], []
+        for filename, dataset_type, data_format in keys.values():
+            dataset = datasets[(filename, dataset_type.pk, data_format.pk)]
+            relative_path = op.join(rel_dir_path, filename)
+            existing = {(fr.data_repository_id, fr.relative_path): fr
+                        for fr in file_records[dataset.pk]}
+            for repo in repositories:
+                exists = repo in exists_in
+                fr = existing.get((repo.pk, relative_path))
+                if fr is None:
+                    fr = FileRecord(dataset=dataset, data_repository=repo,
+                                    relative_path=relative_path, exists=exists)
+                    file_records[dataset.pk].append(fr)
+                    to_create.append(fr)
+                elif fr.exists != exists:
+                    fr.exists = exists
+                    to_update.append(fr)
+                else:
+                    continue
+                # Validate the fields.
+                fr.full_clean(exclude=('dataset', 'data_repository'), validate_unique=False)
+        FileRecord.objects.bulk_create(to_create)
+        FileRecord.objects.bulk_update(to_update, ['exists'])
+        # The bulk operations do not send the signals updating the completeness flags.
+        if to_create or to_update:
+            update_dataset_completeness({fr.dataset_id for fr in to_create + to_update})
+
+    out = []
+    for filename in filenames:
+        _, dataset_type, data_format = keys[filename]
+        dataset = datasets[(filename, dataset_type.pk, data_format.pk)]
+        out.append((dataset, file_records[dataset.pk]))
+    return out
+
+
+_endpoint_slots = {}
+_endpoint_slots_lock = threading.Lock()
+
+
+def _endpoint_semaphore(endpoint_id):
+    """Semaphore limiting the number of concurrent listings on a Globus endpoint."""
+    with _endpoint_slots_lock:
+        if endpoint_id not in _endpoint_slots:
+            _endpoint_slots[endpoint_id] = threading.BoundedSemaphore(
+                getattr(settings, 'GLOBUS_ENDPOINT_CONCURRENCY', 8))
+        return _endpoint_slots[endpoint_id]
+
+
+def _ls_with_retry(tc, endpoint_id, path, max_retries=3, backoff=1.):
+    """List a directory on a Globus endpoint, retrying up to `max_retries` times after
+    `backoff`, 2 * `backoff`, 4 * `backoff`... seconds. Return None if the listing fails."""
+    for attempt in range(max_retries + 1):
+        try:
+            with _endpoint_semaphore(endpoint_id):
+                return list(tc.operation_ls(endpoint_id, path=path))
+        except globus_sdk.GlobusError as e:
+            # the missing or forbidden directories are not retried
+            if getattr(e, 'http_status', None) in (403, 404) or attempt == max_retries:
+                logger.warning("Unable to list %s on %s: %s", path, endpoint_id, e)
+                return None
+            time.sleep(backoff * 2 ** attempt)
+
+
+def crawl_directories(data_repository, tc=None, path=None, n_threads=8, checkpoint=None,
+                      max_retries=3, backoff=1.):
+    """
+    Iterate over tuples (globus dir path, [files], session dir path) for every directory of
+    a data repository below a path (by default the root of the repository), where the
+    session dir path is the closest directory containing a session.metadata.json file, or
+    None.
+
+    The tree is crawled breadth-first, listing `n_threads` * 4 directories at a time with
+    `n_threads` threads, at most GLOBUS_ENDPOINT_CONCURRENCY at a time per endpoint. Failed
+    listings are retried with an exponential backoff. If `checkpoint` is the path of a JSON
+    file, the frontier of the crawl is saved in it after every batch of directories, and an
+    interrupted crawl resumes from it. The directories that could not be listed are listed
+    in the checkpoint and logged.
+    """
+    tc = tc or globus_transfer_client()
+    endpoint_id = data_repository.globus_endpoint_id
+    root = path or data_repository.globus_path
+    state = {'data_repository': data_repository.name, 'root': root,
+             'pending': [[root, None]], 'failed': [], 'directories': 0}
+    if checkpoint and op.exists(checkpoint):
+        with open(checkpoint, 'r') as f:
+            saved = json.load(f)
+        if (saved['data_repository'], saved['root']) == (data_repository.name, root):
+            logger.info("Resuming the crawl of %s from %s.", root, checkpoint)
+            state = saved
+    batch_size = n_threads * 4
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        while state['pending']:
+            batch = state['pending'][:batch_size]
+            listings = executor.map(
+                lambda item: _ls_with_retry(
+                    tc, endpoint_id, item[0], max_retries=max_retries, backoff=backoff),
+                batch)
+            pending = []
+            for (dir_path, session_path), contents in zip(batch, listings):
+                if contents is None:
+                    state['failed'].append(dir_path)
+                    continue
+                files = [file['name'] for file in contents if file['type'] == 'file']
+                if session_path is None and 'session.metadata.json' in files:
+                    session_path = dir_path
+                yield dir_path, files, session_path
+                pending.extend([op.join(dir_path, file['name']), session_path]
+                               for file in contents if file['type'] == 'dir')
+            state['pending'] = state['pending'][batch_size:] + pending
+            state['directories'] += len(batch)
+            if checkpoint:
+                with open(checkpoint, 'w') as f:
+                    json.dump(state, f)
+            logger.info("Crawled %d directories of %s, %d remaining.",
+                        state['directories'], root, len(state['pending']))
+    if state['failed']:
+        logger.warning("%d directories of %s could not be listed: %s",
+                       len(state['failed']), root, ', '.join(state['failed']))
+    if checkpoint and op.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+def iter_registered_directories(data_repository=None, tc=None, path=None, **kwargs):
     """Iterater over pairs (globus dir path, [list of files]) in any directory that
     contains session.metadat.json."""
-    tc = tc or globus_transfer_client()
-    # Default path: the root of the data repository.
-    path = path or data_repository.path
-    try:
-        contents = tc.operation_ls(data_repository.globus_endpoint_id, path=path)
-    except globus_sdk.exc.TransferAPIError as e:
-        logger.warning(e)
-        return
-    contents = contents['DATA']
-    subdirs = [file['name'] for file in contents if file['type'] == 'dir']
-    files = [file['name'] for file in contents if file['type'] == 'file']
-    # Yield the list of files if there is a session.metadata.json file.
-    if 'session.metadata.json' in files:
-        yield path, files
-    # Recursively call the function in the subdirectories.
-    for subdir in subdirs:
-        subdir_path = op.join(path, subdir)
-        yield from iter_registered_directories(
-            tc=tc, data_repository=data_repository, path=subdir_path)
+    for dir_path, files, session_path in crawl_directories(
+            data_repository, tc=tc, path=path, **kwargs):
+        if dir_path == session_path:
+            yield dir_path, files
+
+
+def autoregister(data_repository, tc=None, path=None, user=None, dry_run=False, **kwargs):
+    """
+    Crawl a data repository (see crawl_directories) and register the files of the session
+    directories, containing a session.metadata.json file, and of their subdirectories, as
+    existing in that repository. The files without a dataset type are skipped.
+    Return the number of crawled directories, of registered directories and files, and the
+    directories that could not be registered.
+    """
+    from data.views import _parse_path
+    root = op.join(data_repository.globus_path, '')
+    classifier = dataset_type_classifier(refresh=True)
+    report = {'directories': 0, 'registered': 0, 'files': 0, 'errors': []}
+    for dir_path, files, session_path in crawl_directories(
+            data_repository, tc=tc, path=path, **kwargs):
+        report['directories'] += 1
+        filenames = [fn for fn in files if len(classifier.match(fn)) == 1]
+        if not session_path or not filenames:
+            continue
+        rel_dir_path = dir_path[len(root):] if dir_path.startswith(root) else dir_path
+        rel_dir_path = rel_dir_path.strip('/')
+        logger.info("Register %d files in %s.", len(filenames), rel_dir_path)
+        if not dry_run:
+            try:
+                subject, date, session_number = _parse_path(rel_dir_path)
+                session = _get_session(
+                    subject=subject, date=date, number=session_number, user=user)
+                repositories = _get_repositories_for_labs([subject.lab])
+                if data_repository not in repositories:
+                    repositories.append(data_repository)
+                _create_dataset_file_records_bulk(
+                    rel_dir_path=rel_dir_path, filenames=filenames, session=session,
+                    user=user, repositories=repositories, exists_in=(data_repository,))
+            except (ValueError, ObjectDoesNotExist, ValidationError) as e:
+                logger.warning("Unable to register the files of %s: %s", rel_dir_path, e)
+                report['errors'].append(rel_dir_path)
+                continue
+        report['registered'] += 1
+        report['files'] += len(filenames)
+    return report
 
 
 def update_file_exists(dataset):
@@ -328,13 +761,17 @@ def transfers_required(dataset):
             }
 
 
-def bulk_sync(dry_run=False, lab=None):
+def bulk_sync(dry_run=False, lab=None, gc=None, n_threads=8, chunk_size=1000):
     """
     updates the Alyx database file records field 'exists' by looking at each Globus repository.
     Only the files belonging to a dataset for which one main repository as a missing file are
     checked on the Globus endpoints (a main repository is a repository with the
     globus_is_personnal field set to False). Also fills dataset size if non-existent.
     This is meant to be launched before the transfer() function
+
+    The directories are listed concurrently with `n_threads` threads per endpoint, and the
+    changes are saved with bulk updates of `chunk_size` rows. Return a report with the
+    listing throughput of every endpoint.
     """
     dfs = FileRecord.objects.filter(exists=False, data_repository__globus_is_personal=False)
     if lab:
@@ -349,108 +786,655 @@ def bulk_sync(dry_run=False, lab=None):
             print(l)
         return fvals
 
-    gc = globus_transfer_client()
-    # loop over all files concerned by a transfer and update the exists and filesize fields
-    files_to_ls = all_files.order_by('data_repository__globus_endpoint_id', 'relative_path')
-    _last_ep = None
-    _last_path = None
-    nfiles = files_to_ls.count()
-    c = 0
+    gc = gc or globus_transfer_client()
+    # group the files by endpoint and directory, each directory is listed only once
+    files_to_ls = all_files.select_related('data_repository', 'dataset').order_by(
+        'data_repository__globus_endpoint_id', 'relative_path')
+    files_to_ls = list(files_to_ls)
+    dirs = {}
     for qf in files_to_ls:
-        c += 1
-        # if the last endpoint has already been queried, do not repeat the query
-        if _last_ep != qf.data_repository.globus_endpoint_id:
-            _last_ep = qf.data_repository.globus_endpoint_id
-            ep_info = gc.get_endpoint(_last_ep)
-        # if the endpoint is not connected skip
-        # NB: the non-personal endpoints have a None so need to explicitly test for False
-        if ep_info['gcp_connected'] is False:
-            logger.warning('UNREACHABLE Endpoint "' + ep_info['display_name'] +
-                           '" (' + str(_last_ep) + ') ' + qf.relative_path)
-            continue
-        # if we already listed the current path of the endpoint, do not repeat the rest ls command
         cpath, fil = os.path.split(qf.relative_path)
-        fil_uuid = _add_uuid_to_filename(fil, qf.dataset_id)
         cpath = qf.data_repository.globus_path + cpath
-        if _last_path != cpath:
-            _last_path = cpath
-            try:
-                logger.info(str(c) + '/' + str(nfiles) + ' ls ' + cpath + ' on ' + str(_last_ep))
-                ls_result = gc.operation_ls(_last_ep, path=_last_path)
-            except globus_sdk.exc.TransferAPIError:
-                ls_result = []
-        # compare the current file against the ls list, update the file_size if necessary
+        dirs.setdefault(qf.data_repository.globus_endpoint_id, {}).setdefault(cpath, [])
+        dirs[qf.data_repository.globus_endpoint_id][cpath].append(qf)
+    listings, report = _list_directories(gc, dirs, n_threads=n_threads)
+
+    # compare the files against the listings, update the exists and file_size fields
+    frs_to_update = []
+    dsets_to_update = {}
+    for qf in files_to_ls:
+        ep = qf.data_repository.globus_endpoint_id
+        cpath, fil = os.path.split(qf.relative_path)
+        cpath = qf.data_repository.globus_path + cpath
+        ls_result = listings.get((ep, cpath))
+        # the endpoint is not connected
+        if ls_result is None:
+            continue
+        fil_uuid = _add_uuid_to_filename(fil, qf.dataset_id)
         exists = False
-        for ind, gfil in enumerate(ls_result):
+        for gfil in ls_result:
             if gfil['name'] in (fil_uuid, fil):
                 exists = True
                 if qf.dataset.file_size != gfil['size']:
                     qf.dataset.file_size = gfil['size']
-                    qf.dataset.save()
+                    dsets_to_update[qf.dataset_id] = qf.dataset
                 break
         # update the filerecord exists field if needed
         if qf.exists != exists:
             qf.exists = exists
-            qf.save()
-            logger.info(str(c) + '/' + str(nfiles) + ' ' + str(qf.data_repository.name) + ':' +
+            frs_to_update.append(qf)
+            logger.info(str(qf.data_repository.name) + ':' +
                         qf.relative_path + ' exist set to ' + str(exists) + ' in Alyx')
+    report_progress(1., "Updating %d file records" % len(frs_to_update))
+    with transaction.atomic():
+        FileRecord.objects.bulk_update(frs_to_update, ['exists'], batch_size=chunk_size)
+        Dataset.objects.bulk_update(
+            list(dsets_to_update.values()), ['file_size'], batch_size=chunk_size)
+        dataset_ids = sorted({fr.dataset_id for fr in frs_to_update})
+        for i in range(0, len(dataset_ids), chunk_size):
+            update_dataset_completeness(dataset_ids[i:i + chunk_size])
+    logger.info("%d file records and %d datasets updated.",
+                len(frs_to_update), len(dsets_to_update))
+    return report
+
+
+def _list_directories(gc, dirs, n_threads=8):
+    """List directories concurrently, with one pool of `n_threads` threads per endpoint.
+
+    `dirs` is a dictionary {endpoint_id: {path: [file records]}}. Return a tuple
+    (listings, report) where listings is a dictionary {(endpoint_id, path): [files]}, without
+    the directories of the endpoints that are not connected, and report is a list with the
+    number of directories and files, and the listing throughput, of every endpoint.
+
+    """
+    listings = {}
+    report = []
+
+    def _ls(ep, path):
+        try:
+            return globus_ls(gc, ep, path)
+        except globus_sdk.exc.TransferAPIError:
+            return []
+
+    executors = {}
+    futures = {}
+    started = {}
+    for ep, ep_dirs in dirs.items():
+        ep_info = globus_get_endpoint(gc, ep)
+        # if the endpoint is not connected skip
+        # NB: the non-personal endpoints have a None so need to explicitly test for False
+        if ep_info['gcp_connected'] is False:
+            logger.warning('UNREACHABLE Endpoint "' + ep_info['display_name'] +
+                           '" (' + str(ep) + ') ' + str(len(ep_dirs)) + ' directories')
+            continue
+        executors[ep] = ThreadPoolExecutor(max_workers=n_threads)
+        started[ep] = time.perf_counter()
+        for path in ep_dirs:
+            futures[executors[ep].submit(_ls, ep, path)] = (ep, path)
+    try:
+        remaining = {ep: len(dirs[ep]) for ep in executors}
+        for n_listed, future in enumerate(as_completed(futures), 1):
+            ep, path = futures[future]
+            listings[(ep, path)] = future.result()
+            remaining[ep] -= 1
+            report_progress(n_listed / len(futures),
+                            "Listed %d/%d directories" % (n_listed, len(futures)))
+            if remaining[ep] == 0:
+                duration = time.perf_counter() - started[ep]
+                n_files = sum(len(frs) for frs in dirs[ep].values())
+                report.append({
+                    'endpoint': str(ep),
+                    'directories': len(dirs[ep]),
+                    'files': n_files,
+                    'duration': duration,
+                    'files_per_second': n_files / duration if duration > 0 else None,
+                })
+                logger.info("Listed %d directories (%d files) on %s in %.1f s.",
+                            len(dirs[ep]), n_files, ep, duration)
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=False)
+    return listings, report
+
+
+def _scandir(root, rel_dir):
+    """List a directory relative to a root, returning ({filename: size}, [subdirectories])."""
+    files, subdirs = {}, []
+    try:
+        with os.scandir(op.join(root, rel_dir)) as it:
+            for entry in it:
+                rel_path = op.join(rel_dir, entry.name) if rel_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(rel_path)
+                elif entry.is_file():
+                    files[entry.name] = entry.stat().st_size
+    except OSError as e:
+        logger.warning("Unable to list %s: %s", op.join(root, rel_dir), e)
+    return files, subdirs
+
+
+def _directory_records_q(rel_dir, names):
+    """Condition on the relative path of the file records below a directory, but not in one
+    of its existing subdirectories, with the variants of the stored relative paths (see
+    _relative_path_candidates). The prefix conditions can use the `varchar_pattern_ops`
+    index of the relative paths. Return None for all the file records."""
+    q = None
+    if rel_dir:
+        q = functools.reduce(or_, (Q(relative_path__startswith=prefix)
+                                   for prefix in _relative_path_candidates(rel_dir + '/')))
+    for name in names:
+        for prefix in _relative_path_candidates(name + '/'):
+            exclude = ~Q(relative_path__startswith=prefix)
+            q = exclude if q is None else q & exclude
+    return q
+
+
+def _reconcile_directories(data_repository, listings, subdirs, dry_run=False,
+                           chunk_size=100):
+    """Update the exists field of the file records of a repository from directory listings
+    {relative directory: {filename: size}}, and the file size of their datasets.
+
+    The file records below the listed directories, but not in one of their existing
+    subdirectories {relative directory: [subdirectories]}, are also missing. They are
+    selected with one query per `chunk_size` directories.
+    Return the number of updated file records and datasets.
+
+    """
+    frs_to_update = []
+    dsets_to_update = {}
+    items = list(subdirs.items())
+    for i in range(0, len(items), chunk_size):
+        conditions = [_directory_records_q(rel_dir, names)
+                      for rel_dir, names in items[i:i + chunk_size]]
+        file_records = FileRecord.objects.filter(
+            data_repository=data_repository).select_related('dataset')
+        if None not in conditions:
+            file_records = file_records.filter(functools.reduce(or_, conditions))
+        for fr in file_records:
+            rel_dir, fn = op.split(_normalize_relative_path(fr.relative_path))
+            on_disk = listings.get(rel_dir, {})
+            size = on_disk.get(fn, None)
+            if size is None:
+                size = on_disk.get(op.basename(_add_uuid_to_filename(fn, fr.dataset_id)), None)
+            exists = size is not None
+            if exists and fr.dataset.file_size != size:
+                fr.dataset.file_size = size
+                dsets_to_update[fr.dataset_id] = fr.dataset
+            if fr.exists != exists:
+                fr.exists = exists
+                frs_to_update.append(fr)
+    if not dry_run:
+        with transaction.atomic():
+            FileRecord.objects.bulk_update(frs_to_update, ['exists'], batch_size=1000)
+            Dataset.objects.bulk_update(
+                list(dsets_to_update.values()), ['file_size'], batch_size=1000)
+            update_dataset_completeness({fr.dataset_id for fr in frs_to_update})
+    return len(frs_to_update), len(dsets_to_update)
+
+
+def scan_repository(data_repository, root=None, n_threads=8, batch_size=1000,
+                    checkpoint=None, dry_run=False):
+    """
+    Update the exists field of the file records of a data repository mounted on the local
+    filesystem (at `root`, by default the Globus path of the repository), and the file
+    size of their datasets.
+
+    The tree is walked with `n_threads` threads, `batch_size` directories at a time; the
+    file records of every batch of directories are updated in bulk. The file names may have
+    the dataset UUID added by _add_uuid_to_filename(). If `checkpoint` is the path of a JSON
+    file, the directories remaining to scan are saved in it after every batch, and an
+    interrupted scan resumes from it. Return a report with the number of scanned directories
+    and files, and of updated file records and datasets.
+    """
+    root = root or data_repository.globus_path
+    state = {'data_repository': data_repository.name, 'root': root, 'pending': [''],
+             'directories': 0, 'files': 0, 'file_records': 0, 'datasets': 0}
+    if checkpoint and op.exists(checkpoint):
+        with open(checkpoint, 'r') as f:
+            saved = json.load(f)
+        if (saved['data_repository'], saved['root']) == (data_repository.name, root):
+            logger.info("Resuming the scan of %s from %s.", root, checkpoint)
+            state = saved
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        while state['pending']:
+            batch = state['pending'][:batch_size]
+            listings = {}
+            subdirs = {}
+            for rel_dir, (files, dirs) in zip(
+                    batch, executor.map(lambda d: _scandir(root, d), batch)):
+                listings[rel_dir] = files
+                subdirs[rel_dir] = dirs
+            n_frs, n_dsets = _reconcile_directories(
+                data_repository, listings, subdirs, dry_run=dry_run)
+            state['pending'] = state['pending'][batch_size:] + [
+                d for dirs in subdirs.values() for d in dirs]
+            state['directories'] += len(batch)
+            state['files'] += sum(len(files) for files in listings.values())
+            state['file_records'] += n_frs
+            state['datasets'] += n_dsets
+            if checkpoint:
+                with open(checkpoint, 'w') as f:
+                    json.dump(state, f)
+            logger.info("Scanned %d directories of %s (%d files), %d remaining.",
+                        state['directories'], root, state['files'], len(state['pending']))
+    if checkpoint and op.exists(checkpoint):
+        os.remove(checkpoint)
+    report = {k: state[k] for k in ('directories', 'files', 'file_records', 'datasets')}
+    report['duration'] = time.perf_counter() - started
+    return report
+
+
+def _file_md5(paths, chunk_size=1 << 24):
+    """Return the MD5 hex digest of the first existing file among some paths, reading it
+    through a memory map by chunks of `chunk_size` bytes, and its size.
+    Return (None, 0) if no file exists. Run in the worker processes of checksum_repository()."""
+    for path in paths:
+        if not op.isfile(path):
+            continue
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    with memoryview(m) as view:
+                        for i in range(0, size, chunk_size):
+                            md5.update(view[i:i + chunk_size])
+        return md5.hexdigest(), size
+    return None, 0
+
+
+def _existing_file(paths):
+    """Return the first existing file among some paths and its size, or (None, 0)."""
+    for path in paths:
+        if op.isfile(path):
+            return path, op.getsize(path)
+    return None, 0
+
+
+class RateLimiter(object):
+    """Block until a number of bytes can be processed without exceeding a rate in MB/s."""
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.started = time.perf_counter()
+        self.n_bytes = 0
+
+    def wait(self, n_bytes):
+        if self.rate:
+            delay = self.n_bytes / (self.rate * 1e6) - (time.perf_counter() - self.started)
+            if delay > 0:
+                time.sleep(delay)
+        self.n_bytes += n_bytes
+
+
+def _save_checksums(checksums, dry_run=False):
+    """Store the missing MD5s of the datasets and flag the file records whose MD5 differs
+    from the one of their dataset, given a list of (file record pk, dataset pk, dataset MD5,
+    computed MD5). The flag of the file records whose MD5 now matches is removed. Return
+    the number of stored MD5s and the mismatching file record pks."""
+    md5s = {}
+    mismatches = {}
+    matches = []
+    for fr_pk, dataset_pk, dataset_md5, md5 in checksums:
+        expected = dataset_md5 or md5s.get(dataset_pk, None)
+        if expected is None:
+            md5s[dataset_pk] = md5
+            matches.append(fr_pk)
+        elif expected != md5:
+            mismatches[fr_pk] = md5
+            logger.warning("MD5 mismatch for file record %s: %s instead of %s.",
+                           fr_pk, md5, expected)
+        else:
+            matches.append(fr_pk)
+    if dry_run:
+        return len(md5s), list(mismatches)
+    file_records = list(FileRecord.objects.filter(pk__in=list(mismatches)))
+    for fr in file_records:
+        fr.json = dict(fr.json or {}, md5_mismatch=str(mismatches[fr.pk]))
+    # the file records flagged by a previous run
+    for pk, data in FileRecord.objects.filter(
+            pk__in=matches, json__isnull=False).values_list('pk', 'json'):
+        if isinstance(data, dict) and 'md5_mismatch' in data:
+            data = {k: v for k, v in data.items() if k != 'md5_mismatch'}
+            file_records.append(FileRecord(pk=pk, json=data or None))
+    with transaction.atomic():
+        Dataset.objects.bulk_update(
+            [Dataset(pk=pk, md5=md5) for pk, md5 in md5s.items()], ['md5'], batch_size=1000)
+        FileRecord.objects.bulk_update(file_records, ['json'], batch_size=1000)
+    return len(md5s), list(mismatches)
+
+
+def checksum_repository(data_repository, root=None, n_processes=None, batch_size=1000,
+                        rate=None, checkpoint=None, dry_run=False):
+    """
+    Compute the MD5 of the existing files of a data repository mounted on the local
+    filesystem (at `root`, by default the Globus path of the repository).
+
+    The files are hashed by a pool of `n_processes` processes (the number of CPUs by
+    default), reading at most `rate` MB/s. The missing MD5s of the datasets are stored, and
+    the file records whose MD5 differs from the one of their dataset are flagged with a
+    `md5_mismatch` key in their JSON, removed once their MD5 matches again. If `checkpoint`
+    is the path of a JSON file, the last hashed file record is saved in it after every batch
+    of `batch_size` files, and an interrupted run resumes from it. Return a report with the
+    number of hashed files and bytes, stored MD5s, mismatches and missing files.
+    """
+    root = root or data_repository.globus_path
+    state = {'data_repository': data_repository.name, 'root': root, 'last': None,
+             'files': 0, 'bytes': 0, 'stored': 0, 'mismatches': [], 'missing': 0}
+    if checkpoint and op.exists(checkpoint):
+        with open(checkpoint, 'r') as f:
+            saved = json.load(f)
+        if (saved['data_repository'], saved['root']) == (data_repository.name, root):
+            logger.info("Resuming the checksums of %s from %s.", root, checkpoint)
+            state = saved
+    file_records = FileRecord.objects.filter(
+        data_repository=data_repository, exists=True).order_by('pk').values_list(
+        'pk', 'relative_path', 'dataset_id', 'dataset__md5')
+    limiter = RateLimiter(rate)
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        while True:
+            batch = file_records
+            if state['last']:
+                batch = batch.filter(pk__gt=state['last'])
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+            futures = []
+            for fr_pk, relative_path, dataset_pk, _ in batch:
+                path = op.join(root, relative_path)
+                # the rate is limited on the size of the file on disk, which is read
+                # once the task is submitted
+                path, size = _existing_file((path, _add_uuid_to_filename(path, dataset_pk)))
+                if path is None:
+                    futures.append(None)
+                    continue
+                limiter.wait(size)
+                futures.append(executor.submit(_file_md5, (path,)))
+            checksums = []
+            for (fr_pk, relative_path, dataset_pk, dataset_md5), future in zip(
+                    batch, futures):
+                md5, size = future.result() if future else (None, 0)
+                if md5 is None:
+                    logger.warning("File %s not found in %s.", relative_path, root)
+                    state['missing'] += 1
+                    continue
+                state['files'] += 1
+                state['bytes'] += size
+                checksums.append((fr_pk, dataset_pk, dataset_md5, uuid.UUID(md5)))
+            n_stored, mismatches = _save_checksums(checksums, dry_run=dry_run)
+            state['stored'] += n_stored
+            state['mismatches'] += [str(pk) for pk in mismatches]
+            state['last'] = str(batch[-1][0])
+            if checkpoint:
+                with open(checkpoint, 'w') as f:
+                    json.dump(state, f)
+            logger.info("Hashed %d files (%d MB) of %s.",
+                        state['files'], state['bytes'] // 1000000, root)
+    if checkpoint and op.exists(checkpoint):
+        os.remove(checkpoint)
+    report = {k: state[k] for k in ('files', 'bytes', 'stored', 'mismatches', 'missing')}
+    report['duration'] = time.perf_counter() - started
+    return report
+
+
+def _iter_manifest(path, chunk_size=10000):
+    """Iterate over the chunks of `chunk_size` distinct paths of a manifest, a plain or
+    gzip-compressed text file with one absolute path per line."""
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    with (gzip.open(path, 'rt') if compressed else open(path, 'r')) as f:
+        chunk = set()
+        for line in f:
+            line = line.strip()
+            if line:
+                chunk.add(line)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = set()
+        if chunk:
+            yield chunk
+
+
+def _relative_path_candidates(relative_path):
+    """The stored relative paths that _get_absolute_path() maps to a relative path."""
+    candidates = (relative_path, 'Data2/' + relative_path, '/' + relative_path)
+    return candidates + tuple(c.replace('/', '\\') for c in candidates)
+
+
+def sync_manifest(path, chunk_size=10000, dry_run=False):
+    """
+    Set the exists field of the file records whose absolute path (see _get_absolute_path)
+    is listed in a manifest, a plain or gzip-compressed text file with one path per line.
+
+    The manifest is streamed by chunks of `chunk_size` paths, matched with one query per
+    chunk and Globus path of the repositories, and the matching file records that were
+    missing are updated with one query per chunk. Return the number of paths in the
+    manifest, of matching and updated file records, and of unmatched paths.
+    """
+    # repositories by Globus path
+    roots = {}
+    for repo in DataRepository.objects.filter(globus_path__isnull=False):
+        roots.setdefault(op.join(repo.globus_path, ''), []).append(repo)
+    report = {'paths': 0, 'matched': 0, 'updated': 0, 'unmatched': 0}
+    for chunk in _iter_manifest(path, chunk_size=chunk_size):
+        matched = set()
+        missing = {}
+        for root, repos in roots.items():
+            candidates = set()
+            for p in chunk:
+                if p.startswith(root):
+                    candidates.update(_relative_path_candidates(p[len(root):]))
+            if not candidates:
+                continue
+            for pk, dataset_id, exists, relative_path in FileRecord.objects.filter(
+                    data_repository__in=repos, relative_path__in=candidates).values_list(
+                    'pk', 'dataset_id', 'exists', 'relative_path'):
+                abs_path = op.join(root, _normalize_relative_path(relative_path))
+                if abs_path not in chunk:
+                    continue
+                report['matched'] += 1
+                matched.add(abs_path)
+                if not exists:
+                    missing[pk] = dataset_id
+        report['paths'] += len(chunk)
+        report['updated'] += len(missing)
+        report['unmatched'] += len(chunk - matched)
+        if missing and not dry_run:
+            with transaction.atomic():
+                FileRecord.objects.filter(pk__in=list(missing)).update(exists=True)
+                update_dataset_completeness(set(missing.values()))
+        logger.info("%d paths of %s: %d file records updated, %d paths unmatched.",
+                    report['paths'], path, report['updated'], report['unmatched'])
+    return report
 
 
 def _filename_from_file_record(fr, add_uuid=False):
     fn = fr.data_repository.globus_path + fr.relative_path
     if add_uuid:
-        fn = _add_uuid_to_filename(fn, fr.dataset.pk)
+        fn = _add_uuid_to_filename(fn, fr.dataset_id)
     return fn
 
 
-def bulk_transfer(dry_run=False, lab=None):
-    """
-    uploads files from a local Globus repository to a main repository if the file on the main
-    repository does not exist.
-    should be launched after bulk_sync() function
+def _plan_bulk_transfer(lab=None):
+    """Return the file transfers required to fill the missing files of the main repositories,
+    as a dictionary {(source repository, destination repository): [(source file record,
+    destination file record)]}.
+
+    The source of a transfer is an existing file of the same dataset on a personal
+    repository (the first one by name). The files covered by a transfer task that is still
+    in flight are skipped.
+
     """
-    gc = globus_transfer_client()
     dfs = FileRecord.objects.filter(exists=False, data_repository__globus_is_personal=False)
+    # the files already being transferred are skipped
+    dfs = dfs.exclude(transfer_tasks__status__in=TransferTask.IN_FLIGHT)
     if lab:
         dfs = dfs.filter(data_repository__lab__name=lab)
-    dfs = dfs.order_by('data_repository__globus_endpoint_id', 'relative_path')
-    pri_repos = DataRepository.objects.filter(globus_is_personal=False)
-    sec_repos = DataRepository.objects.filter(globus_is_personal=True)
-    tm = np.zeros([pri_repos.count(), sec_repos.count()], dtype=object)
-    nfiles = dfs.count()
-    c = 0
-    # create the tasks
-    for ds in dfs:
-        c += 1
-        ipri = [ind for ind, cr in enumerate(pri_repos) if cr == ds.data_repository][0]
-        src_file = ds.dataset.file_records.filter(exists=True).first()
+    # existing copies of the datasets on the personal repositories, indexed by dataset
+    sources = {}
+    for fr in FileRecord.objects.filter(
+            dataset__in=dfs.values('dataset'), exists=True,
+            data_repository__globus_is_personal=True).select_related(
+            'data_repository', 'dataset').order_by('data_repository__name'):
+        sources.setdefault(fr.dataset_id, fr)
+    plan = OrderedDict()
+    for ds in dfs.order_by('data_repository__globus_endpoint_id', 'relative_path'):
+        src_file = sources.get(ds.dataset_id)
         if not src_file:
             logger.warning(str(ds.data_repository.name) + ':' + ds.relative_path +
-                           ' is nowhere to ' + 'be found in local AND remote repositories')
+                           ' is nowhere to ' + 'be found in local repositories')
             continue
-        isec = [ind for ind, cr in enumerate(sec_repos) if cr == src_file.data_repository][0]
-        # if the transfer doesn't exist, create it:
-        if tm[ipri][isec] == 0:
-            label = sec_repos[isec].name + ' to ' + pri_repos[ipri].name
-            tm[ipri][isec] = globus_sdk.TransferData(
-                gc,
-                source_endpoint=sec_repos[isec].globus_endpoint_id,
-                destination_endpoint=pri_repos[ipri].globus_endpoint_id,
-                verify_checksum=True,
-                sync_level='checksum',
-                label=label)
-        # add the transfer to the current task
-        destination_file = _filename_from_file_record(ds, add_uuid=True)
-        source_file = _filename_from_file_record(src_file)
-        tm[ipri][isec].add_item(source_path=source_file, destination_path=destination_file)
-        logger.info(str(c) + '/' + str(nfiles) + ' ' + source_file + ' to ' + destination_file)
+        key = (src_file.data_repository, ds.data_repository)
+        plan.setdefault(key, []).append((src_file, ds))
+    return plan
+
+
+def _chunk_transfers(files, max_files=None, max_bytes=None):
+    """Split a list of (source, destination) file records in chunks of at most `max_files`
+    files and `max_bytes` bytes (a single larger file gets its own chunk)."""
+    chunks = []
+    n_bytes = 0
+    for src_file, dst_file in files:
+        size = src_file.dataset.file_size or 0
+        if (not chunks or (max_files and len(chunks[-1]) >= max_files) or
+                (max_bytes and chunks[-1] and n_bytes + size > max_bytes)):
+            chunks.append([])
+            n_bytes = 0
+        chunks[-1].append((src_file, dst_file))
+        n_bytes += size
+    return chunks
+
+
+def _transfer_data(gc, src_repo, dst_repo, files, label):
+    tdata = globus_sdk.TransferData(
+        gc,
+        source_endpoint=src_repo.globus_endpoint_id,
+        destination_endpoint=dst_repo.globus_endpoint_id,
+        verify_checksum=True,
+        sync_level='checksum',
+        label=label)
+    for src_file, dst_file in files:
+        tdata.add_item(source_path=_filename_from_file_record(src_file),
+                       destination_path=_filename_from_file_record(dst_file, add_uuid=True))
+    return tdata
+
+
+def bulk_transfer(dry_run=False, lab=None, gc=None, max_files=10000, max_bytes=None,
+                  n_threads=4):
+    """
+    uploads files from a local Globus repository to a main repository if the file on the main
+    repository does not exist.
+    should be launched after bulk_sync() function
+
+    The files of every pair of repositories are split in transfer tasks of at most
+    `max_files` files and `max_bytes` bytes, which are submitted concurrently. Return a
+    report with the number of files, bytes and tasks of every pair of repositories. A dry run
+    only returns the report, without accessing the network.
+    """
+    plan = _plan_bulk_transfer(lab=lab)
+    report = []
+    tasks = []
+    for (src_repo, dst_repo), files in plan.items():
+        chunks = _chunk_transfers(files, max_files=max_files, max_bytes=max_bytes)
+        report.append({
+            'source_data_repository': src_repo.name,
+            'destination_data_repository': dst_repo.name,
+            'files': len(files),
+            'bytes': sum(src_file.dataset.file_size or 0 for src_file, _ in files),
+            'tasks': len(chunks),
+        })
+        logger.info("%s to %s: %d files in %d tasks%s.", src_repo.name, dst_repo.name,
+                    len(files), len(chunks), ' (dry)' if dry_run else '')
+        for i, chunk in enumerate(chunks):
+            label = src_repo.name + ' to ' + dst_repo.name
+            if len(chunks) > 1:
+                label += ' (%d/%d)' % (i + 1, len(chunks))
+            tasks.append((src_repo, dst_repo, chunk, label))
     # launch the transfer tasks
     if dry_run:
-        return
-    for t in tm.flatten():
-        if t == 0:
-            continue
-        gc.submit_transfer(t)
+        return report
+    gc = gc or globus_transfer_client()
+    # every submitted task is recorded as soon as its submission succeeds, so that its files
+    # are not submitted again by the next run if another submission fails
+    errors = []
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = {executor.submit(lambda task: gc.submit_transfer(_transfer_data(gc, *task)),
+                                   task): task for task in tasks}
+        for future in as_completed(futures):
+            src_repo, dst_repo, chunk, label = futures[future]
+            try:
+                response = future.result()
+            except Exception as e:
+                logger.error("Unable to submit the transfer %s: %s", label, e)
+                errors.append(e)
+                continue
+            logger.info("%s (task UUID: %s)", response.get('message', None),
+                        response.get('task_id', None))
+            if response.get('task_id', None):
+                _record_transfer_tasks([(src_repo, dst_repo, chunk, response)])
+    if errors:
+        raise errors[0]
+    return report
+
+
+def _record_transfer_tasks(submitted):
+    """Store the submitted transfer tasks, given as a list of (source repository, destination
+    repository, [(source file record, destination file record)], submission response)."""
+    tasks = [
+        TransferTask(
+            task_id=response['task_id'],
+            source_data_repository=src_repo,
+            destination_data_repository=dst_repo,
+            bytes=sum(src_file.dataset.file_size or 0 for src_file, _ in files))
+        for src_repo, dst_repo, files, response in submitted]
+    through = TransferTask.file_records.through
+    with transaction.atomic():
+        TransferTask.objects.bulk_create(tasks, batch_size=1000)
+        through.objects.bulk_create([
+            through(transfertask_id=task.pk, filerecord_id=dst_file.pk)
+            for task, (_, _, files, _) in zip(tasks, submitted)
+            for _, dst_file in files], batch_size=1000)
+    return tasks
+
+
+def poll_transfer_tasks(gc=None, batch_size=100):
+    """
+    Update the status of the transfer tasks in flight, querying Globus for `batch_size`
+    tasks at a time. The destination files of the tasks that have succeeded are marked as
+    existing. Return the number of polled tasks by new status.
+    """
+    tasks = {str(task.task_id): task for task in
+             TransferTask.objects.filter(status__in=TransferTask.IN_FLIGHT)}
+    if not tasks:
+        return {}
+    gc = gc or globus_transfer_client()
+    task_ids = list(tasks)
+    for i in range(0, len(task_ids), batch_size):
+        batch = task_ids[i:i + batch_size]
+        for doc in gc.task_list(filter='task_id:' + ','.join(batch), limit=len(batch)):
+            task = tasks.get(str(doc['task_id']), None)
+            if task is None:
+                continue
+            task.status = doc.get('status', None) or task.status
+            task.bytes_transferred = doc.get('bytes_transferred', None) or 0
+            if doc.get('completion_time', None):
+                task.completion_datetime = parse_datetime(doc['completion_time'])
+    succeeded = [task.pk for task in tasks.values() if task.status == TransferTask.SUCCEEDED]
+    with transaction.atomic():
+        TransferTask.objects.bulk_update(
+            tasks.values(), ['status', 'bytes_transferred', 'completion_datetime'],
+            batch_size=1000)
+        transferred = FileRecord.objects.filter(transfer_tasks__in=succeeded, exists=False)
+        dataset_ids = list(transferred.values_list('dataset_id', flat=True).distinct())
+        n_files = transferred.update(exists=True)
+        update_dataset_completeness(dataset_ids)
+    counts = {}
+    for task in tasks.values():
+        counts[task.status] = counts.get(task.status, 0) + 1
+    logger.info("Polled %d transfer tasks (%s), %d files now exist.", len(tasks),
+                ', '.join('%s: %d' % item for item in sorted(counts.items())), n_files)
+    return counts
 
 
 def _get_session(subject=None, date=None, number=None, user=None):
@@ -1,14 +1,19 @@
 import logging
 import re
+import tempfile
 
 from django.contrib.auth import get_user_model
-from rest_framework import generics, permissions, viewsets, mixins, serializers
+from django.http import FileResponse
+from rest_framework import exceptions, generics, permissions, viewsets, mixins, serializers
 from rest_framework.response import Response
 import django_filters
 from django_filters.rest_framework import FilterSet
 
+from alyx.base import KeysetPagination, StreamingListMixin, ValuesListMixin
 from subjects.models import Subject, Project
-from misc.models import Lab
+from misc.jobs import enqueue
+from misc.models import Job, Lab
+from misc.serializers import JobSerializer
 from .models import (DataRepositoryType,
                      DataRepository,
                      DataFormat,
@@ -23,14 +28,23 @@ from .serializers import (DataRepositoryTypeSerializer,
                           DataFormatSerializer,
                           DatasetTypeSerializer,
                           DatasetSerializer,
+                          DatasetValuesSerializer,
                           DownloadSerializer,
                           FileRecordSerializer,
+                          FileRecordValuesSerializer,
                           )
+from .export import EXPORT_FORMATS, EXPORT_TABLES, export_table
 from .transfers import (_get_session, _get_repositories_for_labs,
-                        _create_dataset_file_records, bulk_sync)
+                        _create_dataset_file_records_bulk)
 
 logger = logging.getLogger(__name__)
 
+EXPORT_CONTENT_TYPES = {
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file',
+    'npy': 'application/zip',
+}
+
 # DataRepositoryType
 # ------------------------------------------------------------------------------------------------
 
@@ -119,12 +133,19 @@ class DatasetFilter(FilterSet):
         exclude = ['json']
 
 
-class DatasetList(generics.ListCreateAPIView):
+class DatasetList(ValuesListMixin, StreamingListMixin, generics.ListCreateAPIView):
     queryset = Dataset.objects.all()
-    queryset = DatasetSerializer.setup_eager_loading(queryset)
     serializer_class = DatasetSerializer
+    values_serializer_class = DatasetValuesSerializer
     permission_classes = (permissions.IsAuthenticated,)
     filter_class = DatasetFilter
+    pagination_class = KeysetPagination
+    cursor_ordering = ('created_datetime', 'id')
+
+    def get_queryset(self):
+        # Only load the relations of the requested fields.
+        return DatasetSerializer.setup_eager_loading(
+            Dataset.objects.all(), DatasetSerializer.requested_fields(self.request))
 
 
 class DatasetDetail(generics.RetrieveUpdateDestroyAPIView):
@@ -132,16 +153,31 @@ class DatasetDetail(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = DatasetSerializer
     permission_classes = (permissions.IsAuthenticated,)
 
+    def get_queryset(self):
+        return DatasetSerializer.setup_eager_loading(
+            Dataset.objects.all(), DatasetSerializer.requested_fields(self.request))
+
 
 # FileRecord
 # ------------------------------------------------------------------------------------------------
 
-class FileRecordList(generics.ListCreateAPIView):
+class FileRecordFilter(FilterSet):
+    class Meta:
+        model = FileRecord
+        fields = ('exists', 'dataset')
+
+
+class FileRecordList(ValuesListMixin, StreamingListMixin, generics.ListCreateAPIView):
     queryset = FileRecord.objects.all()
     queryset = FileRecordSerializer.setup_eager_loading(queryset)
     serializer_class = FileRecordSerializer
+    values_serializer_class = FileRecordValuesSerializer
     permission_classes = (permissions.IsAuthenticated,)
-    filter_fields = ('exists', 'dataset')
+    filter_class = FileRecordFilter
+    pagination_class = KeysetPagination
+    # The file records have no creation date: the keyset pages follow the primary key
+    # index, in a stable but arbitrary order.
+    cursor_ordering = ('id',)
 
 
 class FileRecordDetail(generics.RetrieveUpdateDestroyAPIView):
@@ -150,14 +186,47 @@ class FileRecordDetail(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = (permissions.IsAuthenticated,)
 
 
+# Columnar export
+# ------------------------------------------------------------------------------------------------
+
+class ColumnarExport(generics.GenericAPIView):
+    """
+    Export the sessions, datasets or file records to a columnar file: `export/<table>.<format>`
+    where the table is `sessions`, `datasets` or `files` and the format is `parquet`, `arrow`
+    or `npy` (zip archive of ALF files). The query parameters are the filters of the
+    corresponding list endpoint, for example `export/datasets.parquet?subject=ZM_1085`.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, table=None, export_format=None):
+        if table not in EXPORT_TABLES or export_format not in EXPORT_FORMATS:
+            raise exceptions.NotFound("Unknown export `%s.%s`" % (table, export_format))
+        # Spooled to disk so that large exports do not stay in memory.
+        f = tempfile.TemporaryFile()
+        try:
+            export_table(table, f, export_format, params=request.query_params)
+        except ImportError as e:
+            f.close()
+            raise exceptions.NotAcceptable(str(e))
+        except ValueError as e:
+            f.close()
+            raise exceptions.ValidationError(str(e))
+        f.seek(0)
+        extension = 'zip' if export_format == 'npy' else export_format
+        return FileResponse(f, as_attachment=True, filename='%s.%s' % (table, extension),
+                            content_type=EXPORT_CONTENT_TYPES[export_format])
+
+
 # Register file
 # ------------------------------------------------------------------------------------------------
 
-def _make_dataset_response(dataset):
+def _make_dataset_response(dataset, file_records=None):
     if not dataset:
         return None
 
     # Return the file records.
+    if file_records is None:
+        file_records = FileRecord.objects.filter(dataset=dataset)
     file_records = [
         {
             'id': fr.pk,
@@ -165,7 +234,7 @@ def _make_dataset_response(dataset):
             'relative_path': fr.relative_path,
             'exists': fr.exists,
         }
-        for fr in FileRecord.objects.filter(dataset=dataset)]
+        for fr in file_records]
 
     out = {
         'id': dataset.pk,
@@ -287,30 +356,37 @@ class RegisterFileViewSet(mixins.CreateModelMixin,
             subject=subject, date=date, number=session_number, user=user)
         assert session
 
-        response = []
-        for filename in filenames:
-            if not filename:
-                continue
-            dataset = _create_dataset_file_records(
-                rel_dir_path=rel_dir_path, filename=filename, session=session, user=user,
-                repositories=repositories, exists_in=exists_in)
-            out = _make_dataset_response(dataset)
-            response.append(out)
+        # Register all files at once, in a single transaction.
+        records = _create_dataset_file_records_bulk(
+            rel_dir_path=rel_dir_path, filenames=filenames, session=session, user=user,
+            repositories=repositories, exists_in=exists_in)
+        response = [_make_dataset_response(dataset, file_records)
+                    for dataset, file_records in records]
 
         return Response(response, status=201)
 
 
 class SyncViewSet(viewsets.GenericViewSet):
-
-    serializer_class = serializers.Serializer
+    """
+    POST enqueues a synchronization of the file records with the Globus endpoints, run by
+    the `run_jobs` management command, and returns the job at once. The optional `lab`
+    restricts the synchronization to the repositories of a lab. GET returns the status and
+    progress of the last synchronization job.
+    """
+    serializer_class = JobSerializer
 
     def sync(self, request):
-        bulk_sync()
-        return Response("ok", status=200)
+        lab = request.data.get('lab') or None
+        kwargs = {'lab': lab} if lab else {}
+        job = enqueue('sync_file_status', key=lab or '', **kwargs)
+        return Response(self.get_serializer(job).data, status=202)
 
     def sync_status(self, request):
-        rep = bulk_sync(dry_run=True)
-        return Response(rep, status=200)
+        lab = request.query_params.get('lab') or ''
+        job = Job.objects.filter(name='sync_file_status', key=lab).first()
+        if job is None:
+            raise exceptions.NotFound("No file status synchronization has been run.")
+        return Response(self.get_serializer(job).data, status=200)
 
 
 class DownloadViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
@@ -10,7 +10,7 @@ from django.contrib.postgres.fields import JSONField
 from django.utils.html import format_html, format_html_join
 
 from misc.models import Note, Lab, LabMembership, LabLocation, CageType,\
-    Enrichment, Food, Housing, HousingSubject
+    Enrichment, Food, Housing, HousingSubject, Job
 from alyx.base import BaseAdmin, DefaultListFilter, get_admin_url
 
 
@@ -265,6 +265,18 @@ class HousingAdmin(BaseAdmin):
     subjects_old.short_description = 'old subjects'
 
 
+class JobAdmin(BaseAdmin):
+    fields = ('name', 'key', 'status', 'json', 'run_at', 'created_datetime',
+              'started_datetime', 'finished_datetime', 'progress', 'message',
+              'cancel_requested', 'result', 'error')
+    list_display = ('name', 'key', 'status', 'progress', 'run_at', 'started_datetime',
+                    'finished_datetime')
+    readonly_fields = fields
+    list_filter = ('status', 'name')
+    search_fields = ('name', 'key')
+    ordering = ('-created_datetime',)
+
+
 admin.site.register(Housing, HousingAdmin)
 admin.site.register(Lab, LabAdmin)
 admin.site.register(LabMembership, LabMembershipAdmin)
@@ -273,3 +285,4 @@ admin.site.register(Note, NoteAdmin)
 admin.site.register(CageType, CageTypeAdmin)
 admin.site.register(Enrichment, EnrichmentAdmin)
 admin.site.register(Food, FoodAdmin)
+admin.site.register(Job, JobAdmin)
@@ -0,0 +1,179 @@
+"""Database-backed job queue.
+
+The jobs are rows of the `Job` table, run by the `run_jobs` management command, so that
+slow side effects and long maintenance operations are taken out of the HTTP requests
+without an external broker. A job is enqueued in the transaction of the request: it is not
+run if the request fails. Several workers can run at the same time, the pending jobs are
+claimed with `SELECT ... FOR UPDATE SKIP LOCKED`.
+
+The pending jobs with the same name and key are coalesced into one: for example five
+weighings of a subject added in a row produce a single `check_weighing` job.
+
+A running job reports its progress with `report_progress()`, which also stops the job
+when its cancellation has been requested.
+
+"""
+
+from datetime import timedelta
+from io import StringIO
+import json
+import logging
+import threading
+import time
+import traceback
+
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from misc.models import Job
+
+
+logger = logging.getLogger(__name__)
+
+
+# Job name: function called with the keyword arguments stored in the json of the job.
+JOBS = {
+    'check_weighing': 'actions.notifications.check_subject_weighing',
+    'update_water_ledger': 'actions.water_ledger.fill_water_ledger',
+    'sync_file_status': 'data.transfers.bulk_sync',
+    'command': 'misc.jobs.call_management_command',
+}
+
+# Management commands which can be run by the `command` job.
+COMMAND_JOBS = ('backup', 'dump', 'files', 'report')
+
+# Minimum number of seconds between two progress reports saved to the database.
+PROGRESS_INTERVAL = 1.
+
+_local = threading.local()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def enqueue(name, key=None, delay=0, **kwargs):
+    """Add a job to the queue, to be run in `delay` seconds at the earliest. If a pending
+    job with the same name and key already exists, return it instead of adding another
+    one."""
+    if name not in JOBS:
+        raise ValueError("Unknown job `%s`, must be one of %s." % (name, ', '.join(JOBS)))
+    job = Job(name=name, key=key, json=kwargs or None,
+              run_at=timezone.now() + timedelta(seconds=delay))
+    if key is None:
+        job.save()
+        return job
+    Job.objects.bulk_create([job], ignore_conflicts=True)
+    return Job.objects.filter(name=name, key=key, status=Job.PENDING).first() or job
+
+
+def claim_job():
+    """Mark the next pending job due to run as running and return it, or None. The pending
+    jobs locked by another worker are skipped."""
+    now = timezone.now()
+    with transaction.atomic():
+        job = (Job.objects.select_for_update(skip_locked=True).
+               filter(status=Job.PENDING, run_at__lte=now).
+               order_by('run_at').first())
+        if job is None:
+            return None
+        job.status = Job.RUNNING
+        job.started_datetime = now
+        job.save(update_fields=['status', 'started_datetime'])
+    return job
+
+
+def _json_result(result):
+    try:
+        return json.loads(json.dumps(result, cls=DjangoJSONEncoder))
+    except TypeError:
+        return str(result)
+
+
+def run_job(job):
+    """Run a claimed job and record whether it succeeded."""
+    _local.job, _local.reported = job, 0
+    try:
+        func = import_string(JOBS[job.name])
+        job.result = _json_result(func(**(job.json or {})))
+    except JobCancelled:
+        logger.info("Job %s %s cancelled.", job.name, job.pk)
+        job.status = Job.CANCELLED
+    except Exception:
+        logger.exception("Job %s %s failed.", job.name, job.pk)
+        job.status = Job.FAILED
+        job.error = traceback.format_exc()
+    else:
+        job.status = Job.SUCCEEDED
+        job.progress = 1.
+    finally:
+        _local.job = None
+    job.finished_datetime = timezone.now()
+    job.save(update_fields=['status', 'progress', 'result', 'error', 'finished_datetime'])
+    return job
+
+
+def report_progress(progress=None, message=''):
+    """Save the progress of the running job, a fraction between 0 and 1, at most every
+    PROGRESS_INTERVAL seconds, and raise JobCancelled if its cancellation has been requested.
+    Do nothing outside of a job."""
+    job = getattr(_local, 'job', None)
+    if job is None or time.monotonic() - _local.reported < PROGRESS_INTERVAL:
+        return
+    _local.reported = time.monotonic()
+    job.progress, job.message = progress, message[:255]
+    Job.objects.filter(pk=job.pk).update(progress=progress, message=job.message)
+    if Job.objects.filter(pk=job.pk, cancel_requested=True).exists():
+        raise JobCancelled()
+
+
+def cancel_job(job):
+    """Cancel a pending job, or request the cancellation of a running job, which stops at
+    its next progress report."""
+    if Job.objects.filter(pk=job.pk, status=Job.PENDING).update(
+            status=Job.CANCELLED, finished_datetime=timezone.now()) == 0:
+        Job.objects.filter(pk=job.pk, status=Job.RUNNING).update(cancel_requested=True)
+    job.refresh_from_db()
+    return job
+
+
+def call_management_command(command, args=(), **options):
+    """Job running one of the COMMAND_JOBS management commands, return its output."""
+    if command not in COMMAND_JOBS:
+        raise ValueError("Unknown command `%s`, must be one of %s." % (
+            command, ', '.join(COMMAND_JOBS)))
+    stdout = StringIO()
+    call_command(command, *args, stdout=stdout, **options)
+    return stdout.getvalue()
+
+
+def run_jobs(max_jobs=None):
+    """Run the pending jobs due to run, at most `max_jobs`. Return the number of jobs
+    run."""
+    n_jobs = 0
+    while max_jobs is None or n_jobs < max_jobs:
+        job = claim_job()
+        if job is None:
+            break
+        run_job(job)
+        n_jobs += 1
+    return n_jobs
+
+
+def fail_stale_jobs(timeout):
+    """Mark as failed the jobs running for more than `timeout` seconds, whose worker was
+    probably stopped. Return their number."""
+    started = timezone.now() - timedelta(seconds=timeout)
+    return Job.objects.filter(status=Job.RUNNING, started_datetime__lt=started).update(
+        status=Job.FAILED, error='Timed out', finished_datetime=timezone.now())
+
+
+def purge_jobs(days):
+    """Delete the jobs finished more than `days` days ago. Return their number."""
+    finished = timezone.now() - timedelta(days=days)
+    n_jobs, _ = Job.objects.filter(
+        status__in=Job.FINISHED, finished_datetime__lt=finished).delete()
+    return n_jobs
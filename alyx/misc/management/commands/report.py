@@ -13,6 +13,8 @@ from django.utils import timezone
 
 from alyx.base import alyx_mail
 from actions.models import Surgery, WaterRestriction, Session
+from actions.water_control import weight_status
+from actions.water_ledger import current_water_ledger, water_ledger
 from subjects.models import Subject
 
 logger = logging.getLogger(__name__)
@@ -110,35 +112,38 @@ class Command(BaseCommand):
                                              end_time__isnull=True,
                                              subject__responsible_user=user,
                                              ).order_by('subject__nickname')
+        wr = wr.select_related('subject', 'subject__lab')
         if not wr:
             return
+        current = current_water_ledger({w.subject for w in wr})
         text = "Mice on water restriction:\n"
         # Hench since 2017-04-20. Weight yesterday 27.2g (expected 30.0g, 90.7%).
         # Yesterday given 1.02mL (min 0.96mL, excess 0.06mL). Today requires 0.97mL.
         for w in wr:
             s = w.subject
-            wc = s.water_control
             sn = w.subject.nickname
             sd = w.start_time.date()
             today = timezone.now()
             yesterday = (today - timedelta(days=1)).date()
-            # Weight yesterday.
-            wy = wc.last_weighing_before(date=yesterday)
-            if wy is None:
-                continue
+            records = water_ledger(s, end_date=today)
             # Last date with weighing, might be yesterday or earlier.
-            last_date = wy[0].date()
+            weighed = [r for r in records
+                       if r['date'] <= yesterday and r['weighing_at'] is not None]
+            if not weighed or not records:
+                continue
+            last = weighed[-1]
+            last_date = last['date']
             # Number of days ago.
             n = (today.date() - last_date).days
-            wy = wy[1]
+            wy = last['weight']
             # Expected weight at the last date.
-            wye = wc.expected_weight(date=last_date)
-            wyep = wc.percentage_weight(date=last_date)
+            wye = last['expected_weight']
+            wyep = last['percentage_weight']
             # Water
-            way = wc.given_water_total(date=last_date)
-            waym = wc.expected_water(date=last_date)
-            waye = wc.excess_water(date=last_date)
-            wr = wc.remaining_water()  # remaining water TODAY
+            way = last['given_water_total']
+            waym = last['expected_water']
+            waye = last['excess_water']
+            wr = -current[s.pk]['excess_water']  # remaining water TODAY
             s = '''
                 * {sn} since {sd}.
                 Weight {n} day(s) ago: {wy:.1f}g (expected {wye:.1f}g, {wyep:.1f}%).
@@ -157,19 +162,23 @@ class Command(BaseCommand):
         if self.lab:
             wr = wr.filter(subject__lab__name=self.lab)
         subject_ids = [_[0] for _ in wr.values_list('subject').distinct()]
+        subjects = Subject.objects.filter(pk__in=subject_ids).select_related(
+            'responsible_user', 'lab')
         text = ''
-        for subject_id in subject_ids:
-            subject = Subject.objects.get(pk=subject_id)
-            wc = subject.water_control
-            w = wc.weight()
-            e = wc.expected_weight()
-            p = wc.percentage_weight()
-            last_weighing = wc.last_weighing_before()
-            if not last_weighing:
+        currents = current_water_ledger(subjects)
+        for subject in subjects:
+            records = water_ledger(subject)
+            weighed = [r for r in records if r['weighing_at'] is not None]
+            if not weighed:
                 continue
-            date = last_weighing[0]
-            threshold = max(wc.zscore_weight_pct, wc.reference_weight_pct)
-            if wc.weight_status() > 0:
+            current = currents[subject.pk]
+            w = current['weight']
+            e = current['expected_weight']
+            p = current['percentage_weight']
+            date = weighed[-1]['date']
+            lab = subject.lab
+            threshold = max(lab.zscore_weight_pct, lab.reference_weight_pct) if lab else 0
+            if weight_status(p, threshold) > 0:
                 text += ('* {subject} ({user} <{email}>) weighed {weight:.1f}g '
                          'instead of {expected:.1f}g ({percentage:.1f}%) on {date}\n').format(
                              subject=subject,
@@ -0,0 +1,38 @@
+import logging
+import time
+
+from django.core.management import BaseCommand
+
+from misc.jobs import fail_stale_jobs, purge_jobs, run_jobs
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Run the jobs of the database queue (weighing checks, file status "
+            "synchronizations, maintenance commands...). Several workers can run at the same "
+            "time.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Run the pending jobs and exit instead of polling the queue')
+        parser.add_argument('--sleep', type=float, default=5.,
+                            help='Seconds between two polls of an empty queue')
+        parser.add_argument('--timeout', type=float, default=24 * 3600,
+                            help='Seconds after which a running job is marked as failed')
+        parser.add_argument('--keep-days', type=int, default=30,
+                            help='Days during which the finished jobs are kept')
+
+    def handle(self, *args, **options):
+        n_stale = fail_stale_jobs(options['timeout'])
+        if n_stale:
+            logger.warning("Marked %d stale jobs as failed.", n_stale)
+        purge_jobs(options['keep_days'])
+        while True:
+            n_jobs = run_jobs()
+            if n_jobs:
+                logger.info("Ran %d jobs.", n_jobs)
+            if options['once']:
+                break
+            time.sleep(options['sleep'])
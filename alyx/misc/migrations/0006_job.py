@@ -0,0 +1,42 @@
+# Generated by Django 2.2.28 on 2026-10-17 07:27
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('misc', '0005_lab_repositories'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(blank=True, help_text='Long name', max_length=255)),
+                ('json', django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='Structured data, formatted in a user-defined way', null=True)),
+                ('key', models.CharField(blank=True, help_text='Pending jobs with the same name and key are run only once', max_length=255, null=True)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('SUCCEEDED', 'Succeeded'), ('FAILED', 'Failed')], db_index=True, default='PENDING', max_length=16)),
+                ('run_at', models.DateTimeField(default=django.utils.timezone.now, help_text='The job is not run before this date')),
+                ('created_datetime', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_datetime', models.DateTimeField(blank=True, null=True)),
+                ('finished_datetime', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ('-created_datetime',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'run_at'], name='misc_job_status_62ee94_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='job',
+            constraint=models.UniqueConstraint(condition=models.Q(status='PENDING'), fields=('name', 'key'), name='unique_pending_job'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.28 on 2026-10-17 07:33
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('misc', '0006_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='cancel_requested',
+            field=models.BooleanField(default=False, help_text='The running job stops at its next progress report'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='message',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='progress',
+            field=models.FloatField(blank=True, help_text='Fraction of the job done, reported by the job', null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='result',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, help_text='Value returned by the job', null=True),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('SUCCEEDED', 'Succeeded'), ('FAILED', 'Failed'), ('CANCELLED', 'Cancelled')], db_index=True, default='PENDING', max_length=16),
+        ),
+    ]
@@ -12,6 +12,7 @@ from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.fields import JSONField
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.utils import timezone
 
@@ -297,3 +298,53 @@ class HousingSubject(BaseModel):
             super(HousingSubject, self).save(force_update=True)  # self.save(force_insert=True)
             return
         super(HousingSubject, self).save(**kwargs)
+
+
+class Job(BaseModel):
+    """
+    A job of the database-backed queue run by the `run_jobs` management command. The name
+    is the type of job (see misc.jobs.JOBS) and the json its keyword arguments. The pending
+    jobs with the same name and key are coalesced into one.
+    """
+    PENDING = 'PENDING'
+    RUNNING = 'RUNNING'
+    SUCCEEDED = 'SUCCEEDED'
+    FAILED = 'FAILED'
+    CANCELLED = 'CANCELLED'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    )
+    FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+    key = models.CharField(
+        max_length=255, null=True, blank=True,
+        help_text="Pending jobs with the same name and key are run only once")
+    status = models.CharField(
+        max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    run_at = models.DateTimeField(
+        default=timezone.now, help_text="The job is not run before this date")
+    created_datetime = models.DateTimeField(default=timezone.now)
+    started_datetime = models.DateTimeField(null=True, blank=True)
+    finished_datetime = models.DateTimeField(null=True, blank=True)
+    progress = models.FloatField(
+        null=True, blank=True, help_text="Fraction of the job done, reported by the job")
+    message = models.CharField(max_length=255, blank=True)
+    cancel_requested = models.BooleanField(
+        default=False, help_text="The running job stops at its next progress report")
+    result = JSONField(null=True, blank=True, help_text="Value returned by the job")
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ('-created_datetime',)
+        indexes = [models.Index(fields=['status', 'run_at'])]
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'key'], condition=models.Q(status='PENDING'),
+                                    name='unique_pending_job'),
+        ]
+
+    def __str__(self):
+        return "<Job %s %s (%s)>" % (self.name, self.key or '', self.status)
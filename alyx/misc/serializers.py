@@ -2,7 +2,8 @@ from rest_framework import serializers
 from django.contrib.auth import get_user_model
 
 from subjects.models import Subject
-from misc.models import Lab
+from misc.jobs import COMMAND_JOBS, JOBS, enqueue
+from misc.models import Job, Lab
 from data.models import DataRepository
 
 
@@ -35,3 +36,31 @@ class LabSerializer(serializers.HyperlinkedModelSerializer):
                   'reference_weight_pct', 'zscore_weight_pct')
         lookup_field = 'name'
         extra_kwargs = {'url': {'view_name': 'lab-detail', 'lookup_field': 'name'}}
+
+
+class JobSerializer(serializers.HyperlinkedModelSerializer):
+    name = serializers.ChoiceField(choices=sorted(JOBS))
+    json = serializers.JSONField(required=False, allow_null=True)
+
+    def validate(self, data):
+        kwargs = data.get('json') or {}
+        if not isinstance(kwargs, dict):
+            raise serializers.ValidationError({'json': "The job arguments must be a dict."})
+        if data['name'] == 'command' and kwargs.get('command') not in COMMAND_JOBS:
+            raise serializers.ValidationError(
+                {'json': "The command must be one of %s." % ', '.join(COMMAND_JOBS)})
+        return data
+
+    def create(self, validated_data):
+        return enqueue(validated_data['name'], key=validated_data.get('key'),
+                       **(validated_data.get('json') or {}))
+
+    class Meta:
+        model = Job
+        fields = ('id', 'url', 'name', 'key', 'json', 'status', 'progress', 'message',
+                  'result', 'error', 'run_at', 'created_datetime', 'started_datetime',
+                  'finished_datetime', 'cancel_requested')
+        read_only_fields = ('status', 'progress', 'message', 'result', 'error', 'run_at',
+                            'created_datetime', 'started_datetime', 'finished_datetime',
+                            'cancel_requested')
+        extra_kwargs = {'url': {'view_name': 'job-detail'}}
@@ -1,8 +1,15 @@
 from datetime import datetime, timedelta
+from unittest import mock
+
+from django.core.management import call_command
 from django.test import TestCase
+from django.utils import timezone
 
+from actions.models import Weighing
 from subjects.models import Subject
-from misc.models import Housing, HousingSubject, CageType
+from misc.jobs import (
+    cancel_job, enqueue, fail_stale_jobs, purge_jobs, report_progress, run_jobs)
+from misc.models import Housing, HousingSubject, CageType, Job, Lab
 
 
 class HousingTests(TestCase):
@@ -103,3 +110,94 @@ class HousingTests(TestCase):
                                       start_datetime=datetime.now())
         self.assertEqual(self.hou2.subjects_current().count(), 1)
         self.assertEqual(self.hou1.subjects_current().count(), 2)
+
+
+def _failing_job(value):
+    raise ValueError("Invalid value %s" % value)
+
+
+def _progress_job(n):
+    for i in range(n):
+        report_progress(i / n, "Step %d" % i)
+        if i == 1:
+            Job.objects.update(cancel_requested=True)
+    return n
+
+
+class JobTests(TestCase):
+
+    def setUp(self):
+        lab = Lab.objects.create(name='joblab')
+        self.sub1 = Subject.objects.create(nickname='sub1', lab=lab)
+        self.sub2 = Subject.objects.create(nickname='sub2', lab=lab)
+
+    def test_weighing_checks_coalesced(self):
+        for i in range(5):
+            Weighing.objects.create(subject=self.sub1, weight=20 + i)
+        Weighing.objects.create(subject=self.sub2, weight=20)
+        jobs = Job.objects.filter(name='check_weighing', status=Job.PENDING)
+        self.assertEqual(sorted(jobs.values_list('key', flat=True)),
+                         sorted([str(self.sub1.pk), str(self.sub2.pk)]))
+        with mock.patch('actions.notifications.check_weighing') as check_weighing:
+            call_command('run_jobs', once=True)
+        self.assertEqual(sorted(c[0][0].pk for c in check_weighing.call_args_list),
+                         sorted([self.sub1.pk, self.sub2.pk]))
+        self.assertEqual(Job.objects.filter(status=Job.SUCCEEDED).count(), 2)
+        # a new weighing enqueues a new check once the previous one has run
+        Weighing.objects.create(subject=self.sub1, weight=30)
+        self.assertEqual(Job.objects.filter(status=Job.PENDING).count(), 1)
+
+    def test_failed_job(self):
+        with mock.patch.dict('misc.jobs.JOBS', fail='misc.tests._failing_job'):
+            job = enqueue('fail', value=3)
+            self.assertEqual(run_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIn('Invalid value 3', job.error)
+        self.assertIsNotNone(job.finished_datetime)
+        with self.assertRaises(ValueError):
+            enqueue('unknown')
+
+    def test_delayed_job(self):
+        job = enqueue('check_weighing', key=str(self.sub1.pk), delay=3600,
+                      subject=str(self.sub1.pk))
+        self.assertEqual(run_jobs(), 0)
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        self.assertEqual(run_jobs(), 1)
+
+    def test_stale_and_old_jobs(self):
+        old = timezone.now() - timedelta(days=40)
+        Job.objects.create(name='check_weighing', status=Job.RUNNING, started_datetime=old)
+        self.assertEqual(fail_stale_jobs(3600), 1)
+        self.assertEqual(Job.objects.get().status, Job.FAILED)
+        Job.objects.update(finished_datetime=old)
+        self.assertEqual(purge_jobs(30), 1)
+        self.assertFalse(Job.objects.exists())
+
+    def test_progress_and_cancel(self):
+        with mock.patch.dict('misc.jobs.JOBS', progress='misc.tests._progress_job'), \
+                mock.patch('misc.jobs.PROGRESS_INTERVAL', 0):
+            job = enqueue('progress', n=5)
+            run_jobs()
+        job.refresh_from_db()
+        # the job has stopped at the report following the cancellation request
+        self.assertEqual(job.status, Job.CANCELLED)
+        self.assertEqual((job.progress, job.message), (.4, "Step 2"))
+        # a pending job is cancelled at once
+        job = cancel_job(enqueue('check_weighing', subject=str(self.sub1.pk)))
+        self.assertEqual(job.status, Job.CANCELLED)
+        self.assertEqual(run_jobs(), 0)
+        # outside of a job, the progress is not reported
+        report_progress(.5)
+
+    def test_command_job(self):
+        job = enqueue('command', command='report', args=['--list'])
+        run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.progress, 1.)
+        self.assertIn('water', job.result)
+        job = enqueue('command', command='reset_db')
+        run_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
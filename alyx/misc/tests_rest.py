@@ -4,7 +4,8 @@ from django.urls import reverse
 from django.contrib.auth import get_user_model
 
 from alyx.base import BaseTests
-from misc.models import LabMembership, Lab
+from misc.jobs import run_jobs
+from misc.models import Job, LabMembership, Lab
 
 
 class APIActionsTests(BaseTests):
@@ -40,3 +41,33 @@ class APIActionsTests(BaseTests):
     def test_user_rest(self):
         response = self.client.get(reverse('user-list') + '/test')
         self.ar(response, 200)
+
+    def test_jobs(self):
+        url = reverse('job-list')
+        d = self.ar(self.client.post(
+            url, {'name': 'command', 'json': {'command': 'report', 'args': ['--list']}},
+            format='json'), 201)
+        self.assertEqual(d['status'], Job.PENDING)
+        job_url = d['url']
+        self.assertEqual(self.ar(self.client.get(url + '?status=PENDING'), 200)[0]['url'],
+                         job_url)
+        run_jobs()
+        d = self.ar(self.client.get(job_url), 200)
+        self.assertEqual((d['status'], d['progress']), (Job.SUCCEEDED, 1.))
+        self.assertTrue(d['result'])
+        # only the maintenance commands can be run
+        self.ar(self.client.post(
+            url, {'name': 'command', 'json': {'command': 'reset_db'}}, format='json'), 400)
+        self.ar(self.client.post(url, {'name': 'unknown'}, format='json'), 400)
+        # cancellation of a pending job
+        d = self.ar(self.client.post(
+            url, {'name': 'command', 'json': {'command': 'report'}}, format='json'), 201)
+        d = self.ar(self.client.post(d['url'] + '/cancel'), 200)
+        self.assertEqual(d['status'], Job.CANCELLED)
+        self.assertEqual(run_jobs(), 0)
+        # the users who are not staff cannot enqueue jobs
+        get_user_model().objects.create_user('nostaff', 'nostaff', 'nostaff')
+        self.client.login(username='nostaff', password='nostaff')
+        self.ar(self.client.get(job_url), 200)
+        self.ar(self.client.post(url, {'name': 'command', 'json': {'command': 'report'}},
+                                 format='json'), 403)
@@ -9,9 +9,11 @@ from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from rest_framework.reverse import reverse
 from rest_framework import generics, permissions
+from django_filters.rest_framework import FilterSet
 
-from .serializers import UserSerializer, LabSerializer
-from .models import Lab
+from .jobs import cancel_job
+from .serializers import UserSerializer, LabSerializer, JobSerializer
+from .models import Lab, Job
 from alyx.settings import MEDIA_ROOT
 
 
@@ -92,3 +94,55 @@ class UploadedView(views.APIView):
         with open(path, 'rb') as f:
             data = f.read()
         return HttpResponse(data, content_type=mime)
+
+
+class IsStaffOrReadOnly(permissions.IsAuthenticated):
+    """Read access for the authenticated users, write access for the staff."""
+
+    def has_permission(self, request, view):
+        return (super(IsStaffOrReadOnly, self).has_permission(request, view) and
+                (request.method in permissions.SAFE_METHODS or request.user.is_staff))
+
+
+class JobFilter(FilterSet):
+
+    class Meta:
+        model = Job
+        fields = ('name', 'key', 'status')
+
+
+class JobList(generics.ListCreateAPIView):
+    """
+    Jobs of the database queue, run by the `run_jobs` management command. POST enqueues a
+    job, for example `{"name": "command", "json": {"command": "report", "args": ["--lab",
+    "cortexlab"]}}`, and returns it at once with its url, from which its status and progress
+    can be followed.
+
+    Filter implementation examples:
+
+    -   `/jobs?name=sync_file_status`
+    -   `/jobs?status=RUNNING`
+    """
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+    permission_classes = (IsStaffOrReadOnly,)
+    filter_class = JobFilter
+
+
+class JobDetail(generics.RetrieveAPIView):
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+
+class JobCancel(generics.GenericAPIView):
+    """
+    POST cancels a pending job, or stops a running job at its next progress report.
+    """
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+    permission_classes = (IsStaffOrReadOnly,)
+
+    def post(self, request, pk=None):
+        job = cancel_job(self.get_object())
+        return Response(self.get_serializer(job).data, status=200)
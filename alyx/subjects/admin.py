@@ -22,6 +22,7 @@ from actions.models import (
     Surgery, Session, OtherAction, WaterAdministration, WaterRestriction, Weighing)
 from misc.models import LabMember, Housing
 from misc.admin import NoteInline
+from actions.admin import WaterControlCacheStatsMixin
 
 
 # Utility functions
@@ -300,7 +301,7 @@ class SubjectForm(forms.ModelForm):
         return new_ru
 
 
-class SubjectAdmin(BaseAdmin):
+class SubjectAdmin(WaterControlCacheStatsMixin, BaseAdmin):
     HOUSING_FIELDS = ('housing_l', 'cage_name', 'cage_type', 'light_cycle', 'enrichment',
                       'food', 'cage_mates_l')
     fieldsets = (
@@ -14,7 +14,8 @@ from django.utils import timezone
 
 from alyx.base import BaseModel, alyx_mail, modify_fields
 from actions.notifications import responsible_user_changed
-from actions.water_control import water_control
+from actions.water_control import (
+    water_control, water_control_version, cached_water_control, cache_water_control)
 from misc.models import Lab, default_lab, Housing
 
 logger = logging.getLogger(__name__)
@@ -296,13 +297,15 @@ class Subject(BaseModel):
             return tz
 
     def reinit_water_control(self):
+        version = water_control_version(self.id)
         self._water_control = water_control(self)
+        cache_water_control(self._water_control, version)
         return self._water_control
 
     @property
     def water_control(self):
         if self._water_control is None:
-            self.reinit_water_control()
+            self._water_control = cached_water_control(self)
         return self._water_control
 
     def zygosity_strings(self):
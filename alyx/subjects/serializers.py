@@ -1,17 +1,35 @@
+from django.db import models
 from rest_framework import serializers
 from .models import (Allele, Line, Litter, Source, Species, Strain, Subject, Zygosity,
                      Project)
 from actions.serializers import (WeighingDetailSerializer,
                                  WaterAdministrationDetailSerializer,
                                  )
+from actions.water_control import cached_water_control_many
 from django.contrib.auth import get_user_model
 from misc.models import Lab
+from alyx.base import SparseFieldsMixin, sparse_eager_loading
 
 SUBJECT_LIST_SERIALIZER_FIELDS = ('nickname', 'url', 'id', 'responsible_user', 'birth_date',
                                   'age_weeks', 'death_date', 'species', 'sex', 'litter', 'strain',
                                   'source', 'line', 'projects', 'lab', 'genotype', 'description',
                                   'alive', 'reference_weight', 'last_water_restriction',
                                   'expected_water', 'remaining_water')
+WATER_CONTROL_FIELDS = ('reference_weight', 'last_water_restriction', 'expected_water',
+                        'remaining_water')
+
+
+class _WaterRestrictionListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        """Get the water control of all the listed subjects from the cache, and build the
+        missing ones with a constant number of queries instead of three queries per subject."""
+        subjects = list(data.all() if isinstance(data, models.Manager) else data)
+        # Skip the water control when none of its fields is serialized.
+        if set(self.child.fields) & set(WATER_CONTROL_FIELDS):
+            wcs = cached_water_control_many(subjects)
+            for subject in subjects:
+                subject._water_control = wcs[subject.id]
+        return super(_WaterRestrictionListSerializer, self).to_representation(subjects)
 
 
 class _WaterRestrictionBaseSerializer(serializers.HyperlinkedModelSerializer):
@@ -45,6 +63,7 @@ class WaterRestrictedSubjectListSerializer(_WaterRestrictionBaseSerializer):
 
         lookup_field = 'nickname'
         extra_kwargs = {'url': {'view_name': 'subject-detail', 'lookup_field': 'nickname'}}
+        list_serializer_class = _WaterRestrictionListSerializer
 
 
 class ZygosityListSerializer(serializers.ModelSerializer):
@@ -67,7 +86,7 @@ class ZygosityListSerializer(serializers.ModelSerializer):
         fields = ('allele', 'zygosity')
 
 
-class SubjectListSerializer(_WaterRestrictionBaseSerializer):
+class SubjectListSerializer(SparseFieldsMixin, _WaterRestrictionBaseSerializer):
     genotype = serializers.ListField(
         source='zygosity_strings',
         required=False)
@@ -129,18 +148,27 @@ class SubjectListSerializer(_WaterRestrictionBaseSerializer):
         required=True,)
 
     @staticmethod
-    def setup_eager_loading(queryset):
+    def setup_eager_loading(queryset, fields=None):
         """ Perform necessary eager loading of data to avoid horrible performance."""
-        queryset = queryset.select_related(
-            'responsible_user', 'species', 'strain', 'line', 'litter')
-        queryset = queryset.prefetch_related('zygosity_set', 'zygosity_set__allele')
-        return queryset
+        return sparse_eager_loading(
+            queryset, fields,
+            select_related={
+                'responsible_user': ['responsible_user'],
+                'species': ['species'],
+                'strain': ['strain'],
+                'line': ['line'],
+                'litter': ['litter'],
+                'lab': ['lab'],
+                'genotype': ['line'],
+            },
+            prefetch_related={'genotype': ['zygosity_set', 'zygosity_set__allele']})
 
     class Meta:
         model = Subject
         fields = SUBJECT_LIST_SERIALIZER_FIELDS
         lookup_field = 'nickname'
         extra_kwargs = {'url': {'view_name': 'subject-detail', 'lookup_field': 'nickname'}}
+        list_serializer_class = _WaterRestrictionListSerializer
 
 
 class SubjectDetailSerializer(SubjectListSerializer, _WaterRestrictionBaseSerializer):
@@ -148,6 +176,18 @@ class SubjectDetailSerializer(SubjectListSerializer, _WaterRestrictionBaseSerial
     water_administrations = WaterAdministrationDetailSerializer(many=True, read_only=True)
     genotype = ZygosityListSerializer(source='zygosity_set', many=True, read_only=True)
 
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        queryset = SubjectListSerializer.setup_eager_loading(queryset, fields)
+        return sparse_eager_loading(
+            queryset, fields,
+            prefetch_related={
+                'weighings': ['weighings', 'weighings__user'],
+                'water_administrations': [
+                    'water_administrations', 'water_administrations__user',
+                    'water_administrations__water_type', 'water_administrations__session'],
+            })
+
     class Meta:
         model = Subject
         fields = list(SUBJECT_LIST_SERIALIZER_FIELDS)
@@ -1,4 +1,8 @@
+import json
+
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from alyx.base import BaseTests
 from actions.models import WaterAdministration, Weighing
@@ -20,6 +24,34 @@ class APISubjectsTests(BaseTests):
         self.assertTrue(set(('nickname', 'id', 'responsible_user', 'death_date',
                              'line', 'litter', 'sex', 'genotype', 'url')) <= set(d[0]))
 
+    def test_list_subjects_sparse_fields(self):
+        url = reverse('subject-list')
+        d = self.ar(self.client.get(url, data={'limit': 300, 'fields': 'nickname,id,lab'}))
+        self.assertEqual(set(d[0]), {'nickname', 'id', 'lab'})
+        # the water control is not computed when none of its fields is requested
+        with CaptureQueriesContext(connection) as full_queries:
+            self.client.get(url, data={'limit': 300})
+        n_full = len(full_queries)
+        with CaptureQueriesContext(connection) as sparse_queries:
+            self.client.get(url, data={'limit': 300, 'fields': 'nickname,id,lab'})
+        self.assertLess(len(sparse_queries), n_full)
+        d = self.ar(self.client.get(url, data={'exclude': 'genotype,expected_water'}))
+        self.assertTrue('nickname' in d[0] and 'reference_weight' in d[0])
+        self.assertFalse('genotype' in d[0] or 'expected_water' in d[0])
+        # the detail view prunes its fields as well
+        url = reverse('subject-detail', args=[d[0]['nickname']])
+        d = self.ar(self.client.get(url, data={'fields': 'nickname,weighings'}))
+        self.assertEqual(set(d), {'nickname', 'weighings'})
+
+    def test_list_subjects_stream(self):
+        url = reverse('subject-list')
+        expected = self.ar(self.client.get(url, data={'limit': 100000}))
+        # the whole list is streamed, without the default page size
+        r = self.client.get(url, data={'stream': 'ndjson'})
+        lines = b''.join(r.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(sorted(json.loads(line)['nickname'] for line in lines),
+                         sorted(d['nickname'] for d in expected))
+
     def test_list_alive_subjects(self):
         url = reverse('subject-list') + '?alive=True&stock=True&limit=300'
         d = self.ar(self.client.get(url))
@@ -2,6 +2,8 @@ from rest_framework import generics, permissions
 import django_filters
 from django_filters.rest_framework import FilterSet
 
+from alyx.base import StreamingListMixin
+
 from .models import Subject, Project
 from .serializers import (SubjectListSerializer,
                           SubjectDetailSerializer,
@@ -44,13 +46,17 @@ class SubjectFilter(FilterSet):
         exclude = ['json']
 
 
-class SubjectList(generics.ListCreateAPIView):
+class SubjectList(StreamingListMixin, generics.ListCreateAPIView):
     queryset = Subject.objects.all()
-    queryset = SubjectListSerializer.setup_eager_loading(queryset)
     serializer_class = SubjectListSerializer
     permission_classes = (permissions.IsAuthenticated,)
     filter_class = SubjectFilter
 
+    def get_queryset(self):
+        # Only load the relations of the requested fields.
+        return SubjectListSerializer.setup_eager_loading(
+            Subject.objects.all(), SubjectListSerializer.requested_fields(self.request))
+
 
 class SubjectDetail(generics.RetrieveUpdateDestroyAPIView):
     queryset = Subject.objects.all()
@@ -58,6 +64,10 @@ class SubjectDetail(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = (permissions.IsAuthenticated,)
     lookup_field = 'nickname'
 
+    def get_queryset(self):
+        return SubjectDetailSerializer.setup_eager_loading(
+            Subject.objects.all(), SubjectDetailSerializer.requested_fields(self.request))
+
 
 class ProjectList(generics.ListCreateAPIView):
     queryset = Project.objects.all()
@@ -77,6 +87,6 @@ class WaterRestrictedSubjectList(generics.ListAPIView):
     queryset = Subject.objects.all().extra(where=['''
         subjects_subject.id IN
         (SELECT subject_id FROM actions_waterrestriction
-         WHERE end_time IS NULL)'''])
+         WHERE end_time IS NULL)''']).select_related('lab')
     serializer_class = WaterRestrictedSubjectListSerializer
     permission_classes = (permissions.IsAuthenticated,)
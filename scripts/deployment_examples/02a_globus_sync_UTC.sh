@@ -2,6 +2,9 @@ cd /var/www/alyx-main/
 source ./venv/bin/activate
 cd alyx
 
+# register the files of the transfer tasks completed since the last run
+./manage.py files poll
+
 ./manage.py files bulksync --lab=cortexlab
 ./manage.py files bulksync --lab=mainenlab
 ./manage.py files bulksync --lab=mrsicflogellab
@@ -10,8 +13,3 @@ cd alyx
 ./manage.py files bulktransfer --lab=mainenlab
 ./manage.py files bulktransfer --lab=mrsicflogellab
 
-sleep 900
-
-./manage.py files bulksync --lab=cortexlab
-./manage.py files bulksync --lab=mainenlab
-./manage.py files bulksync --lab=mrsicflogellab
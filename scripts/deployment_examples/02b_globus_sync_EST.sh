@@ -2,6 +2,9 @@ cd /var/www/alyx-main/
 source ./venv/bin/activate
 cd alyx
 
+# register the files of the transfer tasks completed since the last run
+./manage.py files poll
+
 ./manage.py files bulksync --lab=churchlandlab
 ./manage.py files bulksync --lab=wittenlab
 ./manage.py files bulksync --lab=angelakilab
@@ -10,8 +13,3 @@ cd alyx
 ./manage.py files bulktransfer --lab=wittenlab
 ./manage.py files bulktransfer --lab=angelakilab
 
-sleep 900
-
-./manage.py files bulksync --lab=churchlandlab
-./manage.py files bulksync --lab=wittenlab
-./manage.py files bulksync --lab=angelakilab
@@ -2,10 +2,10 @@ cd /var/www/alyx-main/
 source ./venv/bin/activate
 cd alyx
 
+# register the files of the transfer tasks completed since the last run
+./manage.py files poll
+
 ./manage.py files bulksync --lab=danlab
 
 ./manage.py files bulktransfer --lab=danlab
 
-sleep 900
-
-./manage.py files bulksync --lab=danlab
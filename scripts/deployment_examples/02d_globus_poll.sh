@@ -0,0 +1,7 @@
+# run every few minutes to mark the files of completed Globus transfers as existing, e.g.
+# */10 * * * * /var/www/alyx-main/scripts/deployment_examples/02d_globus_poll.sh
+cd /var/www/alyx-main/
+source ./venv/bin/activate
+cd alyx
+
+./manage.py files poll
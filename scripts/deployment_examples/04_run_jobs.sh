@@ -0,0 +1,10 @@
+# run every minute to run the jobs of the database queue: weighing checks and underweight
+# notifications, water ledger updates, file status synchronizations... e.g.
+# * * * * * /var/www/alyx-main/scripts/deployment_examples/04_run_jobs.sh
+# Several runs can overlap, each job is only run once. Alternatively, a service can run
+# `./manage.py run_jobs` without `--once`, which polls the queue continuously.
+cd /var/www/alyx-main/
+source ./venv/bin/activate
+cd alyx
+
+./manage.py run_jobs --once